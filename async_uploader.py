@@ -0,0 +1,151 @@
+#
+# asyncio client for the ingest API. Producers await put() for each batch; a bounded queue between them and the
+# uploaders makes generation wait when the network is the bottleneck, so memory use stays bounded. Uploads are
+# counted in the same metrics as uploader.BatchUploader's.
+#
+# This is a library for asyncio programs; sparky.py uploads with uploader.BatchUploader. Requires aiohttp.
+#
+
+import asyncio, logging, time
+import aiohttp
+import ingest
+from uploader import UploadResult, RetryPolicy, RETRY_STATUS, parse_retry_after
+from uploader import IN_FLIGHT, UPLOAD_SECONDS, RESPONSES, RETRIES, EVENTS_UPLOADED, BYTES_UPLOADED, SKIPPED
+from journal import payload_digest
+
+log = logging.getLogger('async_uploader')
+
+
+class AsyncIngestClient:
+    # Use as "async with AsyncIngestClient(url, hdrs) as client:". Leaving the block waits for every queued batch to
+    # be uploaded. queue_size defaults to twice the concurrency. retry and journal work as for uploader.BatchUploader.
+    # Each UploadResult is passed to on_result(result) and not kept, so memory use doesn't grow with the number of
+    # batches; upload_all() collects them if you want them all.
+    def __init__(self, url, hdrs, concurrency=8, queue_size=None, timeout=60, on_result=None, retry=None, journal=None):
+        self.url = url
+        self.hdrs = hdrs
+        self.concurrency = concurrency
+        self.queue_size = queue_size or 2 * concurrency
+        self.timeout = timeout
+        self.on_result = on_result
+        self.retry = retry or RetryPolicy()
+        self.journal = journal
+        self._seq = 0
+
+    # Client for the host and API key given in the environment, as for ingest.ingest_from_env()
+    @classmethod
+    def from_env(cls, **kwargs):
+        url, hdrs = ingest.ingest_from_env()
+        return cls(url, hdrs, **kwargs)
+
+    async def __aenter__(self):
+        self._session = aiohttp.ClientSession(
+            headers=self.hdrs,
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [asyncio.ensure_future(self._worker()) for i in range(self.concurrency)]
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self._queue.join()
+        finally:
+            for w in self._workers:
+                w.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            await self._session.close()
+
+    # Queue one payload (bytes, or a batch.Batch) for upload, waiting while the queue is full. Returns its sequence
+    # number.
+    async def put(self, payload):
+        seq = self._seq
+        self._seq += 1
+        await self._queue.put((seq, payload))
+        return seq
+
+    # POST one payload now. Returns its UploadResult and the Retry-After header, if any
+    async def post(self, payload, seq=None, attempt=0):
+        async with self._session.post(self.url, data=getattr(payload, 'payload', payload)) as res:
+            content = await res.read()
+            batch_id = None
+            if res.status == 200:
+                try:
+                    batch_id = (await res.json(content_type=None))['results']['id']
+                except (ValueError, KeyError, TypeError):
+                    pass
+            return UploadResult(seq, batch_id, res.status, content, attempt + 1), res.headers.get('Retry-After')
+
+    # POST one payload, retrying transient failures as uploader.BatchUploader does. The journal is used on the default
+    # executor, as recording a batch waits for an fsync that would otherwise hold up every worker.
+    async def _upload_one(self, seq, payload):
+        loop = asyncio.get_running_loop()
+        digest = None
+        if self.journal is not None:
+            digest = await loop.run_in_executor(None, payload_digest, payload)
+            batch_id = await loop.run_in_executor(None, self.journal.accepted, digest)
+            if batch_id:
+                SKIPPED.inc()
+                return UploadResult(seq, batch_id, 200, b'', 0)
+        IN_FLIGHT.inc()
+        try:
+            attempt = 0
+            while True:
+                retry_after = None
+                t = time.perf_counter()
+                try:
+                    r, retry_after = await self.post(payload, seq, attempt)
+                    retryable = r.status_code in RETRY_STATUS
+                    retry_after = parse_retry_after(retry_after)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    r = UploadResult(seq, None, None, str(err).encode('utf-8'), attempt + 1)
+                    retryable = True
+                UPLOAD_SECONDS.observe(time.perf_counter() - t)
+                RESPONSES.labels(r.status_code or 'error').inc()
+                if not retryable or attempt >= self.retry.max_retries:
+                    break
+                RETRIES.inc()
+                await asyncio.sleep(self.retry.delay(attempt, retry_after))
+                attempt += 1
+        finally:
+            IN_FLIGHT.dec()
+        if r.batch_id:
+            EVENTS_UPLOADED.inc(getattr(payload, 'events', 0))
+            BYTES_UPLOADED.inc(len(getattr(payload, 'payload', payload)))
+            if self.journal is not None:
+                await loop.run_in_executor(None, self.journal.record, digest, r.batch_id)
+        return r
+
+    # Workers keep running whatever goes wrong with one payload (e.g. in the journal or on_result), as put() would wait
+    # forever on a full queue once they had all stopped. A payload that raised is given a failed UploadResult.
+    async def _worker(self):
+        while True:
+            seq, payload = await self._queue.get()
+            try:
+                try:
+                    r = await self._upload_one(seq, payload)
+                except Exception as err:
+                    log.exception('Upload of batch %d failed', seq)
+                    r = UploadResult(seq, None, None, str(err).encode('utf-8'), 1)
+                if self.on_result:
+                    try:
+                        self.on_result(r)
+                    except Exception:
+                        log.exception('on_result failed for batch %d', seq)
+            finally:
+                self._queue.task_done()
+
+
+# Upload every payload from an iterable (e.g. BatchBuilder.batches()) and return the results in order. on_result, if
+# given, is also called with each one as it arrives.
+async def upload_all(url, hdrs, payloads, concurrency=8, on_result=None, **kwargs):
+    results = {}
+    def collect(r):
+        results[r.seq] = r
+        if on_result:
+            on_result(r)
+    async with AsyncIngestClient(url, hdrs, concurrency=concurrency, on_result=collect, **kwargs) as client:
+        for p in payloads:
+            await client.put(p)
+    return [results[k] for k in sorted(results)]
@@ -0,0 +1,120 @@
+#
+# Split a stream of NDJSON event lines into gzip batches that stay within the ingest API payload limits
+#
+
+import zlib, collections, time
+import metrics
+
+# Limits applied when the caller doesn't give their own. The compressed limit is the one the ingest API enforces on
+# the request body; uncompressed size and event count are unlimited unless asked for.
+MAX_COMPRESSED_BYTES = 5 * 1024 * 1024
+MAX_UNCOMPRESSED_BYTES = None
+MAX_EVENTS = None
+
+# A ready-to-send gzip payload, with the number of events and uncompressed bytes it holds
+Batch = collections.namedtuple('Batch', ['payload', 'events', 'size'])
+
+BATCHES = metrics.counter('sparky_batches_built_total', 'Batches built')
+EVENTS = metrics.counter('sparky_batch_events_total', 'Events put into batches')
+UNCOMPRESSED = metrics.counter('sparky_batch_uncompressed_bytes_total', 'Event bytes put into batches')
+COMPRESSED = metrics.counter('sparky_batch_compressed_bytes_total', 'Compressed batch payload bytes')
+RATIO = metrics.histogram('sparky_compression_ratio', 'Uncompressed / compressed size of each batch',
+                          buckets=(2, 4, 6, 8, 10, 12, 15, 20, 25, 30))
+COMPRESS_SECONDS = metrics.histogram('sparky_compression_seconds', 'Time spent compressing each batch')
+
+
+# Count a finished batch in the metrics, with the seconds spent compressing it if known
+def observe(batch, seconds=None):
+    BATCHES.inc()
+    EVENTS.inc(batch.events)
+    UNCOMPRESSED.inc(batch.size)
+    COMPRESSED.inc(len(batch.payload))
+    RATIO.observe(batch.size / max(len(batch.payload), 1))
+    if seconds is not None:
+        COMPRESS_SECONDS.observe(seconds)
+
+
+# Worst-case compressed size of n bytes of input, as zlib's deflateBound() plus the 18-byte gzip header and trailer
+def gzip_bound(n):
+    return n + (n >> 12) + (n >> 14) + (n >> 25) + 13 + 18
+
+
+class BatchBuilder:
+    # sync_interval sets how often (in uncompressed bytes) the compressor is flushed, so that the output size so far
+    # is known exactly. It bounds how much slack is left under max_compressed at the cost of a few bytes per flush,
+    # so it is capped at a quarter of max_compressed; otherwise small batches would close long before they're full.
+    def __init__(self, max_compressed=MAX_COMPRESSED_BYTES, max_uncompressed=MAX_UNCOMPRESSED_BYTES, max_events=MAX_EVENTS,
+                 level=9, sync_interval=256 * 1024):
+        self.max_compressed = max_compressed
+        self.max_uncompressed = max_uncompressed
+        self.max_events = max_events
+        self.level = level
+        self.sync_interval = sync_interval if max_compressed is None else max(min(sync_interval, max_compressed // 4), 1)
+        self._start()
+
+    def _start(self):
+        self._z = zlib.compressobj(self.level, zlib.DEFLATED, 31)  # wbits=31 gives gzip header and trailer
+        self._chunks = []
+        self._compressed = 0                    # compressed bytes emitted so far
+        self._pending = 0                       # uncompressed bytes given to the compressor since it was last flushed
+        self._size = 0
+        self._events = 0
+        self._seconds = 0.0                     # time spent in the compressor
+
+    def _emit(self, chunk):
+        if chunk:
+            self._chunks.append(chunk)
+            self._compressed += len(chunk)
+
+    def _fits(self, n):
+        if self.max_events is not None and self._events + 1 > self.max_events:
+            return False
+        if self.max_uncompressed is not None and self._size + n > self.max_uncompressed:
+            return False
+        if self.max_compressed is not None and self._compressed + gzip_bound(self._pending + n) > self.max_compressed:
+            return False
+        return True
+
+    # Add one event line (str or bytes). Returns the previous Batch if this line would not fit in it, otherwise None.
+    def add(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        n = len(line)
+        batch = None
+        if not self._fits(n):
+            if self._events == 0:
+                raise ValueError('Event of {} bytes is too large to fit in any batch'.format(n))
+            batch = self.flush()
+            if not self._fits(n):
+                raise ValueError('Event of {} bytes is too large to fit in any batch'.format(n))
+        t = time.perf_counter()
+        self._emit(self._z.compress(line))
+        self._pending += n
+        self._size += n
+        self._events += 1
+        if self._pending >= self.sync_interval:
+            self._emit(self._z.flush(zlib.Z_SYNC_FLUSH))
+            self._pending = 0
+        self._seconds += time.perf_counter() - t
+        return batch
+
+    # Finish the batch in progress. Returns None if it has no events.
+    def flush(self):
+        if self._events == 0:
+            return None
+        t = time.perf_counter()
+        self._emit(self._z.flush())
+        batch = Batch(b''.join(self._chunks), self._events, self._size)
+        observe(batch, self._seconds + time.perf_counter() - t)
+        self._start()
+        return batch
+
+    # Generator: consume an iterable of event lines, yielding each Batch as soon as it is full
+    def batches(self, lines):
+        for line in lines:
+            batch = self.add(line)
+            if batch:
+                yield batch
+        batch = self.flush()
+        if batch:
+            yield batch
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for event construction, serialization, compression and upload.
+#
+# Reports events/sec, bytes/sec and peak memory for each case, and saves the results as JSON. Give --compare with an
+# earlier results file to see the change, and flag regressions.
+#
+
+from __future__ import print_function
+import argparse, gzip, inspect, json, platform, sys, time, tracemalloc
+import ingest, sequences, batch, compress, mock_ingest
+
+# Sample values for the make_*_event builders' parameters, by name
+SAMPLE_ARGS = {
+    'msg_from': 'test@bounces.test.sparkpost.com',
+    'friendly_from': 'sp-event-agent@test.sparkpost.com',
+    'rcpt_to': 'fred.bloggs123456789012@ingest.thetucks.com',
+    'uniq_msg_id': '0000a00dcc624c882e80',
+    'campaign_id': 'big nice campaign',
+    'subject': 'lovely test email',
+    'sending_ip': '10.0.0.1',
+    'geo_ip': {'country': 'US', 'region': 'MD', 'city': 'Columbia', 'latitude': 39.1749, 'longitude': -76.8375,
+               'zip': 21046, 'postal_code': '21046'},
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36',
+    'bounce_code': '554',
+    'bounce_reason': 'smtp;554 5.7.1 Blacklisted by black.uribl.com Contact the postmaster of this domain for resolution.',
+    'bounce_class': '51',
+    'raw_reason': 'smtp;554 5.7.1 Blacklisted by black.uribl.com Contact the postmaster of this domain for resolution.',
+}
+
+
+# Time fn(), which returns (events, bytes) handled per call, repeating until min_time has passed. The best run is
+# reported, then one more run is made under tracemalloc for peak memory.
+def bench(name, fn, min_time):
+    best = None
+    elapsed = 0.0
+    while elapsed < min_time or best is None:
+        t = time.perf_counter()
+        events, nbytes = fn()
+        dt = time.perf_counter() - t
+        elapsed += dt
+        best = dt if best is None else min(best, dt)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    r = {
+        'name': name,
+        'seconds': best,
+        'events': events,
+        'bytes': nbytes,
+        'events_per_sec': events / best if best else None,
+        'bytes_per_sec': nbytes / best if best else None,
+        'peak_memory': peak,
+    }
+    print('{:<60} {:>12} ev/s {:>10} MB/s {:>10} KiB peak'.format(name,
+        '{:,.0f}'.format(r['events_per_sec']) if events else '-',
+        '{:,.1f}'.format(r['bytes_per_sec'] / 1e6) if nbytes else '-',
+        '{:,.0f}'.format(peak / 1024)))
+    return r
+
+
+def make_event_cases(n):
+    for name, fn in sorted(vars(ingest).items()):
+        if not (name.startswith('make_') and name.endswith('_event')) or name == 'make_event':
+            continue                                # make_event is the generic form the builders call
+        params = inspect.signature(fn).parameters
+        args = {k: v for k, v in SAMPLE_ARGS.items() if k in params}
+        for privacy in (False, True):
+            def case(fn=fn, args=args, privacy=privacy):
+                ts = sequences.FakeTimestamp(0, 1)
+                nbytes = 0
+                for i in range(n):
+                    nbytes += len(fn(ts=ts, privacy=privacy, **args))
+                return n, nbytes
+            yield 'ingest.{}(privacy={})'.format(name, privacy), case
+
+
+def sequence_cases(sizes):
+    for name, fn in sorted(vars(sequences).items()):
+        if not (name.startswith('make_') and '_events_sequence' in name):
+            continue
+        for n in sizes:
+            def case(fn=fn, n=n):
+                s = fn(sequences.FakeTimestamp(0, 1), n, True)
+                return s.count('\n'), len(s)
+            yield 'sequences.{}(n={})'.format(name, n), case
+
+
+# n messages of the success sequence, one event at a time and then a block of messages at a time with NumPy. The
+# columnar case is left out if numpy isn't installed.
+def generator_cases(n):
+    spec = sequences.SEQUENCES['success'](True)
+    events = n * sum(len(message) for message in spec)
+    def case():
+        nbytes = 0
+        for line in sequences.iter_events(sequences.FakeTimestamp(0, 1), n, spec):
+            nbytes += len(line)
+        return events, nbytes
+    yield 'sequences.iter_events(success, {:,} events)'.format(events), case
+    try:
+        import columnar
+    except ImportError:
+        return
+    def case():
+        nbytes = 0
+        for text in columnar.ColumnarGenerator('success', True, 0, 1, seed=1).blocks(n):
+            nbytes += len(text)
+        return events, nbytes
+    yield 'columnar.ColumnarGenerator(success, {:,} events)'.format(events), case
+
+
+# The same messages generated and batched on 1, 2, 4 ... worker processes, to show how parallel.py scales
+def parallel_cases(n, processes_list):
+    import parallel
+    events = n * parallel.events_per_message('success', True)
+    for processes in processes_list:
+        def case(processes=processes):
+            nbytes = 0
+            for b in parallel.generate_batches('success', n, True, 0, 1, processes, chunk=max(n // 16, 1), seed=1):
+                nbytes += b.size
+            return events, nbytes
+        yield 'parallel.generate_batches(processes={}, {:,} events)'.format(processes, events), case
+
+
+# Every run hashes the same recipients, so the privacy cache is cleared first for the cold case (the cost of hashing
+# new recipients) and kept for the warm one (recipients seen again, e.g. opens and clicks after a delivery)
+def privacy_cases(n):
+    rcpts = ['fred.bloggs{}@ingest.thetucks.com'.format(i) for i in range(n)]
+    for privacy, cache in ((False, None), (True, 'cold'), (True, 'warm')):
+        def case(privacy=privacy, cache=cache):
+            if cache == 'cold':
+                ingest.rcpt_privacy.cache_clear()
+            for r in rcpts:
+                ingest.apply_privacy({'rcpt_to': r}, privacy)
+            return n, 0
+        yield 'ingest.apply_privacy(privacy={}{})'.format(privacy, ', ' + cache + ' cache' if cache else ''), case
+
+
+# The parallel cases split the sample into at least eight members, so that they compress in parallel even when the
+# sample is smaller than compress.MEMBER_SIZE (as with --quick)
+def gzip_cases(data, levels):
+    chunk_size = min(compress.MEMBER_SIZE, max(len(data) // 8, 1))
+    for level in levels:
+        def case(level=level):
+            gzip.compress(data, compresslevel=level)
+            return 0, len(data)
+        yield 'gzip.compress(level={})'.format(level), case
+        def case(level=level):
+            compress.parallel_compress(data, level, chunk_size)
+            return 0, len(data)
+        yield 'compress.parallel_compress(level={}, chunk={:,} KiB)'.format(level, chunk_size // 1024), case
+    def case():
+        for b in batch.BatchBuilder().batches(data.splitlines(keepends=True)):
+            pass
+        return data.count(b'\n'), len(data)
+    yield 'batch.BatchBuilder()', case
+    def case():
+        for b in compress.ParallelBatchBuilder(member_size=chunk_size).batches(data.splitlines(keepends=True)):
+            pass
+        return data.count(b'\n'), len(data)
+    yield 'compress.ParallelBatchBuilder(member_size={:,} KiB)'.format(chunk_size // 1024), case
+
+
+# The stand-in server and the events to upload are only set up when a case first runs, so that filtering out the
+# upload cases with -k costs nothing
+def upload_cases(n, workers_list, latency):
+    import uploader
+    spec = sequences.SEQUENCES['success'](True)
+    events = n * sum(len(message) for message in spec)
+    setup = {}
+    def prepare():
+        if not setup:
+            server = mock_ingest.MockIngestServer(latency=latency).start()
+            lines = list(sequences.iter_events(sequences.FakeTimestamp(0, 1), n, spec))
+            setup.update(url=ingest.ingest_url(server.url), lines=lines, nbytes=sum(len(l) for l in lines))
+        return setup
+    for workers in workers_list:
+        def case(workers=workers):
+            s = prepare()
+            builder = batch.BatchBuilder(max_events=100)
+            with uploader.BatchUploader(s['url'], ingest.ingest_hdrs('benchmark'), workers=workers) as up:
+                for r in up.upload(builder.batches(s['lines'])):
+                    assert r.status_code == 200
+            return len(s['lines']), s['nbytes']
+        yield 'end-to-end upload (workers={}, {:,} events)'.format(workers, events), case
+
+
+def compare(results, baseline, threshold):
+    old = {r['name']: r for r in baseline['results']}
+    regressions = 0
+    print('\nChange against baseline ({}):'.format(baseline.get('time', '?')))
+    for r in results:
+        o = old.get(r['name'])
+        if not o or not o['seconds']:
+            continue
+        change = o['seconds'] / r['seconds'] - 1            # > 0 means faster
+        flag = ''
+        if change < -threshold:
+            flag = '  <-- REGRESSION'
+            regressions += 1
+        print('{:<60} {:>+7.1%}{}'.format(r['name'], change, flag))
+    return regressions
+
+
+# -----------------------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark event generation, compression and upload')
+    parser.add_argument('-o', '--output', help='Save results to this JSON file', default='benchmark_results.json')
+    parser.add_argument('-c', '--compare', help='Compare against an earlier results file')
+    parser.add_argument('-t', '--threshold', help='Slowdown that counts as a regression (default 0.10)', type=float, default=0.10)
+    parser.add_argument('-k', '--filter', help='Only run cases whose name contains this text')
+    parser.add_argument('--min-time', help='Minimum seconds to spend on each case', type=float, default=1.0)
+    parser.add_argument('--quick', help='Smaller sizes, for a fast check', action='store_true')
+    parser.add_argument('--latency', help='Round-trip time simulated by the stand-in upload server, in seconds', type=float, default=0.02)
+    args = parser.parse_args(argv)
+
+    n = 1000 if args.quick else 10000
+    sizes = [1, 100, 1000] if args.quick else [1, 100, 1000, 10000]
+    results = []
+    sample = ''.join(sequences.iter_events(sequences.FakeTimestamp(0, 1), n // 5, sequences.SEQUENCES['success'](True))).encode('utf-8')
+    cases = []
+    cases += make_event_cases(n)
+    cases += sequence_cases(sizes)
+    cases += generator_cases(n)
+    cases += parallel_cases(n, [1, 2, 4])
+    cases += privacy_cases(n)
+    cases += gzip_cases(sample, [1, 6, 9])
+    cases += upload_cases(n // 5, [1, 4, 16], args.latency)
+
+    for name, fn in cases:
+        if args.filter and args.filter not in name:
+            continue
+        results.append(bench(name, fn, args.min_time))
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to', args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
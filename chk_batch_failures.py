@@ -1,54 +1,160 @@
 #!/usr/bin/env python3
 #
-import requests, gzip, os, argparse
+import zlib, json, sys, argparse, collections
+from concurrent.futures import ThreadPoolExecutor
+import ingest
 
 
-def stripEnd(h, s):
-    if h.endswith(s):
-        h = h[:-len(s)]
-    return h
+# Generator: decompress a gzip response body as it arrives, yielding complete lines. Bodies that are not gzip
+# (e.g. already decoded by requests because of a Content-Encoding header) are passed through unchanged. A body of
+# several gzip members (RFC 1952 allows this) is read to the end.
+def iter_lines(chunks):
+    d = None
+    buf = b''
+    for chunk in chunks:
+        if d is None:
+            d = zlib.decompressobj(47) if chunk[:2] == b'\x1f\x8b' else False  # wbits=47: gzip or zlib header
+        if d:
+            data = chunk
+            chunk = b''
+            while data:
+                if d.eof:                       # another gzip member follows
+                    d = zlib.decompressobj(47)
+                chunk += d.decompress(data)
+                data = d.unused_data
+        buf += chunk
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            yield line
+    if d:
+        buf += d.flush()
+    if buf:
+        yield buf
 
 
-# condense into a access+base_url form
-def hostCleanup(host):
-    if not host.startswith('https://'):
-        host = 'https://' + host  # Add schema
-    host = stripEnd(host, '/')
-    host = stripEnd(host, '/api/v1')
-    host = stripEnd(host, '/')
-    return host
+# Ingest event type of the event a failure refers to, e.g. "delivery". Events with an unrecognised class
+# are shown as "class/type", e.g. "banana/reception".
+def event_type_of(failure):
+    ev = failure.get('event')
+    if isinstance(ev, str):
+        try:
+            ev = json.loads(ev)
+        except ValueError:
+            return 'unparseable'
+    if not isinstance(ev, dict) or not isinstance(ev.get('msys'), dict) or not ev['msys']:
+        return 'unknown'
+    ev_class, body = next(iter(ev['msys'].items()))
+    t = body.get('type', 'unknown') if isinstance(body, dict) else 'unknown'
+    return t if ev_class in ('message_event', 'track_event', 'gen_event', 'unsubscribe_event') else ev_class + '/' + t
+
+
+def error_type_of(failure):
+    return failure.get('error_type') or failure.get('type') or 'unknown'
+
+
+# Fetch the failures for one batch, returning (batch ID, status code, summary dict, raw lines if keep_lines)
+def check_batch(session, url, batch_id, keep_lines):
+    import requests
+    summary = {'failures': 0, 'error_types': collections.Counter(), 'event_types': collections.Counter()}
+    lines = []
+    try:
+        res = session.get(url + '/failures/' + batch_id, stream=True, timeout=60)
+    except requests.RequestException as err:
+        summary['error'] = str(err)
+        return batch_id, None, summary, lines
+    with res:
+        if res.status_code != 200:
+            summary['error'] = res.content.decode('utf8', errors='replace')
+            return batch_id, res.status_code, summary, lines
+        try:
+            for line in iter_lines(res.iter_content(64 * 1024)):
+                if keep_lines:
+                    lines.append(line)
+                if not line.strip():
+                    continue
+                summary['failures'] += 1
+                try:
+                    f = json.loads(line)
+                except ValueError:
+                    summary['error_types']['unparseable'] += 1
+                    continue
+                summary['error_types'][error_type_of(f)] += 1
+                summary['event_types'][event_type_of(f)] += 1
+        except zlib.error as err:
+            summary['error'] = str(err)
+    return batch_id, res.status_code, summary, lines
+
+
+# Generator: batch IDs from the command line and/or a file ("-" for stdin), one per line
+def batch_ids(args):
+    for i in args.batch:
+        yield i
+    if args.file:
+        f = sys.stdin if args.file == '-' else open(args.file, 'r')
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+# Like pool.map, but with no more than "limit" calls outstanding, so a long input isn't all submitted at once
+def bounded_map(pool, fn, items, limit):
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+        pending.append(pool.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
 
 # -----------------------------------------------------------------------------------------
 # Main code
 # -----------------------------------------------------------------------------------------
-parser = argparse.ArgumentParser(description='Get batch failures')
-parser.add_argument('batch', help='Batch ID', type=str, nargs = '+')
-args = parser.parse_args()
-
-host = hostCleanup(os.getenv('SPARKPOST_HOST', default='api.sparkpost.com'))
-url = host + '/api/v1/ingest/events'
-
-apiKey = os.getenv('SPARKPOST_API_KEY')
-if apiKey == None:
-    print('Environment variable SPARKPOST_API_KEY not set - stopping.')
-    exit(1)
-
-hdrs = {
-    'Authorization': apiKey,
-    'Content-Type': 'application/x-ndjson',
-    'Content-Encoding': 'gzip'
-}
-
-for i in args.batch:
-    res = requests.get(url + '/failures/' + i, headers=hdrs)
-    print('Batch "{}", check status: {}\n'.format(i, res.status_code))
-    result = res.content
-    if res.status_code == 200:
-        try:
-            decoded = gzip.decompress(result)
-        except Exception as err:
-            print(err)
-            decoded = result
-        print(decoded.decode('utf8'))
-    else:
-        print(res.content.decode('utf8'))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Get batch failures')
+    parser.add_argument('batch', help='Batch ID', type=str, nargs='*')
+    parser.add_argument('-f', '--file', help='Read batch IDs from this file, one per line ("-" for stdin)')
+    parser.add_argument('-w', '--workers', help='Number of batches to fetch in parallel', type=int, default=8)
+    parser.add_argument('-s', '--summary', help='Write a JSON summary of failure counts to this file ("-" for stdout)')
+    parser.add_argument('-q', '--quiet', help='Don\'t print each batch\'s failure records', action='store_true')
+    args = parser.parse_args(argv)
+    if not args.batch and not args.file:
+        parser.error('give at least one batch ID, or --file')
+
+    url, hdrs = ingest.ingest_from_env()
+
+    import requests                             # imported when needed, so importing this module stays quick
+    session = requests.Session()
+    session.headers.update(hdrs)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    totals = {'batches': {}, 'failures': 0, 'error_types': collections.Counter(), 'event_types': collections.Counter()}
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        keep_lines = not args.quiet
+        results = bounded_map(pool, lambda i: check_batch(session, url, i, keep_lines), batch_ids(args), 2 * args.workers)
+        for i, status, summary, lines in results:
+            if not args.quiet:
+                print('Batch "{}", check status: {}\n'.format(i, status))
+                if status == 200:
+                    print(b'\n'.join(lines).decode('utf8', errors='replace'))
+                else:
+                    print(summary.get('error', ''))
+            totals['batches'][i] = dict(summary, status=status)
+            totals['failures'] += summary['failures']
+            totals['error_types'].update(summary['error_types'])
+            totals['event_types'].update(summary['event_types'])
+
+    if args.summary:
+        out = sys.stdout if args.summary == '-' else open(args.summary, 'w')
+        json.dump(totals, out, indent=2, sort_keys=True)
+        out.write('\n')
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#
+# Columnar event generation with NumPy, for load tests with millions of messages.
+#
+# Timestamps, event IDs, message IDs and recipients are produced as arrays for a block of messages at a time, then
+# spliced into the compiled event templates (see ingest.compile_event) a column at a time. The output has the same
+# schema and formatting as the sequences in sequences.py.
+#
+# Requires numpy 2 or later (for np.strings).
+#
+
+import re, time, struct
+import numpy as np
+import ingest, sequences
+
+_SLOT = re.compile(r'%\((\w)\)s')
+
+
+class ColumnarGenerator:
+    # spec is a sequence name from sequences.SEQUENCES, or a spec as returned by one of the *_events_spec functions.
+    # Timestamps follow sequences.FakeTimestamp(begintime, naptime): each event is naptime after the previous one.
+    # recipients is an optional list of addresses to draw from at random; by default each message gets a new
+    # fred.bloggs address, as uniq_recip() does.
+    def __init__(self, spec, privacy, begintime, naptime, recipients=None, seed=None, block=4096):
+        if isinstance(spec, str):
+            spec = sequences.SEQUENCES[spec](privacy)
+        self.block = block
+        self.rng = np.random.default_rng(seed)
+        self.recipients = np.asarray(recipients, dtype=str) if recipients is not None else None
+        self.messages = len(spec)
+        self.events = []                        # (positional format, slots, message index) for each event in one play
+        for m, message in enumerate(spec):
+            for event in message:
+                self.events.append((_SLOT.sub('%s', event.fmt), _SLOT.findall(event.fmt), m))
+        # Keep ints as ints, and accumulate floats step by step, just as FakeTimestamp does
+        self._float = not (isinstance(begintime, int) and isinstance(naptime, int))
+        self._ts = begintime
+        self.naptime = naptime
+
+    def _timestamps(self, count):
+        steps = np.full(count + 1, self.naptime, dtype=np.float64 if self._float else np.int64)
+        steps[0] = self._ts
+        ts = np.cumsum(steps)[1:]
+        self._ts = ts[-1].item()
+        if self._float:
+            return np.array([str(t) for t in ts.tolist()])
+        return ts.astype(str)
+
+    def _event_ids(self, count):
+        return self.rng.integers(0, 2 ** 63 - 1, size=count, dtype=np.int64, endpoint=True).astype(str)
+
+    def _message_ids(self, count):
+        prefix = '0000' + struct.pack('<I', int(time.time()) & 0xffffffff).hex()
+        rand = self.rng.integers(0, 2 ** 32, size=count, dtype=np.uint64)
+        return np.strings.add(prefix, np.strings.zfill(np.char.mod('%x', rand), 8))
+
+    def _recipients(self, count):
+        if self.recipients is None:
+            digits = self.rng.integers(10 ** 11, 10 ** 12, size=count, dtype=np.int64).astype(str)
+            return np.strings.add(np.strings.add('fred.bloggs', digits), '@ingest.thetucks.com')
+        return self.recipients[self.rng.integers(0, len(self.recipients), size=count)]
+
+    # Per-recipient columns: escaped address and domain, and privacy hash. Each distinct recipient is worked out once.
+    def _recipient_columns(self, rcpts, slots):
+        uniq, inverse = np.unique(rcpts, return_inverse=True)
+        cols = {'r': np.array([ingest._escaped(r) for r in uniq.tolist()])[inverse]}
+        if 'h' in slots:
+            priv = [ingest.rcpt_privacy(r) for r in uniq.tolist()]
+            cols['h'] = np.array([p[0] for p in priv])[inverse]
+            cols['d'] = np.array([ingest._escaped(p[1]) for p in priv])[inverse]
+        elif 'd' in slots:
+            cols['d'] = np.array([ingest._escaped(r.split('@')[1]) for r in uniq.tolist()])[inverse]
+        return cols
+
+    # Render plays of the spec (messages) into an array of NDJSON lines, shape (plays, events per play)
+    def _render(self, plays):
+        all_slots = set(s for e in self.events for s in e[1])
+        per_msg = plays * self.messages
+        cols = self._recipient_columns(self._recipients(per_msg), all_slots)
+        cols['m'] = self._message_ids(per_msg)
+        for k in cols:
+            cols[k] = cols[k].reshape(plays, self.messages)
+        n_events = len(self.events)
+        ts = self._timestamps(plays * n_events).reshape(plays, n_events)
+        eids = self._event_ids(plays * n_events).reshape(plays, n_events)
+        out = np.empty((plays, n_events), dtype=object)
+        for k, (fmt, slots, m) in enumerate(self.events):
+            columns = []
+            for slot in slots:
+                if slot == 't':
+                    columns.append(ts[:, k].tolist())
+                elif slot == 'e':
+                    columns.append(eids[:, k].tolist())
+                else:
+                    columns.append(cols[slot][:, m].tolist())
+            out[:, k] = [fmt % row for row in zip(*columns)]
+        return out
+
+    # Generator: NDJSON text for n plays of the spec, a block at a time
+    def blocks(self, n):
+        for start in range(0, n, self.block):
+            yield ''.join(self._render(min(self.block, n - start)).ravel().tolist())
+
+    # Generator: individual NDJSON lines for n plays of the spec, e.g. for batch.BatchBuilder
+    def lines(self, n):
+        for start in range(0, n, self.block):
+            for line in self._render(min(self.block, n - start)).ravel().tolist():
+                yield line
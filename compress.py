@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# Compression backends for batch payloads.
+#
+# "gzip" compresses a payload as one gzip stream on the calling thread. "parallel" splits it at line boundaries into
+# chunks that are compressed at the same time on a thread pool (zlib releases the GIL while it works) and joined as a
+# multi-member gzip stream, which RFC 1952 allows and standard decoders accept. ParallelBatchBuilder does the same
+# while building upload batches, as a drop-in for batch.BatchBuilder.
+#
+# Run this file to report throughput against compression ratio for each backend and level, on a file of NDJSON or
+# on generated events, to pick the best setting for a link.
+#
+
+from __future__ import print_function
+import argparse, os, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+import batch
+
+MEMBER_SIZE = 1024 * 1024                       # uncompressed bytes per gzip member in parallel mode
+
+
+def gzip_compress(data, level=9):
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 gives gzip header and trailer
+    return z.compress(data) + z.flush()
+
+
+# Split data into chunks of about chunk_size bytes, each ending at a line boundary
+def split_lines(data, chunk_size):
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + chunk_size - 1)
+        end = len(data) if end < 0 else end + 1
+        yield data[start:end]
+        start = end
+
+
+_pool = None
+
+
+def _default_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _pool
+
+
+# Multi-member gzip of data, with chunks compressed in parallel on pool (default: a shared pool, one thread per CPU)
+def parallel_compress(data, level=9, chunk_size=MEMBER_SIZE, pool=None):
+    pool = pool or _default_pool()
+    return b''.join(pool.map(lambda c: gzip_compress(c, level), split_lines(data, chunk_size)))
+
+
+# Backends by name: functions of (data, level) returning gzip bytes. Add to this to try others.
+BACKENDS = {
+    'gzip': gzip_compress,
+    'parallel': parallel_compress,
+}
+
+
+# Like batch.BatchBuilder, but each batch is made of gzip members of about member_size uncompressed bytes, compressed
+# on a thread pool while further lines are added. Payloads stay within max_compressed: sizes of members still being
+# compressed are taken at their worst case, and only waited for when that would go over the limit. The batch is
+# closed once the room left is less than a full member could take, so member_size is capped at a quarter of
+# max_compressed; otherwise small batches would close long before they're full.
+class ParallelBatchBuilder:
+    def __init__(self, max_compressed=batch.MAX_COMPRESSED_BYTES, max_uncompressed=batch.MAX_UNCOMPRESSED_BYTES,
+                 max_events=batch.MAX_EVENTS, level=9, member_size=MEMBER_SIZE, pool=None):
+        self.max_compressed = max_compressed
+        self.max_uncompressed = max_uncompressed
+        self.max_events = max_events
+        self.level = level
+        self.member_size = member_size if max_compressed is None else max(min(member_size, max_compressed // 4), 1)
+        self.pool = pool or _default_pool()
+        self._start()
+
+    def _start(self):
+        self._members = []                      # futures for the compressed members, in order
+        self._raw = []                          # uncompressed size of each member not yet known to be done
+        self._compressed = 0                    # compressed bytes of members known to be done
+        self._buf = []                          # lines for the member being filled
+        self._buf_size = 0
+        self._size = 0
+        self._events = 0
+
+    def _bound(self, n):
+        return self._compressed + sum(batch.gzip_bound(r) for r in self._raw) + batch.gzip_bound(self._buf_size + n)
+
+    # Wait for the members being compressed, so their sizes are known exactly
+    def _settle(self):
+        if self._raw:
+            self._compressed = sum(len(m.result()) for m in self._members)
+            self._raw = []
+
+    def _fits(self, n):
+        if self.max_events is not None and self._events + 1 > self.max_events:
+            return False
+        if self.max_uncompressed is not None and self._size + n > self.max_uncompressed:
+            return False
+        if self.max_compressed is not None and self._bound(n) > self.max_compressed:
+            if self._events == 0:
+                return False
+            self._submit()                      # close off the member being filled, so only this line is a guess
+            self._settle()
+            # Rather than settle again for each further line, in ever smaller members, close the batch once there
+            # isn't room for another full member
+            if self.max_compressed - self._compressed < batch.gzip_bound(self.member_size):
+                return False
+            return self._bound(n) <= self.max_compressed
+        return True
+
+    def _submit(self):
+        if self._buf:
+            data = b''.join(self._buf)
+            self._members.append(self.pool.submit(gzip_compress, data, self.level))
+            self._raw.append(len(data))
+            self._buf = []
+            self._buf_size = 0
+
+    # Add one event line (str or bytes). Returns the previous Batch if this line would not fit in it, otherwise None.
+    def add(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        n = len(line)
+        b = None
+        if not self._fits(n):
+            if self._events == 0:
+                raise ValueError('Event of {} bytes is too large to fit in any batch'.format(n))
+            b = self.flush()
+            if not self._fits(n):
+                raise ValueError('Event of {} bytes is too large to fit in any batch'.format(n))
+        self._buf.append(line)
+        self._buf_size += n
+        self._size += n
+        self._events += 1
+        if self._buf_size >= self.member_size:
+            self._submit()
+        return b
+
+    # Finish the batch in progress. Returns None if it has no events.
+    def flush(self):
+        if self._events == 0:
+            return None
+        self._submit()
+        b = batch.Batch(b''.join(m.result() for m in self._members), self._events, self._size)
+        batch.observe(b)                        # compression time is spread over the pool, so isn't counted
+        self._start()
+        return b
+
+    # Generator: consume an iterable of event lines, yielding each Batch as soon as it is full
+    def batches(self, lines):
+        for line in lines:
+            b = self.add(line)
+            if b:
+                yield b
+        b = self.flush()
+        if b:
+            yield b
+
+
+# Returns a batch builder for a backend name and level, with the given limits
+def make_builder(backend='gzip', level=9, **limits):
+    if backend == 'parallel':
+        return ParallelBatchBuilder(level=level, **limits)
+    return batch.BatchBuilder(level=level, **limits)
+
+
+# Time each backend at each level on data, returning a list of dicts with MB/s and compression ratio
+def compare_backends(data, levels=(1, 6, 9), backends=None, min_time=1.0):
+    results = []
+    for name in backends or sorted(BACKENDS):
+        fn = BACKENDS[name]
+        for level in levels:
+            best = None
+            elapsed = 0.0
+            while elapsed < min_time or best is None:
+                t = time.perf_counter()
+                out = fn(data, level)
+                dt = time.perf_counter() - t
+                elapsed += dt
+                best = dt if best is None else min(best, dt)
+            results.append({'backend': name, 'level': level, 'seconds': best, 'mb_per_sec': len(data) / best / 1e6,
+                            'ratio': len(data) / len(out), 'compressed': len(out)})
+    return results
+
+
+# -----------------------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare compression backends and levels for batch payloads')
+    parser.add_argument('file', help='NDJSON file to compress (default: generated success events)', nargs='?')
+    parser.add_argument('-l', '--levels', help='Comma-separated levels (default 1,6,9)', default='1,6,9')
+    parser.add_argument('-n', '--messages', help='Messages to generate if no file is given (default 20000)', type=int, default=20000)
+    parser.add_argument('--min-time', help='Minimum seconds to spend on each case', type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            data = f.read()
+    else:
+        import sequences
+        spec = sequences.SEQUENCES['success'](True)
+        data = ''.join(sequences.iter_events(sequences.FakeTimestamp(0, 1), args.messages, spec)).encode('utf-8')
+    print('{:,} bytes, {} CPUs'.format(len(data), os.cpu_count()))
+    print('{:<10} {:>5} {:>10} {:>8}'.format('backend', 'level', 'MB/s', 'ratio'))
+    for r in compare_backends(data, [int(l) for l in args.levels.split(',')], min_time=args.min_time):
+        print('{backend:<10} {level:>5} {mb_per_sec:>10.1f} {ratio:>8.2f}'.format(**r))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#
+# Persistent index of the event_ids and batches accepted by the ingest API, so that events aren't sent twice across
+# runs, e.g. when replaying overlapping windows of archived events.
+#
+# The index is a SQLite file holding a 64-bit hash of each accepted event_id, and the payload digest and batch ID
+# of each accepted batch. Lookups in the generate/replay loop go to an in-memory Bloom filter first, built from the
+# file when it is opened, so only events that may have been seen before cost a SQLite query.
+#
+# DedupIndex has the accepted(digest) / record(digest, batch_id) methods of journal.UploadJournal, so it can be given
+# to uploader.BatchUploader as its journal. Events are only added to the index once the batch holding them is
+# accepted; a failed batch leaves them to be sent again on a later run. Wrap a batch builder with builder() to drop
+# events already in the index, or already sent in this run, before they are batched.
+#
+
+import hashlib, math, re, sqlite3, threading, time
+import batch
+from journal import payload_digest
+
+EVENT_ID = re.compile(rb'"event_id"\s*:\s*"([^"]*)"')
+
+
+# 64-bit key for an event_id (str or bytes), as stored in the index
+def event_key(event_id):
+    if isinstance(event_id, str):
+        event_id = event_id.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(event_id, digest_size=8).digest(), 'little', signed=True)
+
+
+# Key for the event_id of an NDJSON line (str or bytes), or None if it has none
+def line_key(line):
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    m = EVENT_ID.search(line)
+    return event_key(m.group(1)) if m else None
+
+
+class BloomFilter:
+    # Sized for capacity keys at a false positive rate of error. Keys are 64-bit ints, already well mixed, so the
+    # bit positions are derived from their two halves by double hashing.
+    def __init__(self, capacity, error=0.01):
+        self.bits = max(64, int(-capacity * math.log(error) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._a = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        h1 = key & 0xffffffff
+        h2 = (key >> 32) | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        a = self._a
+        for p in self._positions(key):
+            a[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        a = self._a
+        for p in self._positions(key):
+            if not a[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+
+class DedupIndex:
+    # capacity sizes the Bloom filter; it grows to twice the number of events already in the file when opened
+    def __init__(self, path, capacity=1000000):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS events (key INTEGER PRIMARY KEY)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS batches (sha256 TEXT PRIMARY KEY, batch_id TEXT, time INTEGER)')
+        self._db.commit()
+        n = self._db.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+        self._bloom = BloomFilter(max(capacity, 2 * n))
+        for (key,) in self._db.execute('SELECT key FROM events'):
+            self._bloom.add(key)
+        self._sent = set()                      # keys sent in this run and not yet recorded as accepted
+        self._batch_keys = {}                   # payload digest -> keys of the events in it, until it is accepted
+        self.skipped = 0                        # events dropped as duplicates
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM batches').fetchone()[0]
+
+    # True if an event key has been accepted before, or sent in this run
+    def seen(self, key):
+        if key not in self._bloom:
+            return False
+        if key in self._sent:
+            return True
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM events WHERE key=?', (key,)).fetchone() is not None
+
+    # Note an event key as sent in this run
+    def add(self, key):
+        self._bloom.add(key)
+        self._sent.add(key)
+
+    # Note which event keys make up a batch, to be recorded if it is accepted
+    def hold(self, payload, keys):
+        self._batch_keys[payload_digest(payload)] = keys
+
+    # Returns the batch ID this payload digest was accepted under, or None
+    def accepted(self, digest):
+        with self._lock:
+            r = self._db.execute('SELECT batch_id FROM batches WHERE sha256=?', (digest,)).fetchone()
+        return r[0] if r else None
+
+    # Record an accepted batch, and the events in it
+    def record(self, digest, batch_id):
+        keys = self._batch_keys.pop(digest, ())
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?)', (digest, batch_id, int(time.time())))
+                self._db.executemany('INSERT OR IGNORE INTO events VALUES (?)', ((k,) for k in keys))
+        self._sent.difference_update(keys)
+
+    def builder(self, builder=None):
+        return DedupBuilder(self, builder or batch.BatchBuilder())
+
+
+# A batch builder (e.g. batch.BatchBuilder) that drops events already in a DedupIndex, and tells the index which
+# events went into each batch
+class DedupBuilder:
+    def __init__(self, index, builder):
+        self.index = index
+        self.builder = builder
+        self._keys = []
+
+    def _hold(self, b):
+        if b:
+            self.index.hold(b, self._keys)
+            self._keys = []
+        return b
+
+    # Add one event line. Returns the previous Batch if this line would not fit in it, otherwise None. The key is only
+    # recorded once the builder has taken the line, so an event it refuses (e.g. too large) isn't taken as sent.
+    def add(self, line):
+        key = line_key(line)
+        if key is not None and self.index.seen(key):
+            self.index.skipped += 1
+            return None
+        b = self._hold(self.builder.add(line))
+        if key is not None:
+            self.index.add(key)
+            self._keys.append(key)
+        return b
+
+    def flush(self):
+        return self._hold(self.builder.flush())
+
+    def batches(self, lines):
+        for line in lines:
+            b = self.add(line)
+            if b:
+                yield b
+        b = self.flush()
+        if b:
+            yield b
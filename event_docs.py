@@ -1,25 +1,166 @@
 #!/usr/bin/env python3
 #
 from __future__ import print_function
-import requests, json
+import argparse, json, os, time
+
+DOCS_URL = 'https://api.sparkpost.com/api/v1/ingest/events/documentation'
+
+# Local copy of the documentation, refreshed with a conditional GET once it is older than DOCS_MAX_AGE seconds.
+# Bump DOCS_CACHE_VERSION when the cache file layout changes, so older files are ignored rather than misread.
+DOCS_CACHE = os.getenv('INGEST_DOCS_CACHE', default=os.path.join(os.path.expanduser('~'), '.cache', 'sparkyIngest', 'event_docs.json'))
+DOCS_CACHE_VERSION = 1
+DOCS_MAX_AGE = 24 * 60 * 60
+
+# Copy of the documentation shipped with this repo, used when it has never been fetched and can't be now. Its
+# "source" says where it came from. Refresh it from the API with "event_docs.py --write-snapshot".
+DOCS_SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'event_docs_snapshot.json')
+
+
+# Fetch the ingest event documentation: a list with one dict per event type, of attribute name -> details
+# (required, reporting, sampleValue, description)
+def fetch_docs(url=DOCS_URL, timeout=10):
+    import requests                             # imported when needed, so importing this module stays quick
+    docs = requests.get(url, timeout=timeout)
+    return results_of(docs.json())
+
+
+# The list of event types from a documentation response body. Raises ValueError if it has none.
+def results_of(body):
+    results = body.get('results') if isinstance(body, dict) else None
+    if not isinstance(results, list):
+        raise ValueError('documentation response has no "results" list')
+    return results
+
+
+# Index documentation results by event type: {type: {attribute: details}}. Dicts keep the documentation's order.
+# Entries that don't name their type are skipped.
+def index_docs(results):
+    return {event_type_of(ev): ev for ev in results if event_type_of(ev)}
+
+
+# The documentation snapshot shipped with this repo (see DOCS_SNAPSHOT)
+def snapshot_docs(path=DOCS_SNAPSHOT):
+    with open(path) as f:
+        return results_of(json.load(f))
+
+
+# Fetch the documentation and save it as the snapshot
+def write_snapshot(url=DOCS_URL, path=DOCS_SNAPSHOT):
+    results = fetch_docs(url)
+    source = 'Fetched from {} on {}'.format(url, time.strftime('%Y-%m-%d', time.gmtime()))
+    with open(path, 'w') as f:
+        json.dump({'source': source, 'results': results}, f, indent=2)
+        f.write('\n')
+    return results
+
+
+def _read_cache(path):
+    try:
+        with open(path, 'r') as f:
+            c = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(c, dict) or c.get('version') != DOCS_CACHE_VERSION:
+        return None
+    return c
+
+
+# Write via a temporary file and rename, so a reader never sees a half-written cache
+def _write_cache(path, c):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(c, f)
+    os.replace(tmp, path)
+
+
+# Returns the documentation indexed by event type (see index_docs), from the local cache when it is fresh enough.
+# A stale cache is revalidated with If-None-Match / If-Modified-Since, so an unchanged document isn't downloaded
+# again. If the API can't be reached, a stale cache is used as-is, and with no cache at all, snapshot_docs().
+# max_age=0 always revalidates; offline=True never touches the network.
+def load_docs(url=DOCS_URL, cache_path=DOCS_CACHE, max_age=DOCS_MAX_AGE, offline=False, timeout=10):
+    c = _read_cache(cache_path) if cache_path else None
+    if c and c.get('url') != url:
+        c = None
+    if c and (offline or time.time() - c['fetched'] < max_age):
+        return c['index']
+    if not offline:
+        hdrs = {}
+        if c and c.get('etag'):
+            hdrs['If-None-Match'] = c['etag']
+        if c and c.get('last_modified'):
+            hdrs['If-Modified-Since'] = c['last_modified']
+        import requests
+        try:
+            res = requests.get(url, headers=hdrs, timeout=timeout)
+            if res.status_code == 304 and c:
+                c['fetched'] = time.time()
+            elif res.status_code == 200:
+                index = index_docs(results_of(res.json()))
+                if not index:
+                    raise ValueError('documentation response describes no event types')
+                c = {
+                    'version': DOCS_CACHE_VERSION,
+                    'url': url,
+                    'etag': res.headers.get('ETag'),
+                    'last_modified': res.headers.get('Last-Modified'),
+                    'fetched': time.time(),
+                    'index': index,
+                }
+            else:
+                raise requests.RequestException('status {}'.format(res.status_code))
+            if cache_path:
+                _write_cache(cache_path, c)
+        except (requests.RequestException, ValueError, OSError):
+            pass
+    if c:
+        return c['index']
+    return index_docs(snapshot_docs())
+
+
+# The event type a documentation entry describes, e.g. "reception", or None if the entry doesn't say
+def event_type_of(ev):
+    t = ev.get('type') if isinstance(ev, dict) else None
+    return t.get('sampleValue') if isinstance(t, dict) else None
+
 
 # escape any embedded quotation marks
 def escape_quotation_marks(v):
     return v.replace('"', '\"') if isinstance(v, str) else v
 
 
-# surrounding placeholders with quotes, in case of values that could contain commas
-out = '"{}","{}","{}","{}","{}","{}"'
-docs = requests.get('https://api.sparkpost.com/api/v1/ingest/events/documentation')
-res = docs.json()
-print(out.format('type', 'attribute', 'required', 'reporting', 'sampleValue', 'description'))
-for ev in res.get('results'):
-    # Firstly, show the event type
-    ev_name = ev.get('type').get('sampleValue')
-    # Now iterate over the other field names
-    for attrName, v  in ev.items():
-        v_req = True if v.get('required') else False
-        v_rep = True if v.get('reporting') else False
-        v_sv = escape_quotation_marks(v.get('sampleValue')) # escape any quote marks inside values
-        v_desc = escape_quotation_marks(v.get('description'))
-        print(out.format(ev_name, attrName, v_req, v_rep, v_sv, v_desc))
\ No newline at end of file
+# Generator: CSV lines listing every attribute of every event type
+def docs_csv(results):
+    # surrounding placeholders with quotes, in case of values that could contain commas
+    out = '"{}","{}","{}","{}","{}","{}"'
+    yield out.format('type', 'attribute', 'required', 'reporting', 'sampleValue', 'description')
+    for ev in results:
+        # Firstly, show the event type
+        ev_name = event_type_of(ev)
+        # Now iterate over the other field names
+        for attrName, v in ev.items():
+            v_req = True if v.get('required') else False
+            v_rep = True if v.get('reporting') else False
+            v_sv = escape_quotation_marks(v.get('sampleValue')) # escape any quote marks inside values
+            v_desc = escape_quotation_marks(v.get('description'))
+            yield out.format(ev_name, attrName, v_req, v_rep, v_sv, v_desc)
+
+
+# -----------------------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the ingest event documentation as CSV')
+    parser.add_argument('--refresh', help='Check for a newer version even if the cached copy is recent', action='store_true')
+    parser.add_argument('--offline', help='Use the cached copy (or the snapshot) without going to the network', action='store_true')
+    parser.add_argument('--write-snapshot', help='Fetch the documentation and save it as the snapshot used offline', action='store_true')
+    args = parser.parse_args(argv)
+    if args.write_snapshot:
+        print('{} event types saved to {}'.format(len(write_snapshot()), DOCS_SNAPSHOT))
+        return
+    for line in docs_csv(load_docs(max_age=0 if args.refresh else DOCS_MAX_AGE, offline=args.offline).values()):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,139 @@
 # A library of functions for creating SparkPost ingest events
 #
 
-import json, uuid, hashlib, base64
+import json, hashlib, base64, os, sys, time, random, struct, array, threading, functools
+from json.encoder import encode_basestring_ascii
+import metrics
+
+
+def stripEnd(h, s):
+    if h.endswith(s):
+        h = h[:-len(s)]
+    return h
+
+
+# condense into a access+base_url form. https:// is assumed unless the host explicitly says http:// (e.g. a local
+# stand-in server)
+def hostCleanup(host):
+    if not host.startswith('https://') and not host.startswith('http://'):
+        host = 'https://' + host  # Add schema
+    host = stripEnd(host, '/')
+    host = stripEnd(host, '/api/v1')
+    host = stripEnd(host, '/')
+    return host
+
+
+# Ingest API endpoint for a host that has been through hostCleanup
+def ingest_url(host):
+    return host + '/api/v1/ingest/events'
+
+
+# Request headers for uploading gzip NDJSON batches
+def ingest_hdrs(apiKey):
+    return {
+        'Authorization': apiKey,
+        'Content-Type': 'application/x-ndjson',
+        'Content-Encoding': 'gzip'
+    }
+
+
+# Ingest API URL and request headers from the environment: SPARKPOST_HOST (default api.sparkpost.com) and
+# SPARKPOST_API_KEY. Stops with a message if the API key is not set.
+def ingest_from_env():
+    host = hostCleanup(os.getenv('SPARKPOST_HOST', default='api.sparkpost.com'))
+    apiKey = os.getenv('SPARKPOST_API_KEY')
+    if apiKey == None:
+        print('Environment variable SPARKPOST_API_KEY not set - stopping.')
+        exit(1)
+    return ingest_url(host), ingest_hdrs(apiKey)
+
+#
+# Fast generation of event_id and message_id values. Randomness is drawn from the OS (or a seeded PRNG, for
+# reproducible load tests) a block at a time rather than once per ID.
+#
+# Instances are safe to share between threads. After a fork, the generator behind uniq_event_id() and
+# uniq_message_id() starts on fresh randomness in the child, so worker processes don't repeat their parent's IDs
+# (other instances can call after_fork() themselves). In seeded mode, give each worker its own stream number to keep
+# them reproducible and distinct.
+class IdGenerator:
+    def __init__(self, seed=None, stream=0, block=4096):
+        self.seed = seed
+        self.stream = stream
+        self.block = block
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self, salt=''):
+        self._rng = random.Random('{}:{}{}'.format(self.seed, self.stream, salt)) if self.seed is not None else None
+        self._event_ids = iter(())
+        self._rand32 = iter(())
+        self._prefix = (None, None)                 # (time, message_id prefix for it), replaced as one
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._reset(':pid{}'.format(os.getpid()))
+
+    def _random_bytes(self, n):
+        if self._rng:
+            return self._rng.getrandbits(8 * n).to_bytes(n, 'little')
+        return os.urandom(n)
+
+    # SparkPost formatted event_id: a decimal string 0 .. (2^63-1)
+    def event_id(self):
+        try:
+            return next(self._event_ids)
+        except StopIteration:
+            with self._lock:
+                b = bytearray(self._random_bytes(8 * self.block))
+                top = 7 if sys.byteorder == 'little' else 0             # most significant byte of each native uint64
+                b[top::8] = b[top::8].translate(_CLEAR_TOP_BIT)
+                self._event_ids = iter(list(map(str, array.array('Q', b))))
+            return self.event_id()
+
+    # SparkPost formatted message_id, which has an embedded timestamp (default: now)
+    def message_id(self, t=None):
+        t = int(time.time() if t is None else t)
+        cached_t, prefix = self._prefix
+        if t != cached_t:
+            prefix = '0000' + struct.pack('<I', t & 0xffffffff).hex()             # little-endian byte order
+            self._prefix = t, prefix
+        try:
+            return prefix + next(self._rand32)
+        except StopIteration:
+            with self._lock:
+                h = self._random_bytes(4 * self.block).hex()
+                self._rand32 = iter([h[i:i + 8] for i in range(0, len(h), 8)])
+            return prefix + next(self._rand32)
+
+
+_CLEAR_TOP_BIT = bytes(i & 0x7f for i in range(256))
+
+_ids = IdGenerator()
+
+
+# Make uniq_event_id() and uniq_message_id() deterministic (seed=None restores OS randomness)
+def seed_ids(seed, stream=0):
+    global _ids
+    _ids = IdGenerator(seed, stream)
+
+
+# One hook for the process, acting on whichever generator is current, as seed_ids() replaces it
+def _ids_after_fork():
+    _ids.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_ids_after_fork)
+
 
 # Returns SparkPost formatted unique event_id, which needs to be a decimal string 0 .. (2^63-1).
-# Python ints are arbitrary precision so we don't need to worry about arithmetic overflow
 def uniq_event_id():
-    u = uuid.uuid4().int  & 0x7fffffffffffffff # uuid4 gives us 128-bit random number, need to cut down to size
-    return str(u)
+    return _ids.event_id()
+
+
+# Returns a SparkPost formatted unique messageID, which has an embedded timestamp
+def uniq_message_id(t=None):
+    return _ids.message_id(t)
 
 
 #
@@ -21,471 +147,609 @@ def sha1_hash(s):
     return b64hash_str
 
 
+#
+# Returns (rcpt_hash, rcpt_domain) for a recipient, as set on events when privacy is on
+def _rcpt_privacy(rcpt_to):
+    return sha1_hash(rcpt_to), rcpt_to.split('@')[1]
+
+
+# The same recipient appears in several events per message (and across campaigns), so results are kept in an LRU cache
+PRIVACY_CACHE_SIZE = 65536
+rcpt_privacy = functools.lru_cache(maxsize=PRIVACY_CACHE_SIZE)(_rcpt_privacy)
+
+
+# Replace the recipient privacy cache with an empty one of a different size (None = unbounded, 0 = no caching)
+def set_privacy_cache_size(maxsize):
+    global rcpt_privacy
+    rcpt_privacy = functools.lru_cache(maxsize=maxsize)(_rcpt_privacy)
+
+
+# Returns the cache's (hits, misses, maxsize, currsize)
+def privacy_cache_info():
+    return rcpt_privacy.cache_info()
+
+
+# Read from the cache statistics when collected, so hashing pays nothing for them
+metrics.gauge('sparky_privacy_hashes', 'Recipient hashes computed (privacy cache misses)').set_function(lambda: privacy_cache_info().misses)
+metrics.gauge('sparky_privacy_cache_hits', 'Recipient hashes served from the privacy cache').set_function(lambda: privacy_cache_info().hits)
+
+
+# Precompute privacy fields for a whole recipient list. Returns a dict of recipient -> (rcpt_hash, rcpt_domain), and
+# leaves the most recent recipients in the cache.
+def hash_recipients(recipients):
+    return {r: rcpt_privacy(r) for r in recipients}
+
+
 # Function has side-effect on dict e
 def apply_privacy(e, privacy):
     if privacy:
+        rcpt_hash, rcpt_domain = rcpt_privacy(e['rcpt_to'])
         # Include hash field, otherwise causes ingest error "Missing rcpt_domain on event with rcpt_hash"
-        e['rcpt_hash'] = sha1_hash(e['rcpt_to'])
+        e['rcpt_hash'] = rcpt_hash
         # but only when privacy is true - otherwise ingest error "Missing rcpt_hash on event with rcpt_domain"
-        e['rcpt_domain'] = e['rcpt_to'].split('@')[1]
+        e['rcpt_domain'] = rcpt_domain
         del e['rcpt_to']
 
 
+#
+# -----------------------------------------------------------------------------------------
+#  Event types
+#
+#  Each event type is one table entry: its envelope key (event class), ingest type, and fields in output order. A
+#  field's value is a constant, one of the per-event values below, or arg(name) for an argument given to
+#  make_event() or compile_event(). Privacy replaces rcpt_to with rcpt_hash and rcpt_domain at the end, as
+#  apply_privacy() does.
+#
+#  Events are rendered from a compiled template: a format string in which everything that is the same for every
+#  event is already encoded, and only the per-event values (event_id, message_id, recipient, timestamp) are spliced
+#  in. compile_event() binds the arguments into the template once, for the sequences; make_event() uses one
+#  template per privacy setting with the arguments as further slots, encoded on each call.
+#
+#  The records here (EventType, CompiledEvent, arg and the slots) use __slots__. There is no record per event: an
+#  event goes straight from its per-event values to its NDJSON line, so generating one allocates only that line and
+#  the small dict of values spliced into it.
+# -----------------------------------------------------------------------------------------
+#
+_REQUIRED = object()
+
+
+# A per-event value: the key of its slot in compiled templates, which holds the value escaped for a JSON string
+class _Slot:
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+
+TIMESTAMP = _Slot('t')
+EVENT_ID = _Slot('e')
+MESSAGE_ID = _Slot('m')
+RCPT = _Slot('r')
+ROUTING_DOMAIN = _Slot('d')                         # the recipient's domain, as is rcpt_domain
+_RCPT_HASH = _Slot('h')
+
+
+# A field taken from an argument to make_event(), with an optional default
+class arg:
+    __slots__ = ('name', 'default')
+
+    def __init__(self, name, default=_REQUIRED):
+        self.name = name
+        self.default = default
+
+    @property
+    def required(self):
+        return self.default is _REQUIRED
+
+    def value(self, type, args):
+        v = args.get(self.name, self.default)
+        if v is _REQUIRED:
+            raise TypeError('{} event needs argument {}'.format(type, self.name))
+        return v
+
+
+# An argument value quoting the recipient's address, e.g. rcpt_text('SMTP;550 5.0.0 <{rcpt_to}>... User unknown')
+class rcpt_text:
+    __slots__ = ('parts',)
+
+    def __init__(self, text):
+        self.parts = text.split('{rcpt_to}')
+
+    def format(self, rcpt_to):
+        return rcpt_to.join(self.parts)
+
+
+def _escaped(s):
+    return encode_basestring_ascii(s)[1:-1]         # as json.dumps would write it, without the quotes
+
+
+def _encode(v):
+    return encode_basestring_ascii(v) if type(v) is str else json.dumps(v)
+
+
+class CompiledEvent:
+    __slots__ = ('fmt', 'event_class', 'type', 'args', '_domain', '_rcpt', '_hash', '_msg_id')
+
+    def __init__(self, fmt, event_class, type, args=()):
+        self.fmt = fmt
+        self.event_class = event_class              # e.g. 'message_event'
+        self.type = type                            # ingest event type, e.g. 'reception'
+        self.args = args                            # arg fields left as slots, filled from each call's args
+        self._domain = '%(d)s' in fmt
+        self._rcpt = '%(r)s' in fmt
+        self._hash = '%(h)s' in fmt
+        self._msg_id = '%(m)s' in fmt
+
+    # NDJSON line for one event. privacy can give (rcpt_hash, rcpt_domain) for rcpt_to already worked out, e.g. from
+    # a recipient pool. args are needed only for templates compiled without them (see make_event). event_id defaults
+    # to a new unique one.
+    def __call__(self, ts, rcpt_to, uniq_msg_id, privacy=None, args=None, event_id=None):
+        v = {'t': str(ts.time()), 'e': event_id or uniq_event_id()}
+        if self._msg_id:
+            v['m'] = _escaped(uniq_msg_id)
+        if self._rcpt:
+            v['r'] = _escaped(rcpt_to)
+        if self._hash:
+            rcpt_hash, rcpt_domain = privacy or rcpt_privacy(rcpt_to)
+            v['h'] = rcpt_hash
+            if self._domain:
+                v['d'] = _escaped(rcpt_domain)
+        elif self._domain:
+            v['d'] = _escaped(rcpt_to.split('@')[1])
+        for a in self.args:
+            x = a.value(self.type, args)
+            v[a.name] = _encode(x.format(rcpt_to) if type(x) is rcpt_text else x)
+        return self.fmt % v
+
+
+class EventType:
+    __slots__ = ('event_class', 'type', 'fields', '_templates')
+
+    def __init__(self, event_class, type, fields):
+        self.event_class = event_class
+        self.type = type
+        self.fields = tuple(fields)
+        self._templates = (self.compile(False, None), self.compile(True, None))
+
+    # Template for this type. args binds every arg field into the template (missing ones take their defaults);
+    # with args=None they are left as slots of their own name, filled on each call.
+    def compile(self, privacy, args):
+        fields = [('type', self.type)] + list(self.fields)
+        if privacy and any(k == 'rcpt_to' for k, v in fields):
+            fields = [(k, v) for k, v in fields if k != 'rcpt_to'] + [('rcpt_hash', _RCPT_HASH), ('rcpt_domain', ROUTING_DOMAIN)]
+        parts, unbound = [], []
+        for k, v in fields:
+            key = _encode(k).replace('%', '%%') + ': '
+            if type(v) is arg:
+                if args is None:
+                    parts.append(key + '%(' + v.name + ')s')
+                    unbound.append(v)
+                    continue
+                v = v.value(self.type, args)
+            if type(v) is _Slot:
+                parts.append(key + '"%(' + v.key + ')s"')
+            elif type(v) is rcpt_text:
+                parts.append(key + '"' + '%(r)s'.join(_escaped(p).replace('%', '%%') for p in v.parts) + '"')
+            else:
+                parts.append(key + _encode(v).replace('%', '%%'))
+        fmt = '{"msys": {' + _encode(self.event_class).replace('%', '%%') + ': {' + ', '.join(parts) + '}}}\n'
+        return CompiledEvent(fmt, self.event_class, self.type, tuple(unbound))
+
+    # Template with the arguments left as slots, for events made one at a time
+    def template(self, privacy):
+        return self._templates[1 if privacy else 0]
+
+
+# Fields shared by several types
+OPEN_FIELDS = (
+    ('delv_method', 'smtp'),                        # marked as 'required' in /documentation output
+    ('event_id', EVENT_ID),
+    ('geo_ip', arg('geo_ip')),
+    ('message_id', MESSAGE_ID),
+    ('rcpt_to', RCPT),
+    ('subaccount_id', 0),
+    ('timestamp', TIMESTAMP),
+    ('user_agent', arg('user_agent')),
+)
+CLICK_FIELDS = OPEN_FIELDS[:-1] + (('target_link_url', 'https://example.com'),) + OPEN_FIELDS[-1:]
+
+DEFAULT_AB_TEST = {
+    'id': 'ab_test_1',
+    'name': 'subject line test',
+    'version': 1,
+    'test_mode': 'bayesian',
+    'engagement_metric': 'count_unique_clicked',
+    'default_template': {'template_id': 'template_123456', 'count_unique_clicked': 25, 'count_accepted': 100},
+    'variants': [{'template_id': 'template_654321', 'count_unique_clicked': 30, 'count_accepted': 100}],
+}
+
+# Ingest event type -> EventType. Types with a make_*_event builder below note their SparkPost event type there.
+EVENT_TYPES = {e.type: e for e in (
+    EventType('message_event', 'reception', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('campaign_id', arg('campaign_id')),
+        # custom_message_id?? PowerMTA includes this, different to message_id
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('friendly_name', ''),
+        ('message_id', MESSAGE_ID),
+        ('msg_from', arg('msg_from')),
+        ('msg_size', '315'),
+        ('open_tracking', True),                    # it's important that open_tracking is enabled if you want Signals Health Score to work
+        ('rcpt_to', RCPT),
+        ('recv_method', arg('recv_method', 'smtp')),
+        ('routing_domain', ROUTING_DOMAIN),
+        ('sending_ip', arg('sending_ip')),
+        # ('rcpt_meta', {'pets' : 'dog'}), # You can include this, PowerMTA does not
+        ('subaccount_id', 0),
+        ('subject', arg('subject')),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('message_event', 'delivery', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('campaign_id', arg('campaign_id')),
+        ('delv_method', 'smtp'),                    # marked as 'required' in /documentation output
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('friendly_name', ''),
+        ('message_id', MESSAGE_ID),
+        ('msg_from', arg('msg_from')),
+        ('msg_size', '315'),
+        ('num_retries', '0'),
+        ('open_tracking', True),
+        ('rcpt_to', RCPT),
+        ('recv_method', 'smtp'),
+        ('routing_domain', ROUTING_DOMAIN),
+        ('sending_ip', arg('sending_ip')),
+        ('subaccount_id', 0),
+        ('subject', arg('subject')),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('track_event', 'initial_open', OPEN_FIELDS),
+    EventType('track_event', 'open', OPEN_FIELDS),
+    EventType('track_event', 'click', CLICK_FIELDS),
+    EventType('track_event', 'amp_initial_open', OPEN_FIELDS),
+    EventType('track_event', 'amp_open', OPEN_FIELDS),
+    EventType('track_event', 'amp_click', CLICK_FIELDS),
+    EventType('message_event', 'inband', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('bounce_class', arg('bounce_class')),
+        ('campaign_id', arg('campaign_id')),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('friendly_name', ''),
+        ('message_id', MESSAGE_ID),
+        ('msg_from', arg('msg_from')),
+        ('msg_size', ''),
+        ('num_retries', '0'),
+        ('open_tracking', True),
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('recv_method', 'smtp'),
+        ('routing_domain', ROUTING_DOMAIN),
+        ('sending_ip', arg('sending_ip')),
+        ('subject', arg('subject')),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('message_event', 'outofband', (
+        ('bounce_class', arg('bounce_class')),
+        ('delv_method', 'smtp'),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('message_id', MESSAGE_ID),
+        ('msg_from', arg('msg_from')),
+        ('raw_reason', arg('raw_reason')),
+        ('recv_method', 'smtp'),                    # PowerMTA does not set this, but /documentation says it's required
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('message_event', 'feedback', (
+        ('delv_method', 'smtp'),
+        ('event_id', EVENT_ID),
+        ('fbtype', 'abuse'),                        # required
+        ('friendly_from', arg('friendly_from')),
+        ('message_id', MESSAGE_ID),
+        # ('msg_from', arg('msg_from')),            # PowerMTA does not include this attribute - should it be?
+        ('rcpt_to', RCPT),
+        ('report_by', ''),                          # Should this be populated?
+        ('sending_ip', arg('sending_ip')),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('message_event', 'tempfail', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('bounce_class', arg('bounce_class')),
+        ('campaign_id', arg('campaign_id')),
+        ('delv_method', 'smtp'),                    # PowerMTA does not set this, but /documentation says it's required
+        ('error_code', arg('bounce_code')),         # 452
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('friendly_name', ''),
+        ('message_id', MESSAGE_ID),
+        ('msg_from', arg('msg_from')),
+        ('msg_size', ''),
+        ('num_retries', '0'),
+        ('open_tracking', True),
+        ('queue_time', '0'),                        # try varying this?
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('recv_method', 'smtp'),
+        # ('routing_domain', ROUTING_DOMAIN), appears not to be sent by PMTA
+        ('sending_ip', arg('sending_ip')),
+        ('subaccount_id', 0),
+        ('subject', arg('subject')),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('message_event', 'rejection', (
+        ('bounce_class', arg('bounce_class')),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('message_id', MESSAGE_ID),
+        ('msg_from', arg('msg_from')),
+        ('raw_rcpt_to', RCPT),
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('recv_method', 'smtp'),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('gen_event', 'gen_rejection', (
+        ('bounce_class', arg('bounce_class')),
+        ('campaign_id', arg('campaign_id')),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('msg_from', arg('msg_from')),
+        ('raw_rcpt_to', RCPT),
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('recv_method', 'rest'),
+        ('subject', arg('subject')),
+        ('template_id', 'template_123456'),
+        ('template_version', '0'),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('gen_event', 'gen_fail', (
+        ('campaign_id', arg('campaign_id')),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        # ('message_id', MESSAGE_ID), this type of error happens without getting a message_id
+        ('msg_from', arg('msg_from')),
+        ('raw_rcpt_to', RCPT),
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('recv_method', 'rest'),
+        ('template_id', 'template_123456'),
+        ('template_version', '0'),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('unsubscribe_event', 'link', (
+        ('delv_method', 'smtp'),                    # marked as 'required' in /documentation output
+        ('event_id', EVENT_ID),
+        ('message_id', MESSAGE_ID),
+        ('recv_method', 'smtp'),                    # marked as 'required' in /documentation output
+        ('rcpt_to', RCPT),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+        ('user_agent', arg('user_agent')),
+    )),
+    EventType('unsubscribe_event', 'list', (
+        ('delv_method', 'smtp'),
+        ('event_id', EVENT_ID),
+        ('message_id', MESSAGE_ID),
+        ('recv_method', 'smtp'),
+        ('rcpt_to', RCPT),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+        # ('user_agent', arg('user_agent')),
+    )),
+    # Relay events: mail received for an inbound (relay webhook) domain and passed on
+    EventType('relay_event', 'relay_injection', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('customer_id', '1'),
+        ('event_id', EVENT_ID),
+        ('friendly_from', arg('friendly_from')),
+        ('ip_address', arg('sending_ip')),
+        ('msg_from', arg('msg_from')),
+        ('msg_size', '315'),
+        ('origination', 'smtp'),
+        ('rcpt_to', RCPT),
+        ('relay_id', arg('relay_id', 'relay_webhook_1')),
+        ('routing_domain', ROUTING_DOMAIN),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('relay_event', 'relay_rejection', (
+        ('bounce_class', arg('bounce_class')),
+        ('customer_id', '1'),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('msg_from', arg('msg_from')),
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('relay_id', arg('relay_id', 'relay_webhook_1')),
+        ('remote_addr', arg('sending_ip')),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('relay_event', 'relay_delivery', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('customer_id', '1'),
+        ('delv_method', 'esmtp'),
+        ('event_id', EVENT_ID),
+        ('msg_from', arg('msg_from')),
+        ('num_retries', '0'),
+        ('queue_time', '0'),
+        ('rcpt_to', RCPT),
+        ('relay_id', arg('relay_id', 'relay_webhook_1')),
+        ('routing_domain', ROUTING_DOMAIN),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('relay_event', 'relay_tempfail', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('bounce_class', arg('bounce_class')),
+        ('customer_id', '1'),
+        ('delv_method', 'esmtp'),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('msg_from', arg('msg_from')),
+        ('num_retries', '0'),
+        ('queue_time', '0'),
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('relay_id', arg('relay_id', 'relay_webhook_1')),
+        ('routing_domain', ROUTING_DOMAIN),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('relay_event', 'relay_permfail', (
+        ('binding', arg('binding', 'mta1')),
+        ('binding_group', arg('binding_group', 'hot chili')),
+        ('bounce_class', arg('bounce_class')),
+        ('customer_id', '1'),
+        ('delv_method', 'esmtp'),
+        ('error_code', arg('bounce_code')),
+        ('event_id', EVENT_ID),
+        ('msg_from', arg('msg_from')),
+        ('num_retries', '0'),
+        ('queue_time', '0'),
+        ('raw_reason', arg('bounce_reason')),
+        ('rcpt_to', RCPT),
+        ('reason', arg('bounce_reason')),
+        ('relay_id', arg('relay_id', 'relay_webhook_1')),
+        ('routing_domain', ROUTING_DOMAIN),
+        ('timestamp', TIMESTAMP),
+    )),
+    # A/B test events are about a test as a whole, so have no recipient
+    EventType('ab_test_event', 'ab_test_completed', (
+        ('ab_test', arg('ab_test', DEFAULT_AB_TEST)),
+        ('customer_id', '1'),
+        ('event_id', EVENT_ID),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+    EventType('ab_test_event', 'ab_test_cancelled', (
+        ('ab_test', arg('ab_test', DEFAULT_AB_TEST)),
+        ('customer_id', '1'),
+        ('event_id', EVENT_ID),
+        ('subaccount_id', 0),
+        ('timestamp', TIMESTAMP),
+    )),
+)}
+
+
+# Returns an NDJSON line for an event of the given ingest type. Other arguments are as for the builders below;
+# those the type doesn't use are ignored. event_id defaults to a new unique one.
+def make_event(type, ts, rcpt_to=None, privacy=False, uniq_msg_id=None, event_id=None, **args):
+    return EVENT_TYPES[type].template(privacy)(ts, rcpt_to, uniq_msg_id, args=args, event_id=event_id)
+
+
+# Returns a CompiledEvent for an ingest event type with the given arguments bound, to call with
+# (ts, rcpt_to, uniq_msg_id) for each event. Arguments quoting the recipient can be given as rcpt_text().
+def compile_event(type, privacy, **args):
+    return EVENT_TYPES[type].compile(privacy, args)
+
+
 # Note the ingest event type is "reception", the SparkPost event type is "injection"
-def make_injection_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, recv_method='smtp'):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'message_event': {
-                'type': 'reception',
-                'binding': 'mta1',
-                'binding_group': 'hot chili',
-                'campaign_id': campaign_id,
-                # custom_message_id?? PowerMTA includes this, different to message_id
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                'friendly_name': '',
-                'message_id': uniq_msg_id,
-                'msg_from': msg_from,
-                'msg_size': '315',
-                'open_tracking': True,                       # it's important that open_tracking is enabled if you want Signals Health Score to work
-                'rcpt_to': rcpt_to,
-                'recv_method': recv_method,
-                'routing_domain': rcpt_to.split('@')[1],
-                'sending_ip': sending_ip,
-                # 'rcpt_meta': {'pets' : 'dog'}, # You can include this, PowerMTA does not
-                'subaccount_id': 0,
-                'subject': subject,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['message_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+def make_injection_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, recv_method='smtp', binding='mta1', binding_group='hot chili'):
+    return make_event('reception', **locals())
 
 
 # Note the ingest event type is "delivery", the SparkPost event type is "delivery"
-def make_delivery_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'message_event': {
-                'type': 'delivery',
-                'binding': 'mta1',
-                'binding_group': 'hot chili',
-                'campaign_id': campaign_id,
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                'friendly_name': '',
-                'message_id': uniq_msg_id,
-                'msg_from': msg_from,
-                'msg_size': '315',
-                'num_retries': '0',
-                'open_tracking': True,                       # it's important that open_tracking is enabled if you want Signals Health Score to work
-                'rcpt_to': rcpt_to,
-                'recv_method': 'smtp',
-                'routing_domain': rcpt_to.split('@')[1],
-                'sending_ip': sending_ip,
-                'subaccount_id': 0,
-                'subject': subject,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['message_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+def make_delivery_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, binding='mta1', binding_group='hot chili'):
+    return make_event('delivery', **locals())
 
 
 # Note the ingest event type is "initial_open", the SparkPost event type is "initial_open"
 def make_initial_open_event(ts, rcpt_to, privacy, uniq_msg_id, geo_ip, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'track_event': {
-                'type': 'initial_open',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'geo_ip': geo_ip,
-                'message_id': uniq_msg_id,
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['track_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('initial_open', **locals())
 
 
 # Note the ingest event type is "open", the SparkPost event type is "open"
 def make_open_event(ts, rcpt_to, privacy, uniq_msg_id, geo_ip, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'track_event': {
-                'type': 'open',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'geo_ip': geo_ip,
-                'message_id': uniq_msg_id,
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['track_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('open', **locals())
 
 
 # Note the ingest event type is "click", the SparkPost event type is "click"
 def make_click_event(ts, rcpt_to, privacy, uniq_msg_id, geo_ip, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'track_event': {
-                'type': 'click',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'geo_ip': geo_ip,
-                'message_id': uniq_msg_id,
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                'target_link_url': 'https://example.com',
-                'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['track_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('click', **locals())
 
 
 # Note the ingest event type is "amp_initial_open", the SparkPost event type is "amp_initial_open"
 def make_amp_initial_open_event(ts, rcpt_to, privacy, uniq_msg_id, geo_ip, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'track_event': {
-                'type': 'amp_initial_open',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'geo_ip': geo_ip,
-                'message_id': uniq_msg_id,
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['track_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('amp_initial_open', **locals())
 
 
 # Note the ingest event type is "amp_open", the SparkPost event type is "amp_open"
 def make_amp_open_event(ts, rcpt_to, privacy, uniq_msg_id, geo_ip, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'track_event': {
-                'type': 'amp_open',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'geo_ip': geo_ip,
-                'message_id': uniq_msg_id,
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['track_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('amp_open', **locals())
 
 
 # Note the ingest event type is "amp_click", the SparkPost event type is "amp_click"
 def make_amp_click_event(ts, rcpt_to, privacy, uniq_msg_id, geo_ip, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'track_event': {
-                'type': 'amp_click',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'geo_ip': geo_ip,
-                'message_id': uniq_msg_id,
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                'target_link_url': 'https://example.com',
-                'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['track_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('amp_click', **locals())
 
 
 # Note the ingest event type is "inband", the SparkPost event type is "bounce"
-def make_bounce_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'message_event': {
-                'type': 'inband',
-                'binding': 'mta1',
-                'binding_group': 'hot chili',
-                'bounce_class': bounce_class,
-                'campaign_id': campaign_id,
-                # custom_message_id?? PowerMTA includes this, different to message_id
-                'error_code': bounce_code,
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                'friendly_name': '',
-                'message_id': uniq_msg_id,
-                'msg_from': msg_from,
-                'msg_size': '',
-                'num_retries': '0',
-                'open_tracking': True,                       # it's important that open_tracking is enabled if you want Signals Health Score to work
-                'raw_reason': bounce_reason,
-                'rcpt_to': rcpt_to,
-                'reason': bounce_reason,
-                'recv_method': 'smtp',
-                'routing_domain': rcpt_to.split('@')[1],
-                'sending_ip': sending_ip,
-                'subject': subject,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['message_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+def make_bounce_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason, binding='mta1', binding_group='hot chili'):
+    return make_event('inband', **locals())
+
 
 # Note the ingest event type is "outofband", the SparkPost events type is "out_of_band"
 def make_out_of_band_bounce_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'message_event': {
-                'type': 'outofband',
-                'bounce_class': bounce_class,
-                # custom_message_id?? PowerMTA includes this, different to message_id
-                'delv_method': 'smtp',
-                'error_code': bounce_code,
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                # 'friendly_name': '',
-                'message_id': uniq_msg_id,
-                'msg_from': msg_from,
-                'raw_reason': raw_reason,
-                'recv_method': 'smtp',                      # PowerMTA does not set this, but /documentation says it's required
-                'rcpt_to': rcpt_to,
-                'reason': bounce_reason,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['message_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('outofband', **locals())
 
 
 # Note the ingest event type is "feedback", the SparkPost event type is "spam_complaint"
 def make_spam_complaint_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'message_event': {
-                'type': 'feedback',
-                # custom_message_id?? PowerMTA includes this, different to message_id
-                'delv_method': 'smtp',
-                'event_id': uniq_event_id(),
-                'fbtype': 'abuse', # required
-                'friendly_from': friendly_from,
-                'message_id': uniq_msg_id,
-                # 'msg_from': msg_from,                       # PowerMTA does not include this attribute - should it be?
-                'rcpt_to': rcpt_to,
-                'report_by': '',                              # Should this be populated?
-                'sending_ip': sending_ip,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['message_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('feedback', **locals())
 
 
 # Note the ingest event type is "tempfail", the SparkPost event type is "delay"
-def make_delay_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'message_event': {
-                'type': 'tempfail',
-                'binding': 'mta1',
-                'binding_group': 'hot chili',
-                'bounce_class': bounce_class,
-                'campaign_id': campaign_id,
-                'delv_method': 'smtp',                      # PowerMTA does not set this, but /documentation says it's required
-                # custom_message_id?? PowerMTA includes this, different to message_id
-                'error_code': bounce_code, # 452
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                'friendly_name': '',
-                'message_id': uniq_msg_id,
-                'msg_from': msg_from,
-                'msg_size': '',
-                'num_retries': '0',
-                'open_tracking': True,                       # it's important that open_tracking is enabled if you want Signals Health Score to work
-                'queue_time': "0",                           # try varying this?
-                'raw_reason': bounce_reason,
-                'rcpt_to': rcpt_to,
-                'reason': bounce_reason,
-                'recv_method': 'smtp',
-                # 'routing_domain': rcpt_to.split('@')[1], appears not to be sent by PMTA
-                'sending_ip': sending_ip,
-                'subaccount_id': 0,
-                'subject': subject,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['message_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+def make_delay_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason, binding='mta1', binding_group='hot chili'):
+    return make_event('tempfail', **locals())
 
 
 # Note the ingest event type is "rejection", the SparkPost event type is "policy_rejection"
 def make_policy_rejection_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'message_event': {
-                'type': 'rejection',
-                'bounce_class': bounce_class,
-                'error_code': bounce_code,
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                'message_id': uniq_msg_id,
-                'msg_from': msg_from,
-                'raw_rcpt_to': rcpt_to,
-                'raw_reason': bounce_reason,
-                'rcpt_to': rcpt_to,
-                'reason': bounce_reason,
-                'recv_method': 'smtp',
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['message_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('rejection', **locals())
 
 
 # Note the ingest event type is "gen_rejection", the SparkPost event type is "generation_rejection"
 def make_generation_rejection_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'gen_event': {
-                'type': 'gen_rejection',
-                'bounce_class': bounce_class,
-                'campaign_id': campaign_id,
-                'error_code': bounce_code,
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                'msg_from': msg_from,
-                'raw_rcpt_to': rcpt_to,
-                'raw_reason': bounce_reason,
-                'rcpt_to': rcpt_to,
-                'reason': bounce_reason,
-                'recv_method': 'rest',
-                'subject': subject,
-                'template_id': 'template_123456',
-                'template_version': '0',
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['gen_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('gen_rejection', **locals())
 
 
 # Note the ingest event type is "gen_fail", the SparkPost event type is "generation_failure"
 def make_generation_failure_event(ts, msg_from, friendly_from, rcpt_to, privacy, uniq_msg_id, campaign_id, subject, sending_ip, bounce_code, bounce_reason, bounce_class, raw_reason):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'gen_event': {
-                'type': 'gen_fail',
-                'campaign_id': campaign_id,
-                'error_code': bounce_code,
-                'event_id': uniq_event_id(),
-                'friendly_from': friendly_from,
-                # 'message_id': uniq_msg_id, this type of error happens without getting a message_id
-                'msg_from': msg_from,
-                'raw_rcpt_to': rcpt_to,
-                'raw_reason': bounce_reason,
-                'rcpt_to': rcpt_to,
-                'reason': bounce_reason,
-                'recv_method': 'rest',
-                'template_id': 'template_123456',
-                'template_version': '0',
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-            }
-        }
-    }
-    apply_privacy(e['msys']['gen_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('gen_fail', **locals())
 
 
 # Note the ingest event type is "link", the SparkPost event type is "link_unsubscribe"
 def make_link_unsubscribe_event(ts, rcpt_to, privacy, uniq_msg_id, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'unsubscribe_event': {
-                'type': 'link',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'message_id': uniq_msg_id,
-                'recv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['unsubscribe_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('link', **locals())
 
 
 # Note the ingest event type is "list", the SparkPost event type is "list_unsubscribe"
 def make_list_unsubscribe_event(ts, rcpt_to, privacy, uniq_msg_id, user_agent):
-    timestamp = ts.time()
-    e = {
-        'msys': {
-            'unsubscribe_event': {
-                'type': 'list',
-                'delv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'event_id': uniq_event_id(),
-                'message_id': uniq_msg_id,
-                'recv_method': 'smtp',                     # marked as 'required' in /documentation output
-                'rcpt_to': rcpt_to,
-                'subaccount_id': 0,
-                'timestamp': str(timestamp),
-                # 'user_agent': user_agent,
-            }
-        }
-    }
-    apply_privacy(e['msys']['unsubscribe_event'], privacy)
-    return json.dumps(e, indent=None, separators=None) + '\n'
+    return make_event('list', **locals())
@@ -0,0 +1,56 @@
+#
+# On-disk journal of batches accepted by the ingest API, keyed by a hash of the payload contents.
+#
+# Every accepted batch is appended (and fsync'd) as one JSON line, so a crashed or restarted run can skip batches that
+# were already accepted instead of resending them and getting a "duplicate batch" failure.
+#
+
+import json, hashlib, os, threading, time
+
+
+# Content key for a payload (bytes, or a batch.Batch)
+def payload_digest(payload):
+    return hashlib.sha256(getattr(payload, 'payload', payload)).hexdigest()
+
+
+class UploadJournal:
+    def __init__(self, path):
+        self.path = path
+        self._accepted = {}
+        self._lock = threading.Lock()
+        torn = False
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    torn = not line.endswith(b'\n')
+                    try:
+                        r = json.loads(line)
+                        self._accepted[r['sha256']] = r['batch_id']
+                    except (ValueError, KeyError, TypeError):
+                        pass            # a line torn by a crash part-way through a write
+        self._f = open(path, 'a', encoding='utf-8')
+        if torn:
+            self._f.write('\n')        # don't append to the end of a torn line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+    def __len__(self):
+        return len(self._accepted)
+
+    # Returns the batch ID this payload digest was accepted under, or None
+    def accepted(self, digest):
+        return self._accepted.get(digest)
+
+    def record(self, digest, batch_id):
+        with self._lock:
+            self._f.write(json.dumps({'sha256': digest, 'batch_id': batch_id, 'time': int(time.time())}) + '\n')
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._accepted[digest] = batch_id
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#
+# Sustained load: send a sequence at a target rate of events/sec or batches/sec for a set time, to find the ingest
+# throughput ceiling for an account.
+#
+# A token bucket paces batches into the uploader, with an optional linear ramp-up to the target rate. Event
+# timestamps follow realistic gaps between the events of each message (e.g. delivery a few seconds after
+# injection, opens minutes to hours after delivery), drawn from DELAYS, and are placed so each message's last event
+# is at the time it is generated. The achieved rate is reported against the target as the run goes.
+#
+# e.g. against the local stand-in server:
+#   ./mock_ingest.py -p 8080 --latency 0.05 &
+#   SPARKPOST_HOST=http://localhost:8080 SPARKPOST_API_KEY=anything ./load.py -r 20000 -d 60 --ramp 10
+#
+
+from __future__ import print_function
+import argparse, collections, math, random, time
+import ingest, sequences, batch, uploader, metrics
+
+# Delay before each event type, after the previous event of the same message, as (median seconds, sigma) of a
+# log-normal distribution. sigma 0 gives a fixed delay. Types not listed follow the previous event immediately.
+DELAYS = {
+    'delivery': (2, 1.0),
+    'inband': (2, 1.0),
+    'tempfail': (300, 0.5),
+    'outofband': (600, 1.0),
+    'initial_open': (1800, 1.5),
+    'amp_initial_open': (1800, 1.5),
+    'open': (600, 1.5),
+    'amp_open': (600, 1.5),
+    'click': (30, 1.0),
+    'amp_click': (30, 1.0),
+    'feedback': (3600, 1.0),
+    'link': (3600, 1.0),
+    'list': (3600, 1.0),
+}
+
+
+class TokenBucket:
+    # rate is in tokens/sec, or a function giving the rate at t seconds since the bucket was made (e.g. for a ramp).
+    # Up to burst tokens (default: one second's worth) build up while idle. The bucket starts empty, so there is no
+    # burst at the start of a run.
+    def __init__(self, rate, burst=None):
+        self.rate_at = rate if callable(rate) else lambda t: rate
+        self.burst = burst
+        self.tokens = 0.0
+        self.start = self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.rate_at(now - self.start)
+        burst = self.burst if self.burst is not None else rate
+        self.tokens = min(burst, self.tokens + (now - self.last) * rate)
+        self.last = now
+        return rate
+
+    # Take n tokens, waiting until they are available. n may exceed burst (e.g. one large batch); the bucket then
+    # goes into debt, and later callers wait for it to be repaid, so the long-run rate still holds. The wait is made
+    # in short steps, so a changing rate takes effect promptly.
+    def take(self, n=1):
+        self._refill()
+        self.tokens -= n
+        while self.tokens < 0:
+            time.sleep(min(-self.tokens / max(self.rate_at(self.last - self.start), 1e-9), 0.1))
+            self._refill()
+
+
+def sample_delay(rng, event_type, delays=DELAYS):
+    d = delays.get(event_type)
+    if not d:
+        return 0
+    median, sigma = d
+    return median if sigma == 0 else rng.lognormvariate(math.log(median), sigma)
+
+
+# Generator: NDJSON events for endless plays of a spec, timed by DELAYS. Each message's last event is at the time
+# it is generated, with earlier events spaced back from it. recipients is as for sequences.iter_events().
+def iter_timed_events(spec, privacy=False, delays=DELAYS, rng=None, recipients=None):
+    rng = rng or random.Random()
+    while True:
+        for message in spec:
+            offsets = []
+            t = 0
+            for event in message:
+                t += sample_delay(rng, event.type, delays)
+                offsets.append(t)
+            base = time.time() - t
+            if recipients is None:
+                rcpt_to, fields = sequences.uniq_recip_localpart() + '@ingest.thetucks.com', None
+            else:
+                rcpt_to, fields = recipients()
+            uniq_msg_id = sequences.uniq_message_id()
+            sequences.MESSAGES.inc()
+            sequences.EVENTS.inc(len(message))
+            for event, offset in zip(message, offsets):
+                yield event(sequences.FixedTimestamp(int(base + offset)), rcpt_to, uniq_msg_id, fields)
+
+
+class LoadStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.events_sent = 0
+        self.batches_sent = 0
+        self.events_accepted = 0
+        self.batches_accepted = 0
+        self.status = collections.Counter()
+        self.in_flight = collections.deque()    # event counts of batches sent and not yet answered, in order
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+
+# Generator: batches paced by a token bucket at rate events/sec (unit='events') or batches/sec (unit='batches') for
+# duration seconds. The rate ramps up linearly from zero over the first ramp seconds.
+def paced_batches(batches, rate, unit, duration, ramp, stats):
+    bucket = TokenBucket(lambda t: target_rate(rate, ramp, t))
+    for b in batches:
+        if stats.elapsed() >= duration:
+            return
+        bucket.take(b.events if unit == 'events' else 1)
+        stats.events_sent += b.events
+        stats.batches_sent += 1
+        stats.in_flight.append(b.events)
+        yield b
+
+
+def target_rate(rate, ramp, t):
+    return rate * min(1.0, t / ramp) if ramp else rate
+
+
+def report(stats, rate, unit, ramp, since, last):
+    t = stats.elapsed()
+    done = stats.events_accepted if unit == 'events' else stats.batches_accepted
+    achieved = (done - last) / (t - since) if t > since else 0
+    print('{:7.1f}s  target {:>10,.0f}  achieved {:>10,.0f} {}/s  sent {:,} events in {:,} batches  accepted {:,}  {}'.format(
+        t, target_rate(rate, ramp, t), achieved, unit, stats.events_sent, stats.batches_sent, stats.events_accepted,
+        dict(stats.status)))
+    return t, done
+
+
+def run_load(url, hdrs, name, rate, unit='events', duration=60, ramp=0, batch_events=1000, workers=8, privacy=True,
+             interval=5, delays=DELAYS, seed=None, recipients=None):
+    rng = random.Random(seed)
+    spec = sequences.SEQUENCES[name](privacy)
+    builder = batch.BatchBuilder(max_events=batch_events)
+    stats = LoadStats()
+    batches = paced_batches(builder.batches(iter_timed_events(spec, privacy, delays, rng, recipients)), rate, unit, duration, ramp, stats)
+    since, last = 0.0, 0
+    with uploader.BatchUploader(url, hdrs, workers=workers) as up:
+        for r in up.upload(batches):
+            stats.status[r.status_code] += 1
+            events = stats.in_flight.popleft()
+            if r.batch_id:
+                stats.batches_accepted += 1
+                stats.events_accepted += events
+            if stats.elapsed() - since >= interval:
+                since, last = report(stats, rate, unit, ramp, since, last)
+    t = stats.elapsed()
+    steady = max(t - ramp / 2.0, 1e-9)                  # the ramp delivers half the target on average
+    done = stats.events_accepted if unit == 'events' else stats.batches_accepted
+    print('Finished after {:.1f}s: target {:,.0f} {unit}/s, achieved {:,.0f} {unit}/s ({:.0%}) overall'.format(
+        t, rate, done / t, done / t / rate if rate else 0, unit=unit))
+    print('Ramp-adjusted target {:,} {unit}, achieved {:,} ({:.0%})'.format(int(rate * steady), done,
+          done / (rate * steady) if rate else 0, unit=unit))
+    return stats
+
+
+# -----------------------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Send events to the ingest API at a target rate')
+    parser.add_argument('-r', '--rate', help='Target rate', type=float, required=True)
+    parser.add_argument('-u', '--unit', help='Rate unit (default events)', choices=['events', 'batches'], default='events')
+    parser.add_argument('-d', '--duration', help='Seconds to run for (default 60)', type=float, default=60)
+    parser.add_argument('--ramp', help='Seconds to ramp up to the target rate (default 0)', type=float, default=0)
+    parser.add_argument('-s', '--sequence', help='Event sequence (default success)', choices=sorted(sequences.SEQUENCES), default='success')
+    parser.add_argument('-b', '--batch-events', help='Events per batch (default 1000)', type=int, default=1000)
+    parser.add_argument('-w', '--workers', help='Uploads in flight at once (default 8)', type=int, default=8)
+    parser.add_argument('-i', '--interval', help='Seconds between progress reports (default 5)', type=float, default=5)
+    parser.add_argument('--no-privacy', help='Send rcpt_to rather than rcpt_hash', action='store_true')
+    parser.add_argument('--seed', help='Seed for the timestamp delays', type=int)
+    parser.add_argument('--recipients', help='Send to addresses from this file, one per line (see recipients.py), rather than new ones')
+    metrics.add_args(parser)
+    args = parser.parse_args(argv)
+
+    sampler = None
+    if args.recipients:
+        import recipients
+        sampler = recipients.RecipientPool(args.recipients).sampler(seed=args.seed)
+    url, hdrs = ingest.ingest_from_env()
+    with metrics.from_args(args):
+        run_load(url, hdrs, args.sequence, args.rate, args.unit, args.duration, args.ramp, args.batch_events,
+                 args.workers, not args.no_privacy, args.interval, seed=args.seed, recipients=sampler)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+#
+# Pipeline instrumentation: counters, gauges and latency histograms for each stage (generation, privacy hashing,
+# compression, upload), exposed as Prometheus text over HTTP and/or written as periodic JSON snapshots.
+#
+# Modules declare their metrics once, at import, e.g.
+#   EVENTS = metrics.counter('sparky_events_generated_total', 'Events generated')
+# and update them from the hot path; updates are a lock and an add. Gauges can also be given a function to call
+# when they are read, so that values such as cache statistics cost nothing until they are collected.
+#
+# Sampled() replaces per-event console output with a log line for one call in every N.
+#
+
+import bisect, contextlib, json, logging, math, threading, time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        self._init()
+
+    def _init(self):
+        pass
+
+    def _child(self):
+        return type(self)(self.name, self.help)
+
+    # The metric for one set of label values, e.g. responses.labels(200).inc()
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._child()
+        return child
+
+    # Generator: (label dict, metric) for this metric, or for each of its children if it has labels
+    def series(self):
+        if not self.labelnames:
+            yield {}, self
+            return
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in sorted(children):
+            yield dict(zip(self.labelnames, values)), child
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _init(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def get(self):
+        return self.value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _init(self):
+        self.value = 0
+        self.fn = None
+
+    def set(self, v):
+        self.value = v
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    # Read the value from fn() when the gauge is collected
+    def set_function(self, fn):
+        self.fn = fn
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, help, labelnames)
+
+    def _init(self):
+        self.counts = [0] * (len(self.buckets) + 1)     # the last is the +Inf bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def _child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, v):
+        i = bisect.bisect_left(self.buckets, v)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += v
+
+    # Context manager that observes the seconds spent inside it
+    @contextlib.contextmanager
+    def time(self):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t)
+
+    # Estimate of the q quantile (0..1), interpolated within the bucket it falls in, as Prometheus does
+    def quantile(self, q):
+        with self._lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(counts):
+            if seen + c >= rank and c:
+                if i == len(self.buckets):
+                    return self.buckets[-1] if self.buckets else None     # in the +Inf bucket
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / c
+            seen += c
+        return None
+
+    def get(self):
+        return {'count': self.count, 'sum': self.sum, 'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics = {}
+
+    # Returns the metric of this name, making it if needed, so that modules can declare the same metric
+    def get_or_make(self, cls, name, help, labelnames=(), **kwargs):
+        with self._lock:
+            m = self.metrics.get(name)
+            if m is None:
+                m = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(m, cls):
+                raise ValueError('Metric {} is already a {}'.format(name, m.kind))
+        return m
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=(), registry=REGISTRY):
+    return registry.get_or_make(Counter, name, help, labelnames)
+
+
+def gauge(name, help, labelnames=(), registry=REGISTRY):
+    return registry.get_or_make(Gauge, name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+    return registry.get_or_make(Histogram, name, help, labelnames, buckets=buckets)
+
+
+def _labels(d, **extra):
+    d = dict(d, **extra)
+    if not d:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in d.items()) + '}'
+
+
+def _num(v):
+    if v == math.inf:
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+# All metrics in the Prometheus text exposition format
+def prometheus_text(registry=REGISTRY):
+    out = []
+    for name, m in sorted(registry.metrics.items()):
+        out.append('# HELP {} {}'.format(name, m.help))
+        out.append('# TYPE {} {}'.format(name, m.kind))
+        for labels, s in m.series():
+            if m.kind == 'histogram':
+                cumulative = 0
+                for le, c in zip(s.buckets + (math.inf,), s.counts):
+                    cumulative += c
+                    out.append('{}_bucket{} {}'.format(name, _labels(labels, le=_num(le)), cumulative))
+                out.append('{}_sum{} {}'.format(name, _labels(labels), _num(s.sum)))
+                out.append('{}_count{} {}'.format(name, _labels(labels), s.count))
+            else:
+                out.append('{}{} {}'.format(name, _labels(labels), _num(s.get())))
+    return '\n'.join(out) + '\n'
+
+
+# All metrics as a dict of name -> value, or -> {label values: value} for metrics with labels. Histograms give their
+# count, sum, p50 and p99.
+def snapshot(registry=REGISTRY):
+    r = {}
+    for name, m in sorted(registry.metrics.items()):
+        if m.labelnames:
+            r[name] = {','.join(labels.values()): s.get() for labels, s in m.series()}
+        else:
+            r[name] = m.get()
+    return r
+
+
+# Serves /metrics (Prometheus text) and /metrics.json on a background thread, and/or appends a JSON snapshot line to
+# json_path every interval seconds, with per-second rates for counters since the previous one. Stopping writes a
+# final snapshot.
+class MetricsReporter:
+    def __init__(self, port=None, json_path=None, interval=10, address='', registry=REGISTRY):
+        self.registry = registry
+        self.json_path = json_path
+        self.interval = interval
+        self.server = None
+        self._stop = threading.Event()
+        self._last = None
+        if port is not None:
+            self.server = _make_server((address, port), registry)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self._thread = None
+        if json_path:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        now = time.time()
+        metrics = snapshot(self.registry)
+        r = {'time': now, 'metrics': metrics}
+        if self._last:
+            t, last = self._last
+            r['rates'] = {k: (v - last.get(k, 0)) / (now - t) for k, v in metrics.items()
+                          if isinstance(v, (int, float)) and k.endswith('_total') and now > t}
+        self._last = now, metrics
+        with open(self.json_path, 'a') as f:
+            f.write(json.dumps(r) + '\n')
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.write_snapshot()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def _make_server(address, registry):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/metrics':
+                body, ctype = prometheus_text(registry).encode('utf-8'), 'text/plain; version=0.0.4'
+            elif path == '/metrics.json':
+                body, ctype = json.dumps(snapshot(registry)).encode('utf-8'), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    return server
+
+
+# Call to log one message in every "every" calls (the first, then every Nth), at level. Counting isn't locked, as an
+# exact sample isn't needed. The message is only formatted for calls that are logged.
+class Sampled:
+    def __init__(self, logger, every=1000, level=logging.INFO):
+        self.logger = logger if isinstance(logger, logging.Logger) else logging.getLogger(logger)
+        self.every = max(1, every)
+        self.level = level
+        self.calls = 0
+
+    def __call__(self, msg, *args):
+        self.calls += 1
+        if (self.calls - 1) % self.every == 0:
+            self.logger.log(self.level, msg + ' (1 in %d)', *args, self.every)
+
+
+def add_args(p):
+    p.add_argument('--metrics-port', help='Serve Prometheus metrics on this port (/metrics, and /metrics.json)', type=int)
+    p.add_argument('--metrics-json', help='Append a JSON snapshot of the metrics to this file every --metrics-interval seconds')
+    p.add_argument('--metrics-interval', help='Seconds between JSON snapshots (default 10)', type=float, default=10)
+
+
+# Returns a MetricsReporter for the add_args() options, which is a no-op if none were given
+def from_args(args):
+    return MetricsReporter(args.metrics_port, args.metrics_json, args.metrics_interval)
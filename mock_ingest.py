@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+#
+# Local stand-in for the SparkPost ingest API, for load and failure testing without an account.
+#
+# Accepts gzip NDJSON on /api/v1/ingest/events and returns a batch ID, as the real API does. Problems with a batch
+# (bad gzip, events that fail validation, a batch sent before) are recorded against its ID and served as gzip NDJSON
+# failure records from /api/v1/ingest/events/failures/<id> (or /failures/<id>). Latency, 429s and 5xx errors can be
+# injected to exercise the uploader's retry logic. GET /stats returns request and event counts as JSON.
+#
+# Run it, then point the other scripts at it:
+#   ./mock_ingest.py -p 8080 --rate-429 0.05
+#   SPARKPOST_HOST=http://localhost:8080 SPARKPOST_API_KEY=anything ./send_to_ingest.py
+#
+
+import argparse, collections, gzip, hashlib, http.server, json, random, threading, time, uuid, zlib
+import batch
+from schema import EVENT_CLASSES
+
+INGEST_PATH = '/api/v1/ingest/events'
+
+
+# Returns an error message for one NDJSON event line, or None if it looks valid. Give the server a schema.Schema to
+# check required attributes per event type as well.
+def validate_event(line):
+    try:
+        ev = json.loads(line)
+    except ValueError:
+        return 'event is not valid JSON'
+    if not isinstance(ev, dict) or not isinstance(ev.get('msys'), dict) or len(ev['msys']) != 1:
+        return 'event must be an object with a single "msys" event class'
+    ev_class, body = next(iter(ev['msys'].items()))
+    if ev_class not in EVENT_CLASSES:
+        return 'unknown event class "{}"'.format(ev_class)
+    if not isinstance(body, dict) or not body.get('type'):
+        return 'event has no type'
+    for k in ('event_id', 'timestamp'):
+        if k not in body:
+            return 'event has no {}'.format(k)
+    return None
+
+
+# Decompress a gzip body, which may have several members (see parallel.merge_batches). Raises zlib.error if the
+# data is not gzip or is cut short.
+def gunzip(body):
+    out = []
+    while body:
+        d = zlib.decompressobj(31)
+        out.append(d.decompress(body))
+        if not d.eof:
+            raise zlib.error('incomplete or truncated stream')
+        body = d.unused_data
+    return b''.join(out)
+
+
+def failure(error_type, message, line=None, event=None):
+    return {'error_type': error_type, 'line': line, 'message': message, 'event': event}
+
+
+class MockIngestServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    # latency and jitter are in seconds, added to every response. rate_429 and rate_5xx are the fractions of ingest
+    # requests to refuse with those errors; 429s carry a Retry-After of retry_after seconds.
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.0, rate_429=0.0, rate_5xx=0.0, retry_after=1,
+                 max_compressed=batch.MAX_COMPRESSED_BYTES, seed=None, schema=None):
+        super().__init__(address, MockIngestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.max_compressed = max_compressed
+        self.validate = schema.check if schema else validate_event
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.digests = {}                       # sha256 of each batch body -> ID of the batch that first sent it
+        self.failures = {}                      # batch ID -> gzip NDJSON failure records (empty if none)
+        self.stats = collections.Counter()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    # Start serving on a background thread, e.g. for benchmarks. Returns the server.
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    # Returns the status to inject for this request (429, 5xx), or None to handle it normally
+    def fault(self):
+        with self.lock:
+            r = self.random.random()
+            if r < self.rate_429:
+                return 429
+            if r < self.rate_429 + self.rate_5xx:
+                return self.random.choice((500, 502, 503, 504))
+        return None
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self.lock:
+                d = self.latency + self.random.uniform(0, self.jitter)
+            time.sleep(d)
+
+    # Check one batch body, returning (batch ID, list of failure records)
+    def ingest(self, body):
+        batch_id = str(uuid.uuid4())
+        digest = hashlib.sha256(body).hexdigest()
+        with self.lock:
+            first = self.digests.setdefault(digest, batch_id)
+        if first != batch_id:
+            self.count('duplicate_batches')
+            return batch_id, [failure('duplicate_batch', 'batch is a duplicate of batch {}'.format(first))]
+        try:
+            data = gunzip(body)
+        except zlib.error as err:
+            self.count('decompression_errors')
+            return batch_id, [failure('decompression', 'batch could not be decompressed: {}'.format(err))]
+        failures = []
+        events = 0
+        for n, line in enumerate(data.splitlines(), 1):
+            if not line.strip():
+                continue
+            events += 1
+            err = self.validate(line)
+            if err:
+                failures.append(failure('validation', err, n, line.decode('utf-8', errors='replace')))
+        if events == 0:
+            failures.append(failure('validation', 'batch contains no events'))
+        self.count('events', events)
+        self.count('events_rejected', len([f for f in failures if f['line']]))
+        return batch_id, failures
+
+
+class MockIngestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_error(self, status, message, headers=None):
+        self.reply(status, {'errors': [{'message': message}]}, headers=headers)
+
+    def do_POST(self):
+        s = self.server
+        s.count('requests')
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        s.delay()
+        if self.path.rstrip('/') != INGEST_PATH:
+            return self.reply_error(404, 'not found')
+        if not self.headers.get('Authorization'):
+            return self.reply_error(401, 'unauthorized')
+        status = s.fault()
+        if status == 429:
+            s.count('injected_429')
+            return self.reply_error(429, 'too many requests', {'Retry-After': str(s.retry_after)})
+        if status:
+            s.count('injected_5xx')
+            return self.reply_error(status, 'injected server error')
+        if len(body) > s.max_compressed:
+            s.count('too_large')
+            return self.reply_error(413, 'batch exceeds {} bytes'.format(s.max_compressed))
+        batch_id, failures = s.ingest(body)
+        records = gzip.compress(''.join(json.dumps(f) + '\n' for f in failures).encode('utf-8'))
+        with s.lock:
+            s.failures[batch_id] = records
+        s.count('batches')
+        self.reply(200, {'results': {'id': batch_id}})
+
+    def do_GET(self):
+        s = self.server
+        path = self.path.rstrip('/')
+        if path == '/stats':
+            with s.lock:
+                return self.reply(200, dict(s.stats))
+        prefix, _, batch_id = path.rpartition('/')
+        if prefix not in (INGEST_PATH + '/failures', '/failures'):
+            return self.reply_error(404, 'not found')
+        s.delay()
+        with s.lock:
+            body = s.failures.get(batch_id)
+        if body is None:
+            return self.reply_error(404, 'batch {} not found'.format(batch_id))
+        self.reply(200, body, content_type='application/gzip')
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the SparkPost ingest API')
+    parser.add_argument('-b', '--bind', help='Address to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port to listen on', type=int, default=8080)
+    parser.add_argument('--latency', help='Seconds added to every response', type=float, default=0.0)
+    parser.add_argument('--jitter', help='Up to this many more seconds, at random', type=float, default=0.0)
+    parser.add_argument('--rate-429', help='Fraction of ingest requests refused with 429', type=float, default=0.0)
+    parser.add_argument('--rate-5xx', help='Fraction of ingest requests refused with a 5xx error', type=float, default=0.0)
+    parser.add_argument('--retry-after', help='Retry-After seconds sent with 429s', type=int, default=1)
+    parser.add_argument('--seed', help='Seed for fault injection, for repeatable runs', type=int)
+    args = parser.parse_args()
+
+    server = MockIngestServer((args.bind, args.port), latency=args.latency, jitter=args.jitter, rate_429=args.rate_429,
+                              rate_5xx=args.rate_5xx, retry_after=args.retry_after, seed=args.seed)
+    print('Mock ingest API listening on', server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    print(json.dumps(dict(server.stats), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#
+# Generate synthetic events on several processes at once.
+#
+# The n messages are split into chunks. Each chunk is generated by a worker process with its own FakeTimestamp
+# range (so timestamps carry on exactly where the previous chunk's stop) and its own ID stream, and comes back as
+# gzip batches. Those are merged in order into upload-sized batches.
+#
+
+import collections, os
+from concurrent.futures import ProcessPoolExecutor
+import ingest, sequences, batch
+
+
+# Number of events (and so FakeTimestamp ticks) per message in a sequence
+def events_per_message(name, privacy=False):
+    return sum(len(message) for message in sequences.SEQUENCES[name](privacy))
+
+
+def _generate_chunk(name, start, count, privacy, begintime, naptime, per_message, seed, limits):
+    if seed is not None:
+        ingest.seed_ids(seed, stream=start)         # chunk-based, so output doesn't depend on which worker ran it
+    ts = sequences.FakeTimestamp(begintime + start * per_message * naptime, naptime)
+    spec = sequences.SEQUENCES[name](privacy)
+    builder = batch.BatchBuilder(**limits)
+    return list(builder.batches(sequences.iter_events(ts, count, spec)))
+
+
+# Join consecutive batches into one multi-member gzip payload (RFC 1952 allows concatenated members) wherever the
+# result still fits within the limits. Chunks usually end with a part-filled batch, so this avoids many small uploads.
+def merge_batches(batches, max_compressed=batch.MAX_COMPRESSED_BYTES, max_uncompressed=batch.MAX_UNCOMPRESSED_BYTES,
+                  max_events=batch.MAX_EVENTS, **kwargs):
+    pending = None
+    for b in batches:
+        if pending is not None:
+            if ((max_compressed is None or len(pending.payload) + len(b.payload) <= max_compressed) and
+                    (max_uncompressed is None or pending.size + b.size <= max_uncompressed) and
+                    (max_events is None or pending.events + b.events <= max_events)):
+                pending = batch.Batch(pending.payload + b.payload, pending.events + b.events, pending.size + b.size)
+                continue
+            yield pending
+        pending = b
+    if pending is not None:
+        yield pending
+
+
+# Generator: n messages of the named sequence (see sequences.SEQUENCES) as upload-ready batches, in order.
+# limits are passed to batch.BatchBuilder. Give a seed for reproducible event and message IDs. chunk is the number
+# of messages per chunk; by default each worker gets about four, of 100 to 10,000 messages.
+def generate_batches(name, n, privacy, begintime, naptime, workers=None, chunk=None, seed=None, **limits):
+    per_message = events_per_message(name, privacy)
+    workers = workers or os.cpu_count() or 1
+    if chunk is None:
+        chunk = min(10000, max(100, -(-n // (4 * workers))))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def chunks():
+            pending = collections.deque()
+            for start in range(0, n, chunk):
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(_generate_chunk, name, start, min(chunk, n - start), privacy,
+                                           begintime, naptime, per_message, seed, limits))
+            while pending:
+                yield pending.popleft().result()
+
+        for b in merge_batches((b for result in chunks() for b in result), **limits):
+            yield b
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+#
+# Convert PowerMTA accounting CSV files into ingest events.
+#
+# Records are read one line at a time, so memory use stays flat for files of any size (plain or gzip). Each record
+# type is mapped onto the matching ingest event type:
+#
+#   r   reception               reception       (SparkPost "injection")
+#   d   delivery                delivery
+#   b   bounce                  inband          (in-band bounce)
+#   t   transient failure       tempfail        (SparkPost "delay")
+#   rb  remote bounce           outofband       (out-of-band bounce)
+#   f   feedback loop report    feedback        (SparkPost "spam_complaint")
+#
+# Other record types are skipped. Column names come from the file's header lines (the lines starting with "type"),
+# or PMTA_FIELDS if there are none. PowerMTA bounce categories are mapped onto SparkPost bounce classes.
+#
+# IDs are derived from the records rather than drawn at random: the records of one message share a message_id, and
+# each event_id is a hash of its record, so converting the same file again gives the same events (which the upload
+# journal and dedup index then recognise).
+#
+# Conversion can be spread over worker processes, which also compress the events into batches; the batches come
+# back in file order, ready for uploader.BatchUploader.
+#
+
+from __future__ import print_function
+import argparse, collections, csv, datetime, functools, gzip, hashlib, io, logging, os, struct, sys
+from concurrent.futures import ProcessPoolExecutor
+import ingest, sequences, batch, parallel, metrics
+
+log = logging.getLogger('pmta')
+log_skipped = metrics.Sampled(log, 1000, logging.WARNING)
+SKIPPED = metrics.counter('sparky_pmta_skipped_records_total', 'PowerMTA records skipped as unreadable')
+
+# PowerMTA's default accounting fields, used until the file gives a header line
+PMTA_FIELDS = ['type', 'timeLogged', 'timeQueued', 'orig', 'rcpt', 'orcpt', 'dsnAction', 'dsnStatus', 'dsnDiag',
+               'dsnMta', 'bounceCat', 'srcType', 'srcMta', 'dlvType', 'dlvSourceIp', 'dlvDestinationIp',
+               'dlvEsmtpAvailable', 'dlvSize', 'vmta', 'jobId', 'envId', 'queue', 'vmtaPool']
+
+# PowerMTA bounceCat -> SparkPost bounce_class
+BOUNCE_CLASSES = {
+    'bad-mailbox': '10',                        # Invalid Recipient
+    'inactive-mailbox': '10',
+    'bad-domain': '10',
+    'no-answer-from-host': '24',                # Timeout
+    'message-expired': '24',
+    'bad-connection': '24',
+    'routing-errors': '21',                     # DNS Failure
+    'quota-issues': '22',                       # Mailbox Full
+    'bad-configuration': '25',                  # Admin Failure
+    'protocol-errors': '25',
+    'invalid-sender': '25',
+    'policy-related': '50',                     # Mail Block
+    'spam-related': '51',                       # Spam Block
+    'content-related': '52',                    # Spam Content
+    'virus-related': '53',                      # Prohibited Attachment
+    'relaying-issues': '54',                    # Relaying Denied
+    'other': '1',                               # Undetermined
+}
+DEFAULT_BOUNCE_CLASS = '1'
+
+# PowerMTA record type -> ingest event type
+EVENT_TYPES = {'r': 'reception', 'd': 'delivery', 'b': 'inband', 't': 'tempfail', 'rb': 'outofband', 'f': 'feedback'}
+
+# Columns that together identify the message a record belongs to
+MESSAGE_KEY = ('jobId', 'envId', 'orig', 'rcpt', 'timeQueued')
+
+
+# Unix time from a PowerMTA timestamp, e.g. "2020-06-17 20:33:55+0000". Log lines arrive in time order, so the same
+# few values repeat and are cached.
+@functools.lru_cache(maxsize=1024)
+def parse_time(s):
+    try:
+        return int(datetime.datetime.strptime(s, '%Y-%m-%d %H:%M:%S%z').timestamp())
+    except ValueError:
+        return int(datetime.datetime.strptime(s[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+# SMTP reply code from a diagnostic such as "smtp;550 5.1.1 User unknown", or ''
+def smtp_code(diag):
+    s = diag.split(';', 1)[-1].strip()
+    return s[:3] if s[:3].isdigit() else ''
+
+
+# SparkPost formatted message_id for the message a record belongs to: the time it was queued, embedded as
+# ingest.uniq_message_id() does, then a hash of its MESSAGE_KEY columns
+def message_id(r, when):
+    t = parse_time(r['timeQueued']) if r.get('timeQueued') else when
+    key = '\x1f'.join(r.get(k, '') for k in MESSAGE_KEY).encode('utf-8')
+    return '0000' + struct.pack('<I', t & 0xffffffff).hex() + hashlib.blake2b(key, digest_size=4).hexdigest()
+
+
+# SparkPost formatted event_id (0 .. 2^63-1) for a record, from a hash of all its values
+def event_id(r):
+    h = hashlib.blake2b('\x1f'.join(r.values()).encode('utf-8'), digest_size=8).digest()
+    return str(int.from_bytes(h, 'little') & 0x7fffffffffffffff)
+
+
+# Returns an NDJSON event line for one accounting record (a dict of column name -> value), or None for record types
+# that have no ingest equivalent. Records with a missing or unreadable time are skipped and counted in SKIPPED.
+def convert_record(r, privacy):
+    t = r.get('type')
+    rcpt = r.get('rcpt', '')
+    if t not in EVENT_TYPES or '@' not in rcpt:
+        return None
+    try:
+        when = parse_time(r.get('timeLogged', ''))
+        msg_id = message_id(r, when)
+    except ValueError as e:
+        SKIPPED.inc()
+        log_skipped('Skipping %s record for %s: %s', t, rcpt, e)
+        return None
+    orig = r.get('orig', '')
+    args = dict(msg_from=orig, friendly_from=orig, campaign_id=r.get('jobId', ''), subject=r.get('header_Subject', ''),
+                sending_ip=r.get('dlvSourceIp', ''), binding=r.get('vmta', ''), binding_group=r.get('vmtaPool', ''))
+    if t in ('b', 't', 'rb'):
+        diag = r.get('dsnDiag', '')
+        args.update(bounce_code=smtp_code(diag), bounce_reason=diag, raw_reason=diag,
+                    bounce_class=BOUNCE_CLASSES.get(r.get('bounceCat', ''), DEFAULT_BOUNCE_CLASS))
+    return ingest.make_event(EVENT_TYPES[t], sequences.FixedTimestamp(when), rcpt, privacy, msg_id, event_id(r), **args)
+
+
+def open_text(path):
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', errors='replace', newline='')
+    with open(path, 'rb') as f:
+        gz = f.read(2) == b'\x1f\x8b'
+    if gz:
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace', newline='')
+    return open(path, 'r', encoding='utf-8', errors='replace', newline='')
+
+
+# Generator: (column names, row) for each accounting record in a file
+def iter_rows(path):
+    fields = PMTA_FIELDS
+    with open_text(path) as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            if row[0] == 'type':
+                fields = row
+                continue
+            yield fields, row
+
+
+# Generator: accounting records from a file, as dicts of column name -> value
+def iter_records(path):
+    for fields, row in iter_rows(path):
+        yield dict(zip(fields, row))
+
+
+# Generator: NDJSON event lines for a file, converted in this process
+def iter_events(path, privacy=True):
+    for r in iter_records(path):
+        line = convert_record(r, privacy)
+        if line:
+            yield line
+
+
+# Returns the chunk's batches, and the number of records skipped, as the worker's SKIPPED count isn't seen here
+def _convert_chunk(fields, rows, privacy, limits):
+    skipped = SKIPPED.get()
+    builder = batch.BatchBuilder(**limits)
+    lines = (convert_record(dict(zip(fields, row)), privacy) for row in rows)
+    return list(builder.batches(line for line in lines if line)), SKIPPED.get() - skipped
+
+
+# Generator: gzip batches for a file, converted and compressed by worker processes. The file is read in chunks of
+# "chunk" records, with no more than two chunks per worker in flight. limits are passed to batch.BatchBuilder.
+def convert_batches(path, privacy=True, workers=None, chunk=10000, **limits):
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def chunks():
+            pending = collections.deque()
+            fields, rows = None, []
+            for f, row in iter_rows(path):
+                if rows and (f is not fields or len(rows) >= chunk):     # a chunk shares one header
+                    if len(pending) >= 2 * workers:
+                        yield pending.popleft().result()
+                    pending.append(pool.submit(_convert_chunk, fields, rows, privacy, limits))
+                    rows = []
+                fields = f
+                rows.append(row)
+            if rows:
+                pending.append(pool.submit(_convert_chunk, fields, rows, privacy, limits))
+            while pending:
+                yield pending.popleft().result()
+
+        def converted():
+            for result, skipped in chunks():
+                SKIPPED.inc(skipped)
+                for b in result:
+                    yield b
+
+        for b in parallel.merge_batches(converted(), **limits):
+            yield b
+
+
+def report_skipped():
+    if SKIPPED.get():
+        print('Skipped {:,} unreadable records'.format(SKIPPED.get()), file=sys.stderr)
+
+
+# -----------------------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert PowerMTA accounting CSV files into ingest events')
+    parser.add_argument('file', help='Accounting file, optionally gzip compressed ("-" for stdin)')
+    parser.add_argument('-o', '--output', help='Write NDJSON events to this file ("-" for stdout) instead of uploading')
+    parser.add_argument('-w', '--workers', help='Worker processes for conversion (default 1, i.e. none)', type=int, default=1)
+    parser.add_argument('-u', '--uploads', help='Uploads in flight at once (default 4)', type=int, default=4)
+    parser.add_argument('-j', '--journal', help='Journal file of accepted batches, so a rerun skips them')
+    parser.add_argument('--no-privacy', help='Send rcpt_to rather than rcpt_hash', action='store_true')
+    args = parser.parse_args(argv)
+    privacy = not args.no_privacy
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+
+    if args.output:
+        out = sys.stdout if args.output == '-' else open(args.output, 'w')
+        for line in iter_events(args.file, privacy):
+            out.write(line)
+        if out is not sys.stdout:
+            out.close()
+        report_skipped()
+        return
+
+    import send_to_ingest
+    url, hdrs = ingest.ingest_from_env()
+    if args.workers > 1:
+        batches = convert_batches(args.file, privacy, args.workers)
+    else:
+        batches = batch.BatchBuilder().batches(iter_events(args.file, privacy))
+    ok = send_to_ingest.send_batches(url, hdrs, batches, args.uploads, args.journal)
+    report_skipped()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Recipient pools: millions of real or synthetic addresses to send to, instead of a new fred.bloggs address for every
+# message, so that the same recipients come back across messages as they do in real traffic.
+#
+# A pool is a text file of addresses, one per line. It is memory-mapped rather than read into a list of str, and
+# indexed once into a sidecar file (<file>.idx) holding, for each address, its offset and length in the file, the id
+# of its domain, and the SHA1 digest used for rcpt_hash. Later loads map the index straight back in, so recipients
+# are ready to use at once and the privacy hashes are never recomputed. 10M recipients take 30 bytes each in
+# the index, plus the address file itself, most of which stays on disk until touched.
+#
+# Sampler draws recipients with a Zipf-like skew, so a few are much more active than the rest, and with a chance of
+# repeating a recipient drawn recently, as engaged recipients get mail (and open and click) again soon after.
+#
+# e.g. make a pool of a million synthetic recipients, then send to it:
+#   ./recipients.py pool.txt -n 1000000
+#   ./sparky.py send -n 10000 --recipients pool.txt
+#
+
+from __future__ import print_function
+import argparse, array, base64, collections, hashlib, mmap, os, random, struct
+
+INDEX_MAGIC = b'RCPTIDX1'
+# magic, recipients, source size, source mtime (ns), offset typecode, domains blob length
+INDEX_HEADER = struct.Struct('<8sQQQ1sxxxxxxxQ')
+DIGEST_SIZE = 20                                # SHA1
+SYNTHETIC_DOMAINS = ('ingest.thetucks.com', 'gmail.com', 'yahoo.com', 'hotmail.com', 'outlook.com', 'aol.com',
+                     'icloud.com', 'comcast.net')
+
+
+def _pad(n):
+    return -n % 8
+
+
+def _source_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class RecipientPool:
+    # path is a file of addresses, one per line; blank lines and lines without an @ are skipped. The index is built
+    # if it is missing or older than the file.
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + '.idx'
+        self._f = open(path, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self._f.fileno()).st_size else b''
+        if not self._load_index():
+            build_index(path, self.index_path, self._mm)
+            if not self._load_index():
+                raise ValueError('Recipient index {} could not be read back'.format(self.index_path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for v in self._views:
+            v.release()
+        self._imm.close()
+        self._if.close()
+        if self._mm:
+            self._mm.close()
+        self._f.close()
+
+    def _load_index(self):
+        try:
+            f = open(self.index_path, 'rb')
+        except OSError:
+            return False
+        h = f.read(INDEX_HEADER.size)
+        if len(h) < INDEX_HEADER.size:
+            f.close()
+            return False
+        magic, n, size, mtime, typecode, domains_len = INDEX_HEADER.unpack(h)
+        if magic != INDEX_MAGIC or (size, mtime) != _source_stamp(self.path):
+            f.close()
+            return False
+        self._if = f
+        self._imm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._imm)
+        pos = INDEX_HEADER.size
+        sections = []
+        for code, width in ((typecode.decode(), 8 if typecode == b'Q' else 4), ('H', 2), ('I', 4), ('B', DIGEST_SIZE)):
+            sections.append(view[pos:pos + n * width])
+            pos += n * width + _pad(n * width)
+        self._starts = sections[0].cast(typecode.decode())
+        self._lengths = sections[1].cast('H')
+        self._domain_ids = sections[2].cast('I')
+        self._digests = sections[3]
+        self.domains = bytes(view[pos:pos + domains_len]).decode('utf-8').split('\n')
+        self._views = [self._starts, self._lengths, self._domain_ids] + sections + [view]     # released in this order
+        return True
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def address(self, i):
+        s = self._starts[i]
+        return self._mm[s:s + self._lengths[i]].decode('utf-8')
+
+    def domain(self, i):
+        return self.domains[self._domain_ids[i]]
+
+    # (rcpt_hash, rcpt_domain) for recipient i, as ingest.rcpt_privacy() gives for its address
+    def privacy(self, i):
+        d = self._digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]
+        return base64.b64encode(d).decode('ascii'), self.domains[self._domain_ids[i]]
+
+    # Bytes held in memory by the index, not counting the pages of the address file that have been read
+    def index_bytes(self):
+        return len(self._imm)
+
+    def sampler(self, **kwargs):
+        return Sampler(self, **kwargs)
+
+
+# Build the index for an address file (mm is the file's contents, e.g. mmapped)
+def build_index(path, index_path, mm):
+    size, mtime = _source_stamp(path)
+    typecode = 'I' if size < 2 ** 32 else 'Q'
+    starts, lengths, domain_ids = array.array(typecode), array.array('H'), array.array('I')
+    digests = bytearray()
+    domains = {}
+    sha1 = hashlib.sha1
+    pos, end = 0, len(mm)
+    while pos < end:
+        nl = mm.find(b'\n', pos)
+        if nl < 0:
+            nl = end
+        line = mm[pos:nl]
+        s = pos
+        pos = nl + 1
+        stripped = line.strip()
+        if b'@' not in stripped:
+            continue
+        s += line.index(stripped[:1])           # skip leading whitespace
+        addr = stripped.decode('utf-8')
+        domain = addr.split('@')[1]
+        d = domains.get(domain)
+        if d is None:
+            d = domains[domain] = len(domains)
+        starts.append(s)
+        lengths.append(len(stripped))
+        domain_ids.append(d)
+        digests += sha1(stripped).digest()
+    domains_blob = '\n'.join(domains).encode('utf-8')
+    tmp = index_path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, len(lengths), size, mtime, typecode.encode(), len(domains_blob)))
+        for a in (starts, lengths, domain_ids, digests):
+            f.write(a)
+            f.write(b'\0' * _pad(len(a) * getattr(a, 'itemsize', 1)))
+        f.write(domains_blob)
+    os.replace(tmp, index_path)
+
+
+# Draws recipient indexes from a pool. skew is the Zipf exponent over recipients ranked by activity (0 = uniform,
+# 1 = the classic 1/rank); ranks are scattered over the pool, so activity doesn't follow file order. repeat is the
+# chance of choosing again from the last "recent" recipients drawn.
+class Sampler:
+    def __init__(self, pool, skew=1.0, repeat=0.2, recent=10000, seed=None):
+        self.pool = pool
+        self.n = len(pool)
+        if self.n == 0:
+            raise ValueError('Recipient pool {} is empty'.format(pool.path))
+        self.skew = skew
+        self.repeat = repeat
+        self.recent = collections.deque(maxlen=recent)
+        self.rng = random.Random(seed)
+        self._stride = 2654435761                # prime; steps through every index when it doesn't divide n
+        if self.n % self._stride == 0:
+            self._stride = 1
+
+    # Rank 0 (most active) .. n-1, by inverting the continuous power-law CDF over [1, n+1)
+    def _rank(self):
+        u = self.rng.random()
+        s = self.skew
+        if s == 0:
+            x = 1 + u * self.n
+        elif s == 1:
+            x = (self.n + 1) ** u
+        else:
+            x = ((((self.n + 1) ** (1 - s)) - 1) * u + 1) ** (1 / (1 - s))
+        return min(int(x) - 1, self.n - 1)
+
+    def sample(self):
+        if self.recent and self.rng.random() < self.repeat:
+            return self.recent[self.rng.randrange(len(self.recent))]
+        i = (self._rank() * self._stride) % self.n
+        self.recent.append(i)
+        return i
+
+    # (rcpt_to, (rcpt_hash, rcpt_domain)) for the next recipient
+    def __call__(self):
+        i = self.sample()
+        return self.pool.address(i), self.pool.privacy(i)
+
+
+# Write n synthetic addresses to path, spread over domains
+def write_synthetic(path, n, domains=SYNTHETIC_DOMAINS, seed=None):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for i in range(n):
+            f.write('fred.bloggs{:012d}@{}\n'.format(rng.randrange(10 ** 12), domains[i % len(domains)]))
+
+
+# -----------------------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Make and index recipient pools')
+    parser.add_argument('file', help='Address file, one per line')
+    parser.add_argument('-n', '--synthetic', help='Write this many synthetic addresses to the file first', type=int)
+    parser.add_argument('--seed', help='Seed for the synthetic addresses', type=int)
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        write_synthetic(args.file, args.synthetic, seed=args.seed)
+    with RecipientPool(args.file) as pool:
+        print('{:,} recipients in {:,} domains; index {} is {:,} bytes'.format(
+            len(pool), len(pool.domains), pool.index_path, pool.index_bytes()))
+
+
+if __name__ == '__main__':
+    main()
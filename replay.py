@@ -0,0 +1,169 @@
+#
+# Replay archived events from NDJSON or NDJSON.gz files of any size.
+#
+# Files are memory-mapped and read a line at a time, so memory use doesn't grow with file size. Lines are packed
+# into batches by batch.BatchBuilder and uploaded with bounded memory by uploader.BatchUploader. The byte offset
+# reached is saved to a progress file after each accepted batch, so an interrupted replay can carry on from there.
+# For gzip files the offset counts uncompressed bytes, since there is no seeking within compressed data; resuming
+# decompresses and skips up to it.
+#
+# Events can be re-stamped with new event_ids and timestamps moved up to the present, so that replaying an archive
+# twice isn't rejected as duplicate events.
+#
+
+import collections, json, mmap, os, time, zlib
+import ingest, batch, uploader, journal, dedup, schema
+
+
+# Generator: (line, end offset) for each line of a plain or gzip NDJSON file, starting at byte offset "offset"
+# (which should be at the start of a line, e.g. an end offset from an earlier run)
+def iter_lines(path, offset=0):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:2] == b'\x1f\x8b':
+                for r in _iter_gzip_lines(mm, offset):
+                    yield r
+            else:
+                mm.seek(offset)
+                for line in iter(mm.readline, b''):
+                    yield line, mm.tell()
+
+
+def _iter_gzip_lines(mm, offset, chunk_size=1024 * 1024):
+    d = zlib.decompressobj(31)
+    pos = 0                                     # uncompressed offset reached
+    buf = b''
+    for i in range(0, len(mm), chunk_size):
+        data = mm[i:i + chunk_size]
+        while data:
+            if d.eof:                           # another gzip member follows (RFC 1952 allows several)
+                d = zlib.decompressobj(31)
+            buf += d.decompress(data)
+            data = d.unused_data
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            pos += len(line) + 1
+            if pos > offset:
+                yield line + b'\n', pos
+    if not d.eof:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    if buf:
+        pos += len(buf)
+        if pos > offset:
+            yield buf, pos                      # last line has no newline
+
+
+# Re-stamp events with new event_ids, and shift their timestamps so the first event replayed is at the present
+# time, keeping the spacing between events. Timestamps that aren't Unix times are left alone.
+class Restamper:
+    def __init__(self, now=None):
+        self.now = now
+        self.shift = None
+
+    def __call__(self, line):
+        e = json.loads(line)
+        for body in e.get('msys', {}).values():
+            if not isinstance(body, dict):
+                continue
+            if 'event_id' in body:
+                body['event_id'] = ingest.uniq_event_id()
+            ts = body.get('timestamp')
+            try:
+                t = float(ts)
+            except (TypeError, ValueError):
+                continue
+            if self.shift is None:
+                self.shift = (self.now if self.now is not None else time.time()) - t
+            t += self.shift
+            if isinstance(ts, str):
+                body['timestamp'] = str(int(t)) if ts.isdigit() else str(t)
+            else:
+                body['timestamp'] = int(t) if isinstance(ts, int) else t
+        return json.dumps(e) + '\n'
+
+
+def _read_progress(path, file):
+    try:
+        with open(path, 'r') as f:
+            p = json.load(f)
+    except (OSError, ValueError):
+        return 0
+    return p.get('offset', 0) if p.get('file') == os.path.abspath(file) else 0
+
+
+def _write_progress(path, file, offset):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'file': os.path.abspath(file), 'offset': offset}, f)
+    os.replace(tmp, path)
+
+
+# Generator: (Batch, end offset of its last line) for the lines of a file from offset on. Blank lines are skipped.
+# With a validator (schema.Schema), invalid lines are passed to quarantine(n, line, message) if given, or dropped.
+def file_batches(path, offset=0, restamp=None, validator=None, quarantine=None, builder=None):
+    builder = builder or batch.BatchBuilder()
+    last = offset
+    for n, (line, end) in enumerate(iter_lines(path, offset), 1):
+        if line.strip():
+            if validator is not None:
+                err = validator.check(line)
+                if err is not None:
+                    if quarantine:
+                        quarantine(n, line, err)
+                    line = None
+            if line is not None:
+                if restamp:
+                    line = restamp(line)
+                b = builder.add(line)
+                if b:
+                    yield b, last
+        last = end
+    b = builder.flush()
+    if b:
+        yield b, last
+
+
+# Upload the events in a file. With progress_path, carry on from the offset saved there by an earlier run of the
+# same file (unless an explicit offset is given) and save the offset reached after each accepted batch. The saved
+# offset only moves past batches that were accepted along with every batch before them. Returns (offset reached,
+# True if every batch was accepted).
+# With dedup_path, events whose event_id was accepted by an earlier run (e.g. of an overlapping file) are skipped; this
+# takes the place of the journal. Re-stamped events get new event_ids, so aren't caught by it.
+def replay(url, hdrs, path, offset=None, restamp=False, progress_path=None, workers=4, journal_path=None,
+           validator=None, quarantine_path=None, builder=None, dedup_path=None):
+    if offset is None:
+        offset = _read_progress(progress_path, path) if progress_path else 0
+    if offset:
+        print('Resuming {} from byte offset {:,}'.format(path, offset))
+    if dedup_path:
+        j = dedup.DedupIndex(dedup_path)
+        builder = j.builder(builder)
+    else:
+        j = journal.UploadJournal(journal_path) if journal_path else None
+    q = schema.Quarantine(quarantine_path) if validator is not None and quarantine_path else None
+    marks = collections.deque()                 # end offsets of batches not yet answered, in order
+    def payloads():
+        for b, end in file_batches(path, offset, Restamper() if restamp else None, validator, q, builder):
+            marks.append(end)
+            yield b
+    ok = True
+    with uploader.BatchUploader(url, hdrs, workers=workers, journal=j) as up:
+        for r in up.upload(payloads()):
+            print('Batch {}: {} {}'.format(r.seq, r.status_code, r.content))
+            end = marks.popleft()
+            ok = ok and r.batch_id is not None
+            if ok:
+                offset = end
+                if progress_path:
+                    _write_progress(progress_path, path, offset)
+    if j is not None:
+        if dedup_path:
+            print('{} events already sent were skipped'.format(j.skipped))
+        j.close()
+    if q is not None:
+        print('{} invalid events quarantined in {}'.format(q.count, quarantine_path))
+        q.close()
+    return offset, ok
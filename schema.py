@@ -0,0 +1,106 @@
+#
+# Check events against the ingest event documentation before upload.
+#
+# The documentation (see event_docs.py) is compiled once into the set of required attributes for each event type.
+# Checking an event is then a JSON parse and a set difference, cheap enough to run over every generated or replayed
+# event. Invalid events (e.g. the "banana" event class in send_to_ingest.py) can be dropped or quarantined locally,
+# rather than using up upload bandwidth and only showing up later in chk_batch_failures.py output.
+#
+
+import json, threading
+import event_docs
+
+# Event classes ("envelopes") the ingest API accepts, as built by ingest.py
+EVENT_CLASSES = ('message_event', 'track_event', 'gen_event', 'unsubscribe_event', 'relay_event', 'ab_test_event')
+
+# Attributes that stand in for a required one. Privacy mode (ingest.apply_privacy) replaces rcpt_to with rcpt_hash.
+ALTERNATIVES = {'rcpt_to': 'rcpt_hash'}
+
+# Attributes that the ingest API requires together
+PAIRED = (('rcpt_hash', 'rcpt_domain'),)
+
+
+class Schema:
+    # required is a dict of event type -> names of its required attributes
+    def __init__(self, required):
+        self.required = {t: frozenset(attrs) for t, attrs in required.items()}
+
+    # Schema from the ingest event documentation, as returned by event_docs.fetch_docs()
+    @classmethod
+    def from_docs(cls, results):
+        return cls.from_index(event_docs.index_docs(results))
+
+    # Schema from documentation indexed by event type, as returned by event_docs.load_docs()
+    @classmethod
+    def from_index(cls, index):
+        return cls({t: [a for a, v in attrs.items() if v.get('required')] for t, attrs in index.items()})
+
+    # Returns an error message for one NDJSON event line (str or bytes), or None if the event is valid
+    def check(self, line):
+        try:
+            ev = json.loads(line)
+        except ValueError:
+            return 'event is not valid JSON'
+        if not isinstance(ev, dict) or not isinstance(ev.get('msys'), dict) or len(ev['msys']) != 1:
+            return 'event must be an object with a single "msys" event class'
+        ev_class, body = next(iter(ev['msys'].items()))
+        if ev_class not in EVENT_CLASSES:
+            return 'unknown event class "{}"'.format(ev_class)
+        if not isinstance(body, dict):
+            return 'event class "{}" is not an object'.format(ev_class)
+        t = body.get('type')
+        required = self.required.get(t)
+        if required is None:
+            return 'unknown event type "{}"'.format(t)
+        missing = required.difference(body)
+        if missing:
+            missing = [a for a in missing if ALTERNATIVES.get(a) not in body]
+            if missing:
+                return 'missing required attribute(s) {} on {} event'.format(', '.join(sorted(missing)), t)
+        for a, b in PAIRED:
+            if (a in body) != (b in body):
+                return 'missing {} on event with {}'.format(*((b, a) if a in body else (a, b)))
+        return None
+
+    # Generator: the valid lines from an event stream. Each invalid line is passed to quarantine(n, line, message),
+    # if given, where n is its 1-based position in the stream; otherwise it is dropped.
+    def filter(self, lines, quarantine=None):
+        check = self.check
+        for n, line in enumerate(lines, 1):
+            err = check(line)
+            if err is None:
+                yield line
+            elif quarantine:
+                quarantine(n, line, err)
+
+
+# Write rejected events to an NDJSON file as failure records shaped like the ingest API's, so they can be read
+# alongside chk_batch_failures.py output. Use as the quarantine callback for Schema.filter().
+class Quarantine:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._f = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, n, line, message):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        r = {'error_type': 'validation', 'line': n, 'message': message, 'event': line.rstrip('\n')}
+        with self._lock:
+            self._f.write(json.dumps(r) + '\n')
+            self.count += 1
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Schema for the ingest event documentation, from the local cache where possible (see event_docs.load_docs)
+def load_schema(**kwargs):
+    return Schema.from_index(event_docs.load_docs(**kwargs))
@@ -1,383 +1,137 @@
 #!/usr/bin/env python3
 #
 from __future__ import print_function
-import requests, gzip, time, uuid, os, hashlib, base64
-import ingest
+import zlib, itertools, logging, time
+import ingest, sequences
 
-# Returns a SparkPost formatted unique messageID, which has an embedded timestamp
-def uniq_message_id():
-    uID = uuid.uuid4().bytes
-    tHex = '%08x' % (int(time.time()))
-    tHexLittleEndian = tHex[6:8] + tHex[4:6] + tHex[2:4] + tHex[0:2] # reverse byte order
-    u = '0000%s%02x%02x%02x%02x' % (tHexLittleEndian, uID[0], uID[1], uID[2], uID[3])
-    return u
+# Compress a stream of NDJSON event lines (str or bytes), yielding gzip data as it becomes available.
+# Memory use stays flat however many events are in the stream.
+def gzip_events(lines, level=9):
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 gives gzip header and trailer, same as gzip.compress
+    for line in lines:
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        chunk = z.compress(line)
+        if chunk:
+            yield chunk
+    yield z.flush()
 
 
-def uniq_recip_localpart():
-    u = 'fred.bloggs' + str(uuid.uuid4().int)[:12]
-    return u
+def gzip_payload(lines, level=9):
+    return b''.join(gzip_events(lines, level))
 
 
-def uniq_recip():
-    recip = uniq_recip_localpart() + '@ingest.thetucks.com'
-    print(recip)
-    return recip
-
-class FakeTimestamp:
-    def __init__(self, begintime, naptime):
-        self.ts = begintime
-        self.naptime = naptime
-
-    def time(self):
-        self.ts += self.naptime                 # increment this so events appear spaced apart
-        return self.ts
-
-
-#
-# -----------------------------------------------------------------------------------------
-#  Event sequences, with time between events
-# -----------------------------------------------------------------------------------------
-#
-# "successful" event sequence, open/click
-def make_success_events_sequence(ts, n, privacy):
-    msg_from = 'test@bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'big nice campaign'
-    subject = 'lovely test email'
-    geo_ip = {
-        'country': 'US',
-        'region': 'MD',
-        'city': 'Columbia',
-        'latitude': 39.1749,
-        'longitude': -76.8375,
-        'zip': 21046,
-        'postal_code': '21046',
-    }
-    sending_ip = '10.0.0.1' # example
-    user_agent_opens = 'Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)'
-    user_agent_click = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36'
-
-    events = ''
-    for i in range(0, n):
-        # "successful" message sequence
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        events += ingest.make_injection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_delivery_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_initial_open_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, geo_ip=geo_ip, user_agent=user_agent_opens)
-        events += ingest.make_open_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, geo_ip=geo_ip, user_agent=user_agent_opens)
-        events += ingest.make_click_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, geo_ip=geo_ip, user_agent=user_agent_click)
-    return events
-
-
-# "successful" event sequence, AMP open/click
-def make_success_events_sequence_amp(ts, n, privacy) :
-    msg_from = 'test@bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'big nice campaign'
-    subject = 'lovely test email'
-    geo_ip = {
-        'country': 'US',
-        'region': 'MD',
-        'city': 'Columbia',
-        'latitude': 39.1749,
-        'longitude': -76.8375,
-        'zip': 21046,
-        'postal_code': '21046',
-    }
-    sending_ip = '10.0.0.1' # example
-    user_agent_opens = 'Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)'
-    user_agent_click = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36'
-
-    events = ''
-    for i in range(0, n):
-        # "successful" message sequence
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        events += ingest.make_injection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_delivery_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_amp_initial_open_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, geo_ip=geo_ip, user_agent=user_agent_opens)
-        events += ingest.make_amp_open_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, geo_ip=geo_ip, user_agent=user_agent_opens)
-        events += ingest.make_amp_click_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, geo_ip=geo_ip, user_agent=user_agent_click)
-    return events
-
-
-# "bounce" event sequence (in-band bounce), starting
-def make_bounce_events_sequence(ts, n, privacy):
-    msg_from = 'test@bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'big bouncy campaign'
-    subject = 'This email results in an in-band bounce'
-    sending_ip = '10.0.0.1' # example
-
-    events = ''
-    for i in range(0, n):
-        # "bounce" message sequence
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        bounce_code = '554'
-        bounce_reason = 'smtp;554 5.7.1 Blacklisted by black.uribl.com Contact the postmaster of this domain for resolution.'
-        raw_reason = bounce_reason # no need to redact this type of reason code
-        bounce_class = '51'
-        events += ingest.make_injection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_bounce_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip,
-            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
-    return events
-
-
-# "out of band" bounce event sequence, starting with injection + delivery
-def make_out_of_band_bounce_events_sequence(ts, n, privacy):
-    msg_from = 'test@oob-bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'out of band bouncy campaign'
-    subject = 'out of band bounce test email'
-    sending_ip = '10.0.0.1' # example
-
-    events = ''
-    for i in range(0, n):
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        bounce_code = '550'
-        raw_reason = 'SMTP;550 5.0.0 <' + rcpt_to + '>... User unknown'
-        bounce_reason = 'SMTP;550 5.0.0 ...@... ...' # redacted the email address for this type of reason code
-        bounce_class = '10'
-        events += ingest.make_injection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_delivery_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_out_of_band_bounce_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip,
-            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
-    return events
-
-
-# "spam_complaint" event sequence, starting with injection + delivery
-def make_spam_complaint_events_sequence(ts, n, privacy):
-    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'campaign that gets a spam complaint FBL'
-    subject = 'message that gets spam complaint FBL'
-    sending_ip = '10.0.0.1' # example
-
-    events = ''
-    for i in range(0, n):
-        # "Out of band" bounce message sequence, should have a corresponding injection & delivery
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        events += ingest.make_injection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_delivery_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        events += ingest.make_spam_complaint_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-    return events
-
-
-# "delay" message sequence
-def make_delay_events_sequence(ts, n, privacy):
-    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'campaign that gets delayed'
-    subject = 'message that gets delayed'
-    sending_ip = '10.0.0.1' # example
-
-    events = ''
-    for i in range(0, n):
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        events += ingest.make_injection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-        bounce_code = '452'
-        raw_reason = 'smtp;452 4.2.2 Recipient Unable to accept message - mailbox full(c2mailmx101)'
-        bounce_reason = raw_reason
-        bounce_class = '22' # Mailbox full
-        events += ingest.make_delay_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip,
-            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
-    return events
-
-
-# "rejection" message sequences of various kinds
-def make_rejection_events_sequence(ts, n, privacy):
-    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'campaign-rejections'
-    sending_ip = '10.0.0.1' # example
-
-    events = ''
-    for i in range(0, n):
-        # SMTP Policy rejections have a message_id but do not log a corresponding injection event on SparkPost
-        subject = 'message that gets policy rejection (smtp)'
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        bounce_class = '25' # "Admin Failure"
-        bounce_code = '550'
-        raw_reason = '550 5.7.1 Unconfigured Sending Domain'
-        bounce_reason = raw_reason
-        events += ingest.make_policy_rejection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip,
-            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
-
-        # REST Generation Rejections do not log a corresponding injection event on SparkPost
-        subject = 'message that gets generation rejection (rest)'
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-
-        bounce_class = '25' # "Admin Failure"
-        bounce_code = '550'
-        raw_reason = '550 5.6.0 No Sending Domain found in From header'
-        bounce_reason = raw_reason
-
-        events += ingest.make_generation_rejection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip,
-            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
-
-        # REST Generation Failures do not log a corresponding injection event on SparkPost
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        bounce_code = '554'
-        raw_reason = '554 5.3.3 [internal] Error while rendering part html: line 1: substitution value \'myvar\' did not exist or was null'
-        bounce_reason = raw_reason
-
-        events += ingest.make_generation_failure_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip,
-            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
-
-    return events
-
-
-# "unsubscribe" message sequences of various kinds
-def make_unsubscribe_events_sequence(ts, n, privacy):
-    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
-    friendly_from = 'sp-event-agent@test.sparkpost.com'
-    campaign_id = 'campaign-unsubscribe'
-    sending_ip = '10.0.0.1' # example
-
-    events = ''
-    for i in range(0, n):
-        subject = 'message that gets unsubscribed'
-        rcpt_to = uniq_recip()
-        uniq_msg_id = uniq_message_id()
-        events += ingest.make_injection_event(ts=ts,
-            msg_from=msg_from, friendly_from=friendly_from, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id,campaign_id=campaign_id,
-            subject=subject, sending_ip=sending_ip)
-
-        user_agent_click = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36'
-        events += ingest.make_link_unsubscribe_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, user_agent=user_agent_click)
-
-        events += ingest.make_list_unsubscribe_event(ts=ts, rcpt_to=rcpt_to, privacy=privacy, uniq_msg_id=uniq_msg_id, user_agent=user_agent_click)
-
-    return events
-
-
-def send_to_ingest(compressed_events):
+def send_to_ingest(url, hdrs, compressed_events):
+    import requests
     print('Uploading {} bytes of gzip event data'.format(len(compressed_events)))
     res = requests.post(url, data=compressed_events, headers=hdrs)
     print(res.status_code, res.content)
 
 
-def stripEnd(h, s):
-    if h.endswith(s):
-        h = h[:-len(s)]
-    return h
+# Upload an event stream of any length as a series of batches that each fit within the ingest payload limits.
+# Give a validator (schema.Schema) to check events first; invalid ones are written to the quarantine_path file, if
+# given, instead of being uploaded. Give a dedup_path to skip events and batches accepted by any earlier run.
+# Returns True if every batch was accepted.
+def send_events(url, hdrs, lines, builder=None, workers=4, journal_path=None, validator=None, quarantine_path=None,
+                dedup_path=None, spool_path=None):
+    import batch, dedup, schema                 # imported when needed, so importing this module stays quick
+    if builder is None:
+        builder = batch.BatchBuilder()
+    q = None
+    if validator is not None:
+        q = schema.Quarantine(quarantine_path) if quarantine_path else None
+        lines = validator.filter(lines, q)
+    d = dedup.DedupIndex(dedup_path) if dedup_path else None
+    if d is not None:
+        builder = d.builder(builder)
+    ok = send_batches(url, hdrs, builder.batches(lines), workers, journal_path, d, spool_path)
+    if d is not None:
+        print('{} events already sent were skipped'.format(d.skipped))
+        d.close()
+    if q is not None:
+        print('{} invalid events quarantined in {}'.format(q.count, quarantine_path))
+        q.close()
+    return ok
+
+
+# Upload batches with up to "workers" in flight at once. Give a journal_path to skip batches accepted by an earlier run,
+# or an open journal (e.g. a dedup.DedupIndex) to use instead. With spool_path, batches go through a spool.Spool
+# there, so that building them isn't held up by slow uploads. Returns True if every batch was accepted.
+def send_batches(url, hdrs, batches, workers=4, journal_path=None, j=None, spool_path=None):
+    import uploader, journal
+    if spool_path:
+        import spool
+        return spool.spooled_upload(url, hdrs, batches, spool_path, workers, journal_path, j)
+    opened = j is None and journal_path
+    if opened:
+        j = journal.UploadJournal(journal_path)
+    ok = True
+    with uploader.BatchUploader(url, hdrs, workers=workers, journal=j) as up:
+        for r in up.upload(batches):
+            print('Batch {}: {} {}'.format(r.seq, r.status_code, r.content))
+            ok = ok and r.batch_id is not None
+    if opened:
+        j.close()
+    return ok
+
+
+# The normal message sequences, then batches that exercise the ingest error paths. privacy=True uses SHA1 on RCPT TO.
+def send_test_batches(url, hdrs, privacy=True):
+    # "wind the clock back", to allow for events spread apart in time
+    ts = sequences.FakeTimestamp(int(time.time()) - 10*60, 2)
+
+    print('Success events sequence')
+    events = sequences.iter_success_events_sequence(ts, 1, privacy)
+    print('Success events sequence - AMP')
+    events = itertools.chain(events, sequences.iter_success_events_sequence_amp(ts, 1, privacy)) # AMP opens and clicks
+    print('Bounce events sequence')
+    events = itertools.chain(events, sequences.iter_bounce_events_sequence(ts, 1, privacy))
+    payload = gzip_payload(events)
+    send_to_ingest(url, hdrs, payload)
+    payloadKeep = payload # use later
+
+    # Faulty batches of various types
+    print('Empty batch')
+    send_to_ingest(url, hdrs, gzip_payload([]))
+
+    print('Empty NDJSON - should cause a validation error')
+    send_to_ingest(url, hdrs, gzip_payload(['{}\n']))
+
+    print('Faulty GZIPping, should cause "decompression" error')
+    send_to_ingest(url, hdrs, b'\x1f\x8b\x08\x00')
+
+    print('Duplicate batch - should cause error')
+    send_to_ingest(url, hdrs, payloadKeep)
+
+    print('A couple of weird event types to make a validation error (some failures, some accepted)')
+    events = sequences.iter_success_events_sequence(ts, 1, privacy)
+    events = (e.replace('message_event', 'banana') for e in events)
+    send_to_ingest(url, hdrs, gzip_payload(events))
+
+    # "system" errors can't be deliberately caused by faulty inputs, they are an internal thing.
+
+    print('OOB, spam complaint, delay, rejection events sequence')
+    events = itertools.chain(
+        sequences.iter_out_of_band_bounce_events_sequence(ts, 1, privacy),
+        sequences.iter_spam_complaint_events_sequence(ts, 1, privacy),
+        sequences.iter_delay_events_sequence(ts, 1, privacy),
+        sequences.iter_rejection_events_sequence(ts, 1, privacy), # Various kinds of rejection events
+    )
+    send_to_ingest(url, hdrs, gzip_payload(events))
+
+    print('Unsubscribe events sequence')
+    events = sequences.iter_unsubscribe_events_sequence(ts, 1, privacy)
+    send_to_ingest(url, hdrs, gzip_payload(events))
 
 
-# condense into a access+base_url form
-def hostCleanup(host):
-    if not host.startswith('https://'):
-        host = 'https://' + host  # Add schema
-    host = stripEnd(host, '/')
-    host = stripEnd(host, '/api/v1')
-    host = stripEnd(host, '/')
-    return host
-
 # -----------------------------------------------------------------------------------------
 # Main code
 # -----------------------------------------------------------------------------------------
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    url, hdrs = ingest.ingest_from_env()
+    send_test_batches(url, hdrs)
 
-host = hostCleanup(os.getenv('SPARKPOST_HOST', default='api.sparkpost.com'))
-url = host + '/api/v1/ingest/events'
-
-apiKey = os.getenv('SPARKPOST_API_KEY')
-if apiKey == None:
-    print('Environment variable SPARKPOST_API_KEY not set - stopping.')
-    exit(1)
-
-hdrs = {
-    'Authorization': apiKey,
-    'Content-Type': 'application/x-ndjson',
-    'Content-Encoding': 'gzip'
-}
-
-privacy = True # use SHA1 on RCPT TO
-
-# "wind the clock back", to allow for events spread apart in time
-ts = FakeTimestamp(int(time.time()) - 10*60, 2)
-
-print('Success events sequence')
-events = make_success_events_sequence(ts, 1, privacy)
-print('Success events sequence - AMP')
-events += make_success_events_sequence_amp(ts, 1, privacy) # AMP opens and clicks
-print('Bounce events sequence')
-events += make_bounce_events_sequence(ts, 1, privacy)
-send_to_ingest(gzip.compress(events.encode('utf-8')))
-eventsKeep = events # use later
-
-# Faulty batches of various types
-events = ''
-print('Empty batch')
-send_to_ingest(gzip.compress(events.encode('utf-8')))
-
-print('Empty NDJSON - should cause a validation error')
-events = '{}\n'
-send_to_ingest(gzip.compress(events.encode('utf-8')))
-
-print('Faulty GZIPping, should cause "decompression" error')
-send_to_ingest(b'\x1f\x8b\x08\x00')
-
-print('Duplicate batch - should cause error')
-events = eventsKeep
-send_to_ingest(gzip.compress(events.encode('utf-8')))
-
-print('A couple of weird event types to make a validation error (some failures, some accepted)')
-events = make_success_events_sequence(ts, 1, privacy)
-events = events.replace('message_event', 'banana')
-send_to_ingest(gzip.compress(events.encode('utf-8')))
-
-# "system" errors can't be deliberately caused by faulty inputs, they are an internal thing.
-
-print('OOB, spam complaint, delay, rejection events sequence')
-events = ''
-events += make_out_of_band_bounce_events_sequence(ts, 1, privacy)
-events += make_spam_complaint_events_sequence(ts, 1, privacy)
-events += make_delay_events_sequence(ts, 1, privacy)
-events += make_rejection_events_sequence(ts, 1, privacy) # Various kinds of rejection events
-send_to_ingest(gzip.compress(events.encode('utf-8')))
 
-print('Unsubscribe events sequence')
-events = ''
-events += make_unsubscribe_events_sequence(ts, 1, privacy)
-send_to_ingest(gzip.compress(events.encode('utf-8')))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#
+# Synthetic event sequences: successful delivery and engagement, bounces, complaints, delays, rejections and
+# unsubscribes, built from the ingest library's event builders.
+#
+
+import logging, uuid
+import ingest, metrics
+
+log = logging.getLogger('sequences')
+log_recip = metrics.Sampled(log, 10000)         # recipients are logged 1 in 10000, as printing each throttles generation
+MESSAGES = metrics.counter('sparky_messages_generated_total', 'Messages generated from sequences')
+EVENTS = metrics.counter('sparky_events_generated_total', 'Events generated from sequences')
+
+# Returns a SparkPost formatted unique messageID, which has an embedded timestamp
+def uniq_message_id():
+    return ingest.uniq_message_id()
+
+
+def uniq_recip_localpart():
+    u = 'fred.bloggs' + str(uuid.uuid4().int)[:12]
+    return u
+
+
+def uniq_recip():
+    recip = uniq_recip_localpart() + '@ingest.thetucks.com'
+    log_recip('recipient %s', recip)
+    return recip
+
+class FakeTimestamp:
+    def __init__(self, begintime, naptime):
+        self.ts = begintime
+        self.naptime = naptime
+
+    def time(self):
+        self.ts += self.naptime                 # increment this so events appear spaced apart
+        return self.ts
+
+
+# Stands in for FakeTimestamp when an event's time is already known, e.g. from a log record
+class FixedTimestamp:
+    def __init__(self, t):
+        self.t = t
+
+    def time(self):
+        return self.t
+
+
+#
+# -----------------------------------------------------------------------------------------
+#  Event sequences, with time between events
+#
+#  Each sequence is described by a "spec": a list of messages, each a list of compiled events that share one
+#  recipient and message_id. iter_events() plays a spec n times. Each message goes to a new fred.bloggs address,
+#  or to one from recipients() if given, which returns (rcpt_to, (rcpt_hash, rcpt_domain)), e.g. recipients.Sampler.
+# -----------------------------------------------------------------------------------------
+#
+def iter_events(ts, n, spec, recipients=None):
+    for i in range(0, n):
+        for message in spec:
+            if recipients is None:
+                rcpt_to, privacy = uniq_recip(), None
+            else:
+                rcpt_to, privacy = recipients()
+            uniq_msg_id = uniq_message_id()
+            MESSAGES.inc()
+            EVENTS.inc(len(message))
+            for event in message:
+                yield event(ts, rcpt_to, uniq_msg_id, privacy)
+
+
+# "successful" event sequence, open/click
+def success_events_spec(privacy):
+    msg_from = 'test@bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'big nice campaign'
+    subject = 'lovely test email'
+    geo_ip = {
+        'country': 'US',
+        'region': 'MD',
+        'city': 'Columbia',
+        'latitude': 39.1749,
+        'longitude': -76.8375,
+        'zip': 21046,
+        'postal_code': '21046',
+    }
+    sending_ip = '10.0.0.1' # example
+    user_agent_opens = 'Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)'
+    user_agent_click = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36'
+
+    # "successful" message sequence
+    return [[
+        ingest.compile_event('reception', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('delivery', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('initial_open', privacy, geo_ip=geo_ip, user_agent=user_agent_opens),
+        ingest.compile_event('open', privacy, geo_ip=geo_ip, user_agent=user_agent_opens),
+        ingest.compile_event('click', privacy, geo_ip=geo_ip, user_agent=user_agent_click),
+    ]]
+
+
+def iter_success_events_sequence(ts, n, privacy):
+    return iter_events(ts, n, success_events_spec(privacy))
+
+
+def make_success_events_sequence(ts, n, privacy):
+    return ''.join(iter_success_events_sequence(ts, n, privacy))
+
+
+# "successful" event sequence, AMP open/click
+def success_events_spec_amp(privacy):
+    msg_from = 'test@bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'big nice campaign'
+    subject = 'lovely test email'
+    geo_ip = {
+        'country': 'US',
+        'region': 'MD',
+        'city': 'Columbia',
+        'latitude': 39.1749,
+        'longitude': -76.8375,
+        'zip': 21046,
+        'postal_code': '21046',
+    }
+    sending_ip = '10.0.0.1' # example
+    user_agent_opens = 'Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)'
+    user_agent_click = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36'
+
+    # "successful" message sequence
+    return [[
+        ingest.compile_event('reception', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('delivery', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('amp_initial_open', privacy, geo_ip=geo_ip, user_agent=user_agent_opens),
+        ingest.compile_event('amp_open', privacy, geo_ip=geo_ip, user_agent=user_agent_opens),
+        ingest.compile_event('amp_click', privacy, geo_ip=geo_ip, user_agent=user_agent_click),
+    ]]
+
+
+def iter_success_events_sequence_amp(ts, n, privacy):
+    return iter_events(ts, n, success_events_spec_amp(privacy))
+
+
+def make_success_events_sequence_amp(ts, n, privacy):
+    return ''.join(iter_success_events_sequence_amp(ts, n, privacy))
+
+
+# "bounce" event sequence (in-band bounce), starting
+def bounce_events_spec(privacy):
+    msg_from = 'test@bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'big bouncy campaign'
+    subject = 'This email results in an in-band bounce'
+    sending_ip = '10.0.0.1' # example
+
+    # "bounce" message sequence
+    bounce_code = '554'
+    bounce_reason = 'smtp;554 5.7.1 Blacklisted by black.uribl.com Contact the postmaster of this domain for resolution.'
+    raw_reason = bounce_reason # no need to redact this type of reason code
+    bounce_class = '51'
+    return [[
+        ingest.compile_event('reception', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('inband', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip,
+            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason),
+    ]]
+
+
+def iter_bounce_events_sequence(ts, n, privacy):
+    return iter_events(ts, n, bounce_events_spec(privacy))
+
+
+def make_bounce_events_sequence(ts, n, privacy):
+    return ''.join(iter_bounce_events_sequence(ts, n, privacy))
+
+
+# "out of band" bounce event sequence, starting with injection + delivery
+def out_of_band_bounce_events_spec(privacy):
+    msg_from = 'test@oob-bounces.test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'out of band bouncy campaign'
+    subject = 'out of band bounce test email'
+    sending_ip = '10.0.0.1' # example
+
+    bounce_code = '550'
+    raw_reason = ingest.rcpt_text('SMTP;550 5.0.0 <{rcpt_to}>... User unknown')
+    bounce_reason = 'SMTP;550 5.0.0 ...@... ...' # redacted the email address for this type of reason code
+    bounce_class = '10'
+    return [[
+        ingest.compile_event('reception', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('delivery', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('outofband', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip,
+            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason),
+    ]]
+
+
+def iter_out_of_band_bounce_events_sequence(ts, n, privacy):
+    return iter_events(ts, n, out_of_band_bounce_events_spec(privacy))
+
+
+def make_out_of_band_bounce_events_sequence(ts, n, privacy):
+    return ''.join(iter_out_of_band_bounce_events_sequence(ts, n, privacy))
+
+
+# "spam_complaint" event sequence, starting with injection + delivery
+def spam_complaint_events_spec(privacy):
+    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'campaign that gets a spam complaint FBL'
+    subject = 'message that gets spam complaint FBL'
+    sending_ip = '10.0.0.1' # example
+
+    # Spam complaint message sequence, should have a corresponding injection & delivery
+    return [[
+        ingest.compile_event('reception', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('delivery', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('feedback', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+    ]]
+
+
+def iter_spam_complaint_events_sequence(ts, n, privacy):
+    return iter_events(ts, n, spam_complaint_events_spec(privacy))
+
+
+def make_spam_complaint_events_sequence(ts, n, privacy):
+    return ''.join(iter_spam_complaint_events_sequence(ts, n, privacy))
+
+
+# "delay" message sequence
+def delay_events_spec(privacy):
+    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'campaign that gets delayed'
+    subject = 'message that gets delayed'
+    sending_ip = '10.0.0.1' # example
+
+    bounce_code = '452'
+    raw_reason = 'smtp;452 4.2.2 Recipient Unable to accept message - mailbox full(c2mailmx101)'
+    bounce_reason = raw_reason
+    bounce_class = '22' # Mailbox full
+    return [[
+        ingest.compile_event('reception', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('tempfail', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip,
+            bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason),
+    ]]
+
+
+def iter_delay_events_sequence(ts, n, privacy):
+    return iter_events(ts, n, delay_events_spec(privacy))
+
+
+def make_delay_events_sequence(ts, n, privacy):
+    return ''.join(iter_delay_events_sequence(ts, n, privacy))
+
+
+# "rejection" message sequences of various kinds
+def rejection_events_spec(privacy):
+    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'campaign-rejections'
+    sending_ip = '10.0.0.1' # example
+
+    # SMTP Policy rejections have a message_id but do not log a corresponding injection event on SparkPost
+    subject = 'message that gets policy rejection (smtp)'
+    bounce_class = '25' # "Admin Failure"
+    bounce_code = '550'
+    raw_reason = '550 5.7.1 Unconfigured Sending Domain'
+    bounce_reason = raw_reason
+    policy_rejection = ingest.compile_event('rejection', privacy,
+        msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip,
+        bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
+
+    # REST Generation Rejections do not log a corresponding injection event on SparkPost
+    subject = 'message that gets generation rejection (rest)'
+    bounce_class = '25' # "Admin Failure"
+    bounce_code = '550'
+    raw_reason = '550 5.6.0 No Sending Domain found in From header'
+    bounce_reason = raw_reason
+    generation_rejection = ingest.compile_event('gen_rejection', privacy,
+        msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip,
+        bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
+
+    # REST Generation Failures do not log a corresponding injection event on SparkPost
+    bounce_code = '554'
+    raw_reason = '554 5.3.3 [internal] Error while rendering part html: line 1: substitution value \'myvar\' did not exist or was null'
+    bounce_reason = raw_reason
+    generation_failure = ingest.compile_event('gen_fail', privacy,
+        msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip,
+        bounce_code=bounce_code, bounce_reason=bounce_reason, bounce_class=bounce_class, raw_reason=raw_reason)
+
+    # each one is a separate message, with its own recipient
+    return [[policy_rejection], [generation_rejection], [generation_failure]]
+
+
+def iter_rejection_events_sequence(ts, n, privacy):
+    return iter_events(ts, n, rejection_events_spec(privacy))
+
+
+def make_rejection_events_sequence(ts, n, privacy):
+    return ''.join(iter_rejection_events_sequence(ts, n, privacy))
+
+
+# "unsubscribe" message sequences of various kinds
+def unsubscribe_events_spec(privacy):
+    msg_from = 'test@test.sparkpost.com' # aka Envelope From, Return-Path: address
+    friendly_from = 'sp-event-agent@test.sparkpost.com'
+    campaign_id = 'campaign-unsubscribe'
+    sending_ip = '10.0.0.1' # example
+    subject = 'message that gets unsubscribed'
+    user_agent_click = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36'
+
+    return [[
+        ingest.compile_event('reception', privacy,
+            msg_from=msg_from, friendly_from=friendly_from, campaign_id=campaign_id, subject=subject, sending_ip=sending_ip),
+        ingest.compile_event('link', privacy, user_agent=user_agent_click),
+        ingest.compile_event('list', privacy, user_agent=user_agent_click),
+    ]]
+
+
+def iter_unsubscribe_events_sequence(ts, n, privacy):
+    return iter_events(ts, n, unsubscribe_events_spec(privacy))
+
+
+def make_unsubscribe_events_sequence(ts, n, privacy):
+    return ''.join(iter_unsubscribe_events_sequence(ts, n, privacy))
+
+
+# Sequences by name, for choosing one from the command line or passing to worker processes
+SEQUENCES = {
+    'success': success_events_spec,
+    'success_amp': success_events_spec_amp,
+    'bounce': bounce_events_spec,
+    'out_of_band_bounce': out_of_band_bounce_events_spec,
+    'spam_complaint': spam_complaint_events_spec,
+    'delay': delay_events_spec,
+    'rejection': rejection_events_spec,
+    'unsubscribe': unsubscribe_events_spec,
+}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+#
+# Command line entry point, with a subcommand for each job:
+#
+#   generate        write event sequences as NDJSON (gzip if the output file name ends .gz)
+#   send            generate event sequences and upload them, or send the ingest error-path test batches
+#   replay          upload the events from an NDJSON or NDJSON.gz file
+#   drain           upload the batches left in a spool directory by an earlier send --spool
+#   load            send at a target rate (see load.py)
+#   pmta            convert PowerMTA accounting files and upload them (see pmta.py)
+#   check-failures  fetch batch failure records (see chk_batch_failures.py)
+#   docs            print the ingest event documentation as CSV (see event_docs.py)
+#   compress        compare compression backends and levels (see compress.py)
+#
+# Modules are imported by the subcommand that needs them, so e.g. generating offline doesn't load requests.
+#
+
+from __future__ import print_function
+import argparse, logging, sys, time
+import metrics
+
+# Subcommands that are run by another module's main(), with the rest of the command line
+DELEGATED = {
+    'load': ('load', 'send at a target rate'),
+    'pmta': ('pmta', 'convert PowerMTA accounting files and upload them'),
+    'check-failures': ('chk_batch_failures', 'fetch batch failure records'),
+    'docs': ('event_docs', 'print the ingest event documentation as CSV'),
+    'compress': ('compress', 'compare compression backends and levels'),
+}
+
+
+def add_sequence_args(p):
+    import sequences
+    p.add_argument('-s', '--sequence', help='Event sequence (default success)', choices=sorted(sequences.SEQUENCES), default='success')
+    p.add_argument('-n', '--messages', help='Number of times to play the sequence (default 1)', type=int, default=1)
+    p.add_argument('--naptime', help='Seconds between event timestamps (default 2)', type=float, default=2)
+    p.add_argument('--no-privacy', help='Send rcpt_to rather than rcpt_hash', action='store_true')
+    p.add_argument('--seed', help='Seed for event and message IDs, for repeatable output', type=int)
+    p.add_argument('--recipients', help='Send to addresses from this file, one per line (see recipients.py), rather than new ones')
+    p.add_argument('--skew', help='With --recipients, Zipf exponent of recipient activity (default 1; 0 is uniform)', type=float, default=1.0)
+    p.add_argument('--repeat', help='With --recipients, chance of a recently drawn recipient again (default 0.2)', type=float, default=0.2)
+    p.add_argument('-P', '--processes', help='Generate on this many worker processes (default 1, i.e. none)', type=int, default=1)
+    p.add_argument('--engine', help='Event generator (default sequences; columnar builds blocks of messages with NumPy)',
+                   choices=['sequences', 'columnar'], default='sequences')
+
+
+def add_upload_args(p):
+    p.add_argument('-w', '--workers', help='Uploads in flight at once (default 4)', type=int, default=4)
+    p.add_argument('-j', '--journal', help='Journal file of accepted batches, so a rerun skips them')
+    p.add_argument('--dedup', help='Index file of accepted events and batches, so any later run skips them (replaces --journal)')
+    p.add_argument('--validate', help='Check events against the ingest documentation before upload', action='store_true')
+    p.add_argument('--quarantine', help='With --validate, write invalid events to this file')
+    p.add_argument('-z', '--level', help='gzip compression level, 1 (fastest) to 9 (smallest, the default)', type=int, default=9,
+                   choices=range(1, 10), metavar='{1..9}')
+    p.add_argument('--compress', help='Compression backend (default gzip; parallel compresses chunks on a thread per CPU)',
+                   choices=['gzip', 'parallel'], default='gzip')
+    metrics.add_args(p)
+
+
+def naptime(args):
+    return int(args.naptime) if args.naptime == int(args.naptime) else args.naptime
+
+
+# Generator: NDJSON lines for the sequence given on the command line. Timestamps start ten minutes back, as
+# send_to_ingest.py does, to allow for events spread apart in time.
+def sequence_events(args):
+    if args.engine == 'columnar':
+        return columnar_events(args)
+    import ingest, sequences
+    if args.seed is not None:
+        ingest.seed_ids(args.seed)
+    ts = sequences.FakeTimestamp(int(time.time()) - 10*60, naptime(args))
+    sampler = None
+    if args.recipients:
+        import recipients
+        sampler = recipients.RecipientPool(args.recipients).sampler(skew=args.skew, repeat=args.repeat, seed=args.seed)
+    return sequences.iter_events(ts, args.messages, sequences.SEQUENCES[args.sequence](not args.no_privacy), sampler)
+
+
+# As sequence_events(), with columnar.ColumnarGenerator
+def columnar_events(args):
+    if args.recipients:
+        sys.exit('--recipients can\'t be used with --engine columnar')
+    import columnar
+    gen = columnar.ColumnarGenerator(args.sequence, not args.no_privacy, int(time.time()) - 10*60, naptime(args),
+                                     seed=args.seed)
+    return gen.lines(args.messages)
+
+
+# Generator: gzip batches of the sequence given on the command line, generated on args.processes worker processes
+# (see parallel.py). limits are passed to batch.BatchBuilder. Options that need every event in this process can't be
+# used with it.
+def parallel_batches(args, **limits):
+    import parallel
+    if args.engine != 'sequences':
+        sys.exit('--engine {} can\'t be used with --processes'.format(args.engine))
+    for option in ('recipients', 'validate', 'dedup'):
+        if getattr(args, option, None):
+            sys.exit('--{} can\'t be used with --processes'.format(option))
+    return parallel.generate_batches(args.sequence, args.messages, not args.no_privacy, int(time.time()) - 10*60,
+                                     naptime(args), args.processes, seed=args.seed, **limits)
+
+
+def upload(args, lines):
+    import ingest, schema, compress, send_to_ingest
+    url, hdrs = ingest.ingest_from_env()
+    validator = schema.load_schema() if args.validate else None
+    return send_to_ingest.send_events(url, hdrs, lines, compress.make_builder(args.compress, args.level), args.workers,
+                                      args.journal, validator, args.quarantine, args.dedup, args.spool)
+
+
+def cmd_generate(args):
+    if args.processes > 1:
+        return generate_parallel(args)
+    out = sys.stdout
+    if args.output != '-':
+        if args.output.endswith('.gz'):
+            import gzip
+            out = gzip.open(args.output, 'wt', encoding='utf-8')
+        else:
+            out = open(args.output, 'w')
+    for line in sequence_events(args):
+        out.write(line)
+    if out is not sys.stdout:
+        out.close()
+
+
+# The batches come back as gzip, so they are written as they are to a .gz file (as a multi-member gzip stream)
+def generate_parallel(args):
+    batches = parallel_batches(args)
+    if args.output.endswith('.gz'):
+        with open(args.output, 'wb') as out:
+            for b in batches:
+                out.write(b.payload)
+        return
+    import gzip
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    for b in batches:
+        out.write(gzip.decompress(b.payload))
+    if out is not sys.stdout.buffer:
+        out.close()
+
+
+def cmd_send(args):
+    with metrics.from_args(args):
+        if args.test_batches:
+            import ingest, send_to_ingest
+            url, hdrs = ingest.ingest_from_env()
+            send_to_ingest.send_test_batches(url, hdrs, not args.no_privacy)
+        elif args.processes > 1:
+            import ingest, send_to_ingest
+            if args.compress != 'gzip':
+                sys.exit('--compress {} can\'t be used with --processes'.format(args.compress))
+            url, hdrs = ingest.ingest_from_env()
+            if not send_to_ingest.send_batches(url, hdrs, parallel_batches(args, level=args.level), args.workers,
+                                               args.journal, spool_path=args.spool):
+                sys.exit(1)
+        elif not upload(args, sequence_events(args)):
+            sys.exit(1)
+
+
+def cmd_replay(args):
+    import ingest, schema, compress, replay
+    url, hdrs = ingest.ingest_from_env()
+    validator = schema.load_schema() if args.validate else None
+    with metrics.from_args(args):
+        offset, ok = replay.replay(url, hdrs, args.file, args.offset, args.restamp, args.progress, args.workers,
+                                   args.journal, validator, args.quarantine,
+                                   compress.make_builder(args.compress, args.level), args.dedup)
+    if not ok:
+        sys.exit(1)
+
+
+def cmd_drain(args):
+    import ingest, journal, spool
+    url, hdrs = ingest.ingest_from_env()
+    j = journal.UploadJournal(args.journal) if args.journal else None
+    with metrics.from_args(args), spool.Spool(args.spool) as s:
+        s.finish()                              # nothing more is coming
+        ok = spool.drain(url, hdrs, s, args.workers, j)
+    if j is not None:
+        j.close()
+    if not ok:
+        sys.exit(1)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')     # to stderr
+    if argv and argv[0] in DELEGATED:
+        module = __import__(DELEGATED[argv[0]][0])
+        sys.argv[0] = '{} {}'.format(sys.argv[0], argv[0])      # so usage messages show the subcommand
+        return module.main(argv[1:])
+
+    parser = argparse.ArgumentParser(description='Generate and send events to the SparkPost ingest API')
+    sub = parser.add_subparsers(dest='command', metavar='command')
+    sub.required = True
+
+    p = sub.add_parser('generate', help='write event sequences as NDJSON')
+    add_sequence_args(p)
+    p.add_argument('-o', '--output', help='Output file, gzip if it ends .gz ("-" for stdout, the default)', default='-')
+    p.set_defaults(fn=cmd_generate)
+
+    p = sub.add_parser('send', help='generate event sequences and upload them')
+    add_sequence_args(p)
+    add_upload_args(p)
+    p.add_argument('--test-batches', help='Send the ingest error-path test batches instead, as send_to_ingest.py does', action='store_true')
+    p.add_argument('--spool', help='Spool batches in this directory, so building them isn\'t held up by uploads; "drain" sends any left over')
+    p.set_defaults(fn=cmd_send)
+
+    p = sub.add_parser('replay', help='upload the events from an NDJSON or NDJSON.gz file')
+    p.add_argument('file', help='NDJSON file, optionally gzip compressed')
+    add_upload_args(p)
+    p.add_argument('--restamp', help='Give events new event_ids and move their timestamps up to now', action='store_true')
+    p.add_argument('-p', '--progress', help='Save the offset reached to this file, and resume from it')
+    p.add_argument('--offset', help='Start at this byte offset (uncompressed, for gzip files)', type=int)
+    p.set_defaults(fn=cmd_replay)
+
+    p = sub.add_parser('drain', help='upload the batches left in a spool directory')
+    p.add_argument('spool', help='Spool directory, as given to send --spool')
+    p.add_argument('-w', '--workers', help='Uploads in flight at once (default 4)', type=int, default=4)
+    p.add_argument('-j', '--journal', help='Journal file of accepted batches, so a rerun skips them')
+    metrics.add_args(p)
+    p.set_defaults(fn=cmd_drain)
+
+    for name, (module, help) in DELEGATED.items():
+        sub.add_parser(name, help=help + ' (see {}.py --help)'.format(module), add_help=False)
+
+    args = parser.parse_args(argv)
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
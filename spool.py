@@ -0,0 +1,355 @@
+#
+# Durable on-disk spool for finished gzip batches, between batch building and uploading.
+#
+# When the ingest API is slower than generation, batches are written to segment files in the spool directory rather
+# than held in memory, and the uploader reads them back in order. Each record is framed as
+#
+#   payload length, CRC-32 of payload, events, uncompressed size    (4 x uint32, little-endian)
+#   payload
+#
+# so a record torn by a crash is recognised and skipped. The position up to which every batch has been accepted
+# (2xx) is saved to ack.json, replaced atomically, and segments wholly before it are deleted. A restarted uploader
+# carries on from there without regenerating anything (see drain(), or "sparky.py drain").
+#
+# fsync policy for segments and the ack file:
+#   always      after every record and ack; nothing is lost in a crash, at the cost of a disk flush per batch
+#   interval    at most every fsync_interval seconds, and on rotating or closing a segment. The ack file is saved
+#               (and synced) at most that often too, and on closing, so a crash may resend the last second of batches
+#               (which an upload journal will skip).
+#   never       left to the OS
+#
+# Once max_bytes of batches are waiting to be read, put() blocks until uploads catch up, so the spool can't fill the
+# disk (batches read but not yet accepted, at most the uploader's in-flight window, come on top). If uploads have
+# stopped (see stop_reading), put() carries on spooling up to max_bytes, then gives up.
+#
+
+import collections, json, os, struct, threading, time, weakref, zlib
+import batch, uploader, journal, metrics
+
+HEADER = struct.Struct('<IIII')
+ACK_FILE = 'ack.json'
+REJECTED_FILE = 'rejected.spool'                # batches the ingest API refused outright, kept for inspection
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+SPOOL_BYTES = metrics.gauge('sparky_spool_bytes', 'Bytes of batches in the spool waiting to be accepted')
+SPOOLED = metrics.counter('sparky_spooled_batches_total', 'Batches written to the spool')
+
+_open_spools = weakref.WeakSet()
+
+
+def _spooled_bytes():
+    return sum(s.pending_bytes for s in list(_open_spools))
+
+
+SPOOL_BYTES.set_function(_spooled_bytes)
+
+
+def segment_name(n):
+    return 'seg-{:08d}.spool'.format(n)
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return                                  # e.g. on Windows, directories can't be opened
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _record(b):
+    return HEADER.pack(len(b.payload), zlib.crc32(b.payload), b.events, b.size) + b.payload
+
+
+# Returns (Batch, end offset) for the record at offset in an open segment file, or None if it is torn or corrupt
+def _read_record(f, offset):
+    f.seek(offset)
+    h = f.read(HEADER.size)
+    if len(h) < HEADER.size:
+        return None
+    length, crc, events, size = HEADER.unpack(h)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        return None
+    return batch.Batch(payload, events, size), offset + HEADER.size + length
+
+
+class Spool:
+    def __init__(self, path, max_bytes=1024 ** 3, segment_bytes=64 * 1024 * 1024, fsync='interval', fsync_interval=1.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('fsync policy must be one of {}'.format(', '.join(FSYNC_POLICIES)))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        os.makedirs(path, exist_ok=True)
+        self._cond = threading.Condition()
+        segments = sorted(int(f[4:-6]) for f in os.listdir(path) if f.startswith('seg-') and f.endswith('.spool'))
+        self._acked = self._read_ack() or ((segments[0] if segments else 1), 0)
+        self._saved = self._acked               # position last saved to the ack file
+        self._ack_synced = time.monotonic()
+        self._read = self._acked                # position after the last batch given out by batches()
+        self._sizes = {}                        # segment number -> bytes that can be read from it
+        for n in segments:
+            name = os.path.join(path, segment_name(n))
+            if n < self._acked[0] or (n == self._acked[0] and self._acked[1] >= os.path.getsize(name)):
+                os.remove(name)                 # wholly accepted
+            else:
+                self._sizes[n] = os.path.getsize(name)
+        # Writing starts a new segment, rather than appending after a record that may have been torn
+        self._wseg = max([self._acked[0]] + segments) + 1
+        self._wsize = 0
+        self._w = None
+        self._synced = time.monotonic()
+        self._finished = False                  # no more batches will be put
+        self._stopped = False                   # put() and batches() give up
+        self._reading = True                    # batches() is or may be being read, so space may be freed
+        _open_spools.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_ack(self):
+        try:
+            with open(os.path.join(self.path, ACK_FILE)) as f:
+                a = json.load(f)
+            return a['segment'], a['offset']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    # Bytes of batches from position on
+    def _bytes_from(self, position):
+        seg, off = position
+        return sum(size for n, size in self._sizes.items() if n >= seg) - (off if seg in self._sizes else 0)
+
+    # True once stop() has been called
+    @property
+    def stopped(self):
+        return self._stopped
+
+    # Bytes of batches waiting to be accepted. Safe to read from any thread, e.g. for the metrics.
+    @property
+    def pending_bytes(self):
+        with self._cond:
+            return self._bytes_from(self._acked)
+
+    def _sync(self, force=False):
+        if self._w is None or self.fsync == 'never':
+            return
+        now = time.monotonic()
+        if force or self.fsync == 'always' or now - self._synced >= self.fsync_interval:
+            os.fsync(self._w.fileno())
+            self._synced = now
+
+    def _rotate(self):
+        if self._w is not None:
+            self._sync(force=True)
+            self._w.close()
+            self._wseg += 1
+        self._w = open(os.path.join(self.path, segment_name(self._wseg)), 'ab')
+        self._wsize = 0
+        self._sizes[self._wseg] = 0
+        if self.fsync != 'never':
+            _fsync_dir(self.path)
+
+    # Append a batch.Batch, blocking while the spool is full. Returns False if the spool was stopped instead, or is
+    # full with nothing reading it.
+    def put(self, b):
+        rec = _record(b)
+        with self._cond:
+            while not self._stopped:
+                unread = self._bytes_from(self._read)
+                if unread == 0 or unread + len(rec) <= self.max_bytes:
+                    break
+                if not self._reading:
+                    return False
+                self._cond.wait()
+            if self._stopped:
+                return False
+            if self._w is None or (self._wsize > 0 and self._wsize + len(rec) > self.segment_bytes):
+                self._rotate()
+            self._w.write(rec)
+            self._w.flush()                     # so the reader's file handle sees it
+            self._sync()
+            self._wsize += len(rec)
+            self._sizes[self._wseg] = self._wsize
+            SPOOLED.inc()
+            self._cond.notify_all()
+        return True
+
+    # No more batches will be put; batches() ends once it has read them all
+    def finish(self):
+        with self._cond:
+            self._finished = True
+            if self._w is not None:
+                self._sync(force=True)
+            self._cond.notify_all()
+
+    # Make put() and batches() return, e.g. on closing
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    # Make batches() return, while put() carries on spooling, e.g. when uploads have failed and the rest is left for
+    # a later run
+    def stop_reading(self):
+        with self._cond:
+            self._reading = False
+            self._cond.notify_all()
+
+    # Generator: (Batch, position) for each batch from the last acknowledged one on, in order, waiting for more to be
+    # put until finish() or stop(). Give the position to ack() once the batch is accepted.
+    def batches(self):
+        seg, off = self._acked
+        f = None
+        try:
+            while True:
+                with self._cond:
+                    while True:
+                        if self._stopped or not self._reading:
+                            return
+                        size = self._sizes.get(seg)
+                        if size is not None and off < size:
+                            break
+                        later = [n for n in self._sizes if n > seg]
+                        if later and (size is None or seg != self._wseg or self._w is None):
+                            seg, off = min(later), 0            # this segment is done with
+                            if f is not None:
+                                f.close()
+                                f = None
+                            continue
+                        if self._finished:
+                            return
+                        self._cond.wait()
+                    active = seg == self._wseg and self._w is not None
+                if f is None:
+                    f = open(os.path.join(self.path, segment_name(seg)), 'rb')
+                r = _read_record(f, off)
+                if r is None:
+                    if active:
+                        raise IOError('Spool segment {} is corrupt at offset {}'.format(segment_name(seg), off))
+                    with self._cond:                # a record torn by a crash: the rest of the segment is lost
+                        self._sizes[seg] = off
+                    continue
+                b, off = r
+                with self._cond:
+                    self._read = max(self._read, (seg, off))
+                    self._cond.notify_all()
+                yield b, (seg, off)
+        finally:
+            if f is not None:
+                f.close()
+
+    # Record that every batch up to and including the one at position has been accepted
+    def ack(self, position):
+        with self._cond:
+            self._acked = position
+            self._save_ack()
+            self._cond.notify_all()
+
+    # Save the acknowledged position to the ack file as the fsync policy allows (or now, if forced), then delete the
+    # segments wholly before it. Segments are only deleted once the ack file no longer refers to them. Called with
+    # _cond held.
+    def _save_ack(self, force=False):
+        if self._saved == self._acked:
+            return
+        now = time.monotonic()
+        if not force and self.fsync == 'interval' and now - self._ack_synced < self.fsync_interval:
+            return
+        seg, off = self._acked
+        tmp = os.path.join(self.path, ACK_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'segment': seg, 'offset': off}, f)
+            if self.fsync != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, ACK_FILE))
+        self._saved = self._acked
+        self._ack_synced = now
+        for n in [n for n in self._sizes if n < seg]:
+            del self._sizes[n]
+            os.remove(os.path.join(self.path, segment_name(n)))
+
+    # Keep a batch the ingest API refused outright, so acknowledging it doesn't lose it
+    def reject(self, b):
+        with open(os.path.join(self.path, REJECTED_FILE), 'ab') as f:
+            f.write(_record(b))
+
+    def close(self):
+        self.stop()
+        _open_spools.discard(self)
+        with self._cond:
+            self._save_ack(force=True)
+            if self._w is not None:
+                self._sync(force=True)
+                self._w.close()
+                self._w = None
+
+
+# Upload the batches in a spool, acknowledging each one once it and every batch before it are accepted. Batches the
+# API refuses outright (4xx other than 429) are set aside in rejected.spool and acknowledged, as resending them can't
+# help. If a batch still fails after the uploader's retries, reading the spool stops, leaving it and the rest for a
+# later run. Returns True if everything read was accepted or set aside.
+def drain(url, hdrs, spool, workers=4, j=None):
+    marks = collections.deque()                 # (batch, position) of batches not yet answered, in order
+    def payloads():
+        for b, position in spool.batches():
+            marks.append((b, position))
+            yield b
+    ok = True
+    with uploader.BatchUploader(url, hdrs, workers=workers, journal=j) as up:
+        for r in up.upload(payloads()):
+            print('Batch {}: {} {}'.format(r.seq, r.status_code, r.content))
+            b, position = marks.popleft()
+            if r.batch_id is None and r.status_code is not None and 400 <= r.status_code < 500 and r.status_code != 429:
+                spool.reject(b)
+            elif r.batch_id is None:
+                if ok:
+                    print('Stopping uploads; batches from {} on are left in the spool'.format(r.seq))
+                    spool.stop_reading()
+                ok = False
+            if ok:
+                spool.ack(position)
+    return ok
+
+
+# Upload batches through a spool at spool_path: batches are written to the spool as fast as they are made, on a
+# separate thread, while the uploader drains it. Anything not accepted is left in the spool for drain() to send; if
+# uploads fail, the rest of the batches are still spooled, up to the spool's max_bytes. Returns True if every batch
+# was spooled and accepted.
+def spooled_upload(url, hdrs, batches, spool_path, workers=4, journal_path=None, j=None, **spool_options):
+    opened = j is None and journal_path
+    if opened:
+        j = journal.UploadJournal(journal_path)
+    errors = []
+    complete = []                               # False if batches were left unspooled
+    with Spool(spool_path, **spool_options) as spool:
+        def produce():
+            try:
+                for b in batches:
+                    if not spool.put(b):
+                        if not spool.stopped:
+                            print('Spool {} is full with uploads stopped; the remaining batches were not spooled'.format(spool_path))
+                            complete.append(False)
+                        break
+            except Exception as e:
+                errors.append(e)
+                spool.stop()
+            finally:
+                spool.finish()
+        t = threading.Thread(target=produce, daemon=True)
+        t.start()
+        ok = drain(url, hdrs, spool, workers, j)
+        t.join()                                # after a failure, until the rest is spooled
+    if opened:
+        j.close()
+    if errors:
+        raise errors[0]
+    return ok and all(complete)
@@ -0,0 +1,7 @@
+#
+# The modules live at the top of the repo rather than in a package, so put it on the path for the tests
+#
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
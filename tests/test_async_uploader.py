@@ -0,0 +1,67 @@
+#
+# async_uploader.AsyncIngestClient against a local mock_ingest server
+#
+
+import asyncio
+import pytest
+pytest.importorskip('aiohttp')
+import async_uploader, batch, ingest, journal, mock_ingest, uploader
+from uploader import RetryPolicy
+
+
+def batches(n, events=10):
+    lines = ['{"msys": {"message_event": {"type": "delivery", "event_id": "%d", "timestamp": "1"}}}\n' % i
+             for i in range(n * events)]
+    return list(batch.BatchBuilder(max_events=events).batches(lines))
+
+
+@pytest.fixture
+def server():
+    with mock_ingest.MockIngestServer(rate_5xx=0.3, seed=1).start() as s:
+        yield s
+
+
+def upload_all(server, payloads, **kwargs):
+    return asyncio.run(async_uploader.upload_all(ingest.ingest_url(server.url), ingest.ingest_hdrs('test'), payloads,
+                                                 concurrency=4, retry=RetryPolicy(max_retries=20, backoff=0.01),
+                                                 **kwargs))
+
+
+def test_results_in_order_with_retries(server):
+    seen = []
+    events = uploader.EVENTS_UPLOADED.get()
+    retries = uploader.RETRIES.get()
+    results = upload_all(server, batches(30), on_result=seen.append)
+    assert [r.seq for r in results] == list(range(30))
+    assert all(r.batch_id for r in results)
+    assert sorted(r.seq for r in seen) == list(range(30))
+    assert uploader.EVENTS_UPLOADED.get() - events == 300
+    assert uploader.RETRIES.get() - retries == sum(r.attempts - 1 for r in results) > 0
+    assert server.stats['batches'] == 30 and server.stats['events'] == 300
+
+
+def test_journal_skips_accepted_batches(server, tmp_path):
+    payloads = batches(5)
+    with journal.UploadJournal(str(tmp_path / 'journal')) as j:
+        assert all(r.attempts >= 1 for r in upload_all(server, payloads, journal=j))
+    with journal.UploadJournal(str(tmp_path / 'journal')) as j:
+        assert [r.attempts for r in upload_all(server, payloads, journal=j)] == [0] * 5
+
+
+# A failing callback is logged, and the workers carry on
+def test_on_result_errors_dont_stop_the_workers(server):
+    def fail(r):
+        raise RuntimeError('callback')
+    assert len(upload_all(server, batches(20), on_result=fail, queue_size=1)) == 20
+
+
+def test_client_keeps_no_results(server):
+    async def run():
+        got = []
+        async with async_uploader.AsyncIngestClient(ingest.ingest_url(server.url), ingest.ingest_hdrs('test'),
+                                                    on_result=got.append) as client:
+            for b in batches(3):
+                await client.put(b)
+        return client, got
+    client, got = asyncio.run(run())
+    assert len(got) == 3 and not hasattr(client, 'results')
@@ -0,0 +1,46 @@
+#
+# batch.BatchBuilder
+#
+
+import gzip, random
+import pytest
+import batch
+
+
+# Event-like lines that compress about 2:1, so a batch holds a few hundred KB of them
+def lines(n, seed=1):
+    rnd = random.Random(seed)
+    return ['{"x": "%0200x"}\n' % rnd.getrandbits(800) for _ in range(n)]
+
+
+def test_batches_keep_every_line_in_order():
+    src = lines(5000)
+    out = list(batch.BatchBuilder(max_compressed=100000).batches(src))
+    assert len(out) > 1
+    assert b''.join(gzip.decompress(b.payload) for b in out) == ''.join(src).encode()
+    assert sum(b.events for b in out) == len(src)
+
+
+def test_batches_stay_under_max_compressed():
+    for limit in (20000, 200000):
+        for b in batch.BatchBuilder(max_compressed=limit).batches(lines(20000)):
+            assert len(b.payload) <= limit
+
+
+# A limit below the default sync_interval used to leave the compressor unflushed, so batches closed at a few % full
+def test_batches_fill_most_of_max_compressed():
+    for limit in (20000, 200000, 1000000):
+        out = list(batch.BatchBuilder(max_compressed=limit).batches(lines(20000)))
+        assert len(out) > 1
+        for b in out[:-1]:
+            assert len(b.payload) > 0.75 * limit
+
+
+def test_max_events():
+    out = list(batch.BatchBuilder(max_events=7).batches(lines(50)))
+    assert [b.events for b in out] == [7] * 7 + [1]
+
+
+def test_event_too_large_for_any_batch():
+    with pytest.raises(ValueError):
+        batch.BatchBuilder(max_uncompressed=100).add('x' * 200)
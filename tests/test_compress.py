@@ -0,0 +1,36 @@
+#
+# compress.parallel_compress and compress.ParallelBatchBuilder
+#
+
+import gzip, random
+import compress
+
+
+# Event-like lines that compress about 2:1
+def lines(n, seed=1):
+    rnd = random.Random(seed)
+    return ['{"x": "%0200x"}\n' % rnd.getrandbits(800) for _ in range(n)]
+
+
+def test_parallel_compress_is_multi_member_gzip_of_the_data():
+    data = ''.join(lines(3000)).encode()
+    out = compress.parallel_compress(data, chunk_size=100000)
+    assert out.count(b'\x1f\x8b\x08') >= len(data) // 100000
+    assert gzip.decompress(out) == data
+
+
+def test_batches_keep_every_line_in_order():
+    src = lines(5000)
+    out = list(compress.ParallelBatchBuilder(max_compressed=100000).batches(src))
+    assert len(out) > 1
+    assert b''.join(gzip.decompress(b.payload) for b in out) == ''.join(src).encode()
+    assert sum(b.events for b in out) == len(src)
+
+
+# With member_size over the limit, every batch used to close at its first settle, a few % full
+def test_batches_fill_most_of_max_compressed():
+    for limit in (20000, 200000, 1000000):
+        out = list(compress.ParallelBatchBuilder(max_compressed=limit).batches(lines(20000)))
+        assert len(out) > 1
+        for b in out[:-1]:
+            assert 0.7 * limit < len(b.payload) <= limit
@@ -0,0 +1,81 @@
+#
+# dedup.DedupIndex and DedupBuilder
+#
+
+import gzip
+import pytest
+import dedup, batch, ingest, mock_ingest, uploader
+from journal import payload_digest
+
+
+def event(i, pad=''):
+    return '{"msys": {"message_event": {"type": "delivery", "event_id": "%d", "timestamp": "1"%s}}}\n' % (i, pad)
+
+
+def events_in(batches):
+    return [line for b in batches for line in gzip.decompress(b.payload).decode().splitlines(keepends=True)]
+
+
+# Upload stand-in: record every batch as accepted, as uploader.BatchUploader does through its journal
+def accept(index, batches):
+    for b in batches:
+        index.record(payload_digest(b), 'batch-{}'.format(b.events))
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'dedup.sqlite')
+
+
+def test_skips_repeats_within_a_run(path):
+    with dedup.DedupIndex(path) as index:
+        lines = [event(i) for i in range(10)] * 2
+        out = list(index.builder(batch.BatchBuilder(max_events=4)).batches(lines))
+        assert events_in(out) == lines[:10]
+        assert index.skipped == 10
+
+
+def test_skips_events_accepted_by_an_earlier_run(path):
+    with dedup.DedupIndex(path) as index:
+        accept(index, index.builder().batches([event(i) for i in range(100)]))
+    with dedup.DedupIndex(path) as index:
+        out = list(index.builder().batches([event(i) for i in range(50, 150)]))
+        assert events_in(out) == [event(i) for i in range(100, 150)]
+        assert index.skipped == 50
+        assert len(index) == 1
+
+
+# Events in a batch that wasn't accepted are held back for the rest of the run, but sent again by the next one
+def test_rejected_batch_is_sent_again_next_run(path):
+    lines = [event(i) for i in range(20)]
+    with dedup.DedupIndex(path) as index:
+        builder = index.builder(batch.BatchBuilder(max_events=10))
+        first, second = builder.batches(lines)
+        accept(index, [first])                  # the second batch is refused
+        assert list(index.builder().batches(lines)) == []
+    with dedup.DedupIndex(path) as index:
+        assert events_in(index.builder().batches(lines)) == lines[10:]
+
+
+# An event the batch builder refuses isn't marked as sent, so it isn't skipped as a duplicate later
+def test_oversized_event_is_not_marked_seen(path):
+    with dedup.DedupIndex(path) as index:
+        builder = index.builder(batch.BatchBuilder(max_uncompressed=200))
+        big = event(7, ', "pad": "' + 'x' * 500 + '"')
+        with pytest.raises(ValueError):
+            builder.add(big)
+        assert not index.seen(dedup.line_key(big))
+        assert events_in(index.builder().batches([event(7)])) == [event(7)]
+
+
+# As the uploader's journal: batches accepted by one run aren't sent by the next
+def test_as_uploader_journal(path):
+    lines = [event(i) for i in range(30)]
+    with mock_ingest.MockIngestServer().start() as server:
+        url, hdrs = ingest.ingest_url(server.url), ingest.ingest_hdrs('test')
+        for run in range(2):
+            with dedup.DedupIndex(path) as index, uploader.BatchUploader(url, hdrs, journal=index) as up:
+                results = list(up.upload(index.builder(batch.BatchBuilder(max_events=10)).batches(lines)))
+                assert all(r.batch_id for r in results)
+                assert len(results) == (3 if run == 0 else 0)
+        assert server.stats['batches'] == 3
@@ -0,0 +1,115 @@
+#
+# The make_*_event builders against golden output from the original hand-written builders, which built each event as
+# a dict and called json.dumps on it. data/golden_events.json was made with those builders, from the first commit in
+# this repo; the compiled templates must match it byte for byte.
+#
+
+import inspect, json, os
+import pytest
+import ingest
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'golden_events.json')
+
+BUILDERS = [
+    'make_injection_event', 'make_delivery_event', 'make_initial_open_event', 'make_open_event', 'make_click_event',
+    'make_amp_initial_open_event', 'make_amp_open_event', 'make_amp_click_event', 'make_bounce_event',
+    'make_out_of_band_bounce_event', 'make_spam_complaint_event', 'make_delay_event', 'make_policy_rejection_event',
+    'make_generation_rejection_event', 'make_generation_failure_event', 'make_link_unsubscribe_event',
+    'make_list_unsubscribe_event',
+]
+
+EVENT_ID = '4611686018427387903'
+
+
+class Timestamp:
+    def __init__(self, t):
+        self.t = t
+
+    def time(self):
+        return self.t
+
+
+PLAIN = {
+    'ts': 1600000000,
+    'rcpt_to': 'fred.bloggs123456789012@ingest.thetucks.com',
+    'uniq_msg_id': '0000a00dcc624c882e80',
+    'msg_from': 'test@bounces.test.sparkpost.com',
+    'friendly_from': 'sp-event-agent@test.sparkpost.com',
+    'campaign_id': 'big nice campaign',
+    'subject': 'lovely test email',
+    'sending_ip': '10.0.0.1',
+    'geo_ip': {'country': 'US', 'region': 'MD', 'city': 'Columbia', 'latitude': 39.1749, 'longitude': -76.8375,
+               'zip': 21046, 'postal_code': '21046'},
+    'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
+    'bounce_code': '554',
+    'bounce_reason': 'smtp;554 5.7.1 Blacklisted by black.uribl.com',
+    'bounce_class': '51',
+    'raw_reason': 'smtp;554 5.7.1 Blacklisted by black.uribl.com',
+}
+
+# Quotes, backslashes, % (which the templates must not take as a format), control characters and non-ASCII
+TRICKY = {
+    'ts': 1600000000.25,
+    'rcpt_to': '"O\'Brien %s"\\x@b\u00fccher.example',
+    'uniq_msg_id': '0000%(m)s"\u00e9',
+    'msg_from': 'bounce+%d@\u00e9xample.com',
+    'friendly_from': '"Caf\u00e9 \u2603" <caf\u00e9@example.com>',
+    'campaign_id': '100% "off"\ttoday\n',
+    'subject': '\u2603 Sn\u00f6w %% %(t)s \\o/ \U0001f600',
+    'sending_ip': '::1',
+    'geo_ip': {'country': 'D\u00c9', 'city': 'M\u00fcnchen "%s"', 'latitude': -0.5, 'zip': None},
+    'user_agent': 'UA/1.0 (\u00e9; "q"; 50%)',
+    'bounce_code': '5%0',
+    'bounce_reason': 'smtp;550 <"x"@y> 100% \u00fcber\\',
+    'bounce_class': '1\u00e9',
+    'raw_reason': 'raw %s %(r)s reason \u2603',
+}
+
+
+# (case name, keyword arguments) for each golden case of a builder, given its parameters
+def cases(name, params):
+    for values_name, values in (('plain', PLAIN), ('tricky', TRICKY)):
+        for privacy in (False, True):
+            kwargs = {k: v for k, v in values.items() if k in params}
+            kwargs['ts'] = Timestamp(values['ts'])
+            kwargs['privacy'] = privacy
+            yield '{} {} privacy={}'.format(name, values_name, privacy), kwargs
+    if 'recv_method' in params:
+        kwargs = {k: v for k, v in PLAIN.items() if k in params}
+        kwargs.update(ts=Timestamp(PLAIN['ts']), privacy=False, recv_method='rest')
+        yield '{} plain recv_method=rest'.format(name), kwargs
+
+
+def golden():
+    with open(GOLDEN) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('name', BUILDERS)
+def test_builder_matches_golden(name, monkeypatch):
+    monkeypatch.setattr(ingest, 'uniq_event_id', lambda: EVENT_ID)
+    expected = golden()
+    fn = getattr(ingest, name)
+    n = 0
+    for key, kwargs in cases(name, inspect.signature(fn).parameters):
+        assert fn(**kwargs) == expected[key], key
+        n += 1
+    assert n >= 4
+
+
+def test_golden_covers_every_builder():
+    assert sorted(set(k.split()[0] for k in golden())) == sorted(BUILDERS)
+    assert sorted(n for n in dir(ingest) if n.startswith('make_') and n.endswith('_event') and n != 'make_event') == sorted(BUILDERS)
+
+
+# Templates with the arguments bound in, as the sequences use, give the same lines
+@pytest.mark.parametrize('name', BUILDERS)
+def test_compiled_event_matches_golden(name, monkeypatch):
+    monkeypatch.setattr(ingest, 'uniq_event_id', lambda: EVENT_ID)
+    expected = golden()
+    for key, kwargs in cases(name, inspect.signature(getattr(ingest, name)).parameters):
+        kwargs = dict(kwargs)
+        ts, privacy, rcpt_to, msg_id = (kwargs.pop(k) for k in ('ts', 'privacy', 'rcpt_to', 'uniq_msg_id'))
+        (body,) = json.loads(expected[key])['msys'].values()
+        event = ingest.compile_event(body['type'], privacy, **kwargs)
+        assert event(ts, rcpt_to, msg_id) == expected[key], key
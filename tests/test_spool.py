@@ -0,0 +1,116 @@
+#
+# spool.Spool: torn record recovery, resuming from ack.json, and put() waiting and giving up at max_bytes
+#
+
+import os, threading
+import pytest
+import batch, spool
+
+
+def make_batch(i, size=100):
+    return batch.Batch(bytes([i % 256]) * size, i, size)
+
+
+def record_bytes(size=100):
+    return spool.HEADER.size + size
+
+
+def finished_batches(s):
+    s.finish()
+    return [b for b, position in s.batches()]
+
+
+def segments(path):
+    return sorted(f for f in os.listdir(path) if f.startswith('seg-'))
+
+
+def test_torn_record_is_skipped(tmp_path):
+    path = str(tmp_path)
+    with spool.Spool(path) as s:
+        for i in range(5):
+            assert s.put(make_batch(i))
+    (seg,) = segments(path)
+    with open(os.path.join(path, seg), 'r+b') as f:
+        f.truncate(os.path.getsize(f.name) - 10)            # a crash part-way through writing the last record
+    with spool.Spool(path) as s:
+        assert [b.events for b in finished_batches(s)] == [0, 1, 2, 3]
+
+
+def test_corrupt_record_ends_the_segment(tmp_path):
+    path = str(tmp_path)
+    with spool.Spool(path) as s:
+        for i in range(3):
+            s.put(make_batch(i))
+    with open(os.path.join(path, segments(path)[0]), 'r+b') as f:
+        f.seek(record_bytes() + spool.HEADER.size + 5)
+        f.write(b'\xff')                                    # payload of the second record no longer matches its CRC
+    with spool.Spool(path) as s:
+        assert [b.events for b in finished_batches(s)] == [0]
+
+
+def test_resumes_after_the_acknowledged_batch(tmp_path):
+    path = str(tmp_path)
+    with spool.Spool(path, segment_bytes=2 * record_bytes()) as s:
+        for i in range(7):
+            s.put(make_batch(i))
+        s.finish()
+        for n, (b, position) in enumerate(s.batches()):
+            s.ack(position)
+            if n == 4:
+                break
+    assert os.path.exists(os.path.join(path, spool.ACK_FILE))
+    assert len(segments(path)) == 2                         # the two segments wholly acknowledged are gone
+    with spool.Spool(path) as s:
+        assert s.pending_bytes == 2 * record_bytes()
+        assert [b.events for b in finished_batches(s)] == [5, 6]
+        assert s.put(make_batch(7))                         # new batches go after the ones left
+    with spool.Spool(path) as s:
+        assert [b.events for b in finished_batches(s)] == [5, 6, 7]
+
+
+@pytest.mark.parametrize('fsync', spool.FSYNC_POLICIES)
+def test_ack_is_saved_on_close(tmp_path, fsync):
+    path = str(tmp_path)
+    with spool.Spool(path, fsync=fsync, fsync_interval=3600) as s:
+        for i in range(3):
+            s.put(make_batch(i))
+        s.finish()
+        for b, position in s.batches():
+            s.ack(position)
+            break
+    with spool.Spool(path) as s:
+        assert [b.events for b in finished_batches(s)] == [1, 2]
+
+
+def test_put_waits_while_full(tmp_path):
+    with spool.Spool(str(tmp_path), max_bytes=2 * record_bytes()) as s:
+        assert s.put(make_batch(0)) and s.put(make_batch(1))
+        done = threading.Event()
+        t = threading.Thread(target=lambda: s.put(make_batch(2)) and done.set())
+        t.start()
+        assert not done.wait(0.2)                           # two batches unread: no room for a third
+        reader = s.batches()
+        next(reader)                                        # reading one makes room
+        assert done.wait(5)
+        t.join()
+        s.finish()
+        assert [b.events for b, position in reader] == [1, 2]
+
+
+def test_put_gives_up_when_full_and_nothing_reads(tmp_path):
+    with spool.Spool(str(tmp_path), max_bytes=2 * record_bytes()) as s:
+        s.stop_reading()
+        assert s.put(make_batch(0)) and s.put(make_batch(1))
+        assert not s.put(make_batch(2))
+        assert not s.stopped
+
+
+def test_put_returns_once_stopped(tmp_path):
+    with spool.Spool(str(tmp_path), max_bytes=record_bytes()) as s:
+        assert s.put(make_batch(0))
+        result = []
+        t = threading.Thread(target=lambda: result.append(s.put(make_batch(1))))
+        t.start()
+        s.stop()
+        t.join(5)
+        assert result == [False] and s.stopped
@@ -0,0 +1,148 @@
+#
+# Upload gzip event batches to the ingest API concurrently, over a pool of keep-alive connections
+#
+
+import collections, random, time, email.utils
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from journal import payload_digest
+
+# Outcome of one upload. seq is the position of the payload in the input stream; batch_id is None unless accepted.
+# attempts is the number of POSTs made; 0 means the batch was found already accepted in the journal.
+UploadResult = collections.namedtuple('UploadResult', ['seq', 'batch_id', 'status_code', 'content', 'attempts'])
+
+# Responses worth trying again: rate limiting and transient server-side errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+IN_FLIGHT = metrics.gauge('sparky_uploads_in_flight', 'Batches being uploaded, including waits between retries')
+UPLOAD_SECONDS = metrics.histogram('sparky_upload_seconds', 'Time taken by each POST to the ingest API')
+RESPONSES = metrics.counter('sparky_upload_responses_total', 'Responses from the ingest API, by status code', ['status'])
+RETRIES = metrics.counter('sparky_upload_retries_total', 'Upload attempts that were retried')
+EVENTS_UPLOADED = metrics.counter('sparky_events_uploaded_total', 'Events in batches accepted by the ingest API')
+BYTES_UPLOADED = metrics.counter('sparky_bytes_uploaded_total', 'Compressed bytes of batches accepted by the ingest API')
+SKIPPED = metrics.counter('sparky_batches_skipped_total', 'Batches not sent because the journal has them accepted')
+
+
+# Returns the number of seconds asked for by a Retry-After header (delta-seconds or HTTP-date form), or None
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Exponential backoff with "full jitter". A Retry-After from the server takes precedence over the computed delay.
+class RetryPolicy:
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+
+# Returns the batch ID from an ingest API response body, or None
+def batch_id_of(res):
+    if res.status_code != 200:
+        return None
+    try:
+        return res.json()['results']['id']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class BatchUploader:
+    # At most max_in_flight payloads are held at once (default: twice the number of workers), so a fast producer is
+    # paused rather than queueing unbounded data in memory.
+    # With a journal (journal.UploadJournal), batches already accepted are skipped and newly accepted ones recorded.
+    def __init__(self, url, hdrs, workers=4, max_in_flight=None, timeout=60, retry=None, journal=None):
+        import requests                         # imported when needed, so importing this module stays quick
+        self.url = url
+        self.workers = workers
+        self.max_in_flight = max_in_flight or 2 * workers
+        self.timeout = timeout
+        self.retry = retry or RetryPolicy()
+        self.journal = journal
+        self.session = requests.Session()
+        self.session.headers.update(hdrs)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self.session.close()
+
+    # POST one payload (bytes, or a batch.Batch) and return the requests.Response
+    def post(self, payload):
+        payload = getattr(payload, 'payload', payload)
+        return self.session.post(self.url, data=payload, timeout=self.timeout)
+
+    # POST one payload, retrying transient failures. Connection errors that outlast the retries are returned as a
+    # result with status_code None rather than raised.
+    # A response lost after the server accepted the batch makes the retry a "duplicate batch"; the events are
+    # still ingested once.
+    def _upload_one(self, seq, payload):
+        import requests
+        digest = None
+        if self.journal is not None:
+            digest = payload_digest(payload)
+            batch_id = self.journal.accepted(digest)
+            if batch_id:
+                SKIPPED.inc()
+                return UploadResult(seq, batch_id, 200, b'', 0)
+        IN_FLIGHT.inc()
+        try:
+            attempt = 0
+            while True:
+                retry_after = None
+                t = time.perf_counter()
+                try:
+                    res = self.post(payload)
+                    r = UploadResult(seq, batch_id_of(res), res.status_code, res.content, attempt + 1)
+                    retryable = res.status_code in RETRY_STATUS
+                    retry_after = parse_retry_after(res.headers.get('Retry-After'))
+                except (requests.ConnectionError, requests.Timeout) as err:
+                    r = UploadResult(seq, None, None, str(err).encode('utf-8'), attempt + 1)
+                    retryable = True
+                UPLOAD_SECONDS.observe(time.perf_counter() - t)
+                RESPONSES.labels(r.status_code or 'error').inc()
+                if not retryable or attempt >= self.retry.max_retries:
+                    break
+                RETRIES.inc()
+                time.sleep(self.retry.delay(attempt, retry_after))
+                attempt += 1
+        finally:
+            IN_FLIGHT.dec()
+        if r.batch_id:
+            EVENTS_UPLOADED.inc(getattr(payload, 'events', 0))
+            BYTES_UPLOADED.inc(len(getattr(payload, 'payload', payload)))
+            if self.journal is not None:
+                self.journal.record(digest, r.batch_id)
+        return r
+
+    # Generator: upload every payload from an iterable, yielding an UploadResult for each one in input order
+    def upload(self, payloads):
+        in_flight = collections.deque()
+        for seq, payload in enumerate(payloads):
+            if len(in_flight) >= self.max_in_flight:
+                yield in_flight.popleft().result()
+            in_flight.append(self._pool.submit(self._upload_one, seq, payload))
+        while in_flight:
+            yield in_flight.popleft().result()